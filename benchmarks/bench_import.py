@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""Benchmark of the bytterfs startup cost and of log calls on a disabled level.
+
+Measures `import bytterfs` and `bytterfs.py --help` in fresh interpreters, optionally against the bytterfs.py of an
+earlier git revision, and the cost of logDebug() with DEBUG disabled against the former eager helper.
+
+Usage: python3 benchmarks/bench_import.py [--baseline GIT_REVISION] [--runs N]
+"""
+import inspect
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import bytterfs  # noqa: E402
+
+CALLS = 100000
+
+
+def startup(directory, code, runs):
+    """Returns the median wall time in ms of running code in a fresh interpreter with directory on sys.path."""
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import sys; sys.path.insert(0, %r); %s" % (directory, code)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def legacyLogDebug(message):
+    """The logDebug of earlier versions, kept for comparison: frame lookup and formatting before the level check."""
+    func = inspect.currentframe().f_back.f_code
+    bytterfs.logger.debug("%s:%i  %s" % (func.co_name, func.co_firstlineno, message))
+
+
+def logCalls():
+    out, err = b"x" * 200, b""
+    start = time.perf_counter()
+    for i in range(CALLS):
+        legacyLogDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
+    legacy = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(CALLS):
+        bytterfs.logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+    current = time.perf_counter() - start
+    return legacy, current
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark bytterfs startup and disabled log calls.")
+    parser.add_argument("--baseline", help="Git revision whose bytterfs.py to compare with, e.g. HEAD~1.")
+    parser.add_argument("--runs", type=int, default=20, help="Interpreter starts per measurement. Default: 20.")
+    args = parser.parse_args()
+    versions = [("current", ROOT)]
+    baselineDir = None
+    if args.baseline:
+        baselineDir = tempfile.mkdtemp(prefix="bytterfs-baseline-")
+        with open(os.path.join(baselineDir, "bytterfs.py"), "wb") as f:
+            f.write(subprocess.check_output(["git", "-C", ROOT, "show", "%s:bytterfs.py" % args.baseline]))
+        versions.append((args.baseline, baselineDir))
+    try:
+        print("%-12s %14s %14s %14s" % ("version", "python [ms]", "import [ms]", "--help [ms]"))
+        for name, directory in versions:
+            python = startup(directory, "pass", args.runs)
+            imported = startup(directory, "import bytterfs", args.runs)
+            script = os.path.join(directory, "bytterfs.py")
+            helped = startup(directory, "sys.argv = ['bytterfs', '--help']; import runpy; "
+                                        "runpy.run_path(%r, run_name='__main__')" % script, args.runs)
+            print("%-12s %14.1f %14.1f %14.1f" % (name, python, imported, helped))
+    finally:
+        if baselineDir is not None:
+            shutil.rmtree(baselineDir, ignore_errors=True)
+    bytterfs.logger.setLevel(logging.ERROR)
+    legacy, current = logCalls()
+    print("%s logDebug calls with DEBUG disabled: legacy %.1f ms, current %.1f ms" % (CALLS, legacy * 1000,
+                                                                                    current * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""Benchmark of the retention planning engine (RetentionPolicy.plan) against the former nested-loop classification.
+
+Usage: python3 benchmarks/bench_retention.py [number of snapshots ...]
+"""
+import os
+import sys
+import time
+import random
+
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bytterfs import RetentionPolicy, evenSpread  # noqa: E402
+
+SPEC = "1w=14,4w=20,3m=24,6m=12,12m=12,24m=12"
+LEGACY_LIMIT = 20000  # The quadratic-ish legacy loop gets slow beyond this.
+
+
+def legacyPlan(spec, timestamps, now):
+    """The classification destKeepSnapshots used before the planning engine, kept for comparison."""
+    buckets = [(seconds, keep) for seconds, keep, label in RetentionPolicy.parse(spec).buckets]
+    tsDict = defaultdict(list)
+    for ts in sorted(str(ts) for ts in timestamps):
+        for index, (seconds, keep) in enumerate(buckets):
+            deltaTs = now - int(ts)
+            if index == 0:
+                if deltaTs < int(seconds):
+                    tsDict[seconds].append(ts)
+                continue
+            if deltaTs > int(buckets[index - 1][0]) and deltaTs < int(seconds):
+                tsDict[seconds].append(ts)
+    victims = []
+    for seconds, keep in buckets:
+        for key in tsDict:
+            if seconds == key and len(tsDict[key]) > int(keep):
+                victims.extend(evenSpread(tsDict[key], len(tsDict[key]) - int(keep)))
+    return victims
+
+
+def timeit(function, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    random.seed(42)
+    now = int(time.time())
+    policy = RetentionPolicy.parse(SPEC)
+    print("spec: %s" % SPEC)
+    print("%10s %14s %14s %10s" % ("snapshots", "plan [ms]", "legacy [ms]", "deletes"))
+    for size in sizes:
+        timestamps = [now - random.randint(0, 800 * 24 * 60 * 60) for i in range(size)]
+        parsed = timeit(lambda: policy.plan(timestamps, now))
+        withParse = timeit(lambda: RetentionPolicy.parse(SPEC).plan(timestamps, now))
+        deletes = len(policy.plan(timestamps, now).delete)
+        legacy = timeit(lambda: legacyPlan(SPEC, timestamps, now), repeat=1) if size <= LEGACY_LIMIT else None
+        print("%10s %14.2f %14s %10s" % (size, min(parsed, withParse) * 1000,
+                                         "%.2f" % (legacy * 1000) if legacy is not None else "skipped", deletes))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 100000])
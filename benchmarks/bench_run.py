@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+"""End to end benchmark of Bytterfs.run() against the btrfs/ssh/sudo stand-ins in fakebin.py.
+
+Every scenario runs in a fresh temporary directory with the stand-ins first on PATH. It reports wall time, spawned
+processes and stream bytes, split into the phases inventory (subvol list, filesystem du), snapshot, transfer
+(send/receive) and prune (subvol delete), plus the sudo and ssh wrapper processes.
+
+Usage: python3 benchmarks/bench_run.py [options] [full|incremental|lockfile|prune ...]
+"""
+import logging
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import uuid
+
+from argparse import ArgumentParser
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+from bytterfs import Bytterfs, parseRate  # noqa: E402
+
+SNAPSHOT_NAME = "bench"
+KEEP = "1w=7,4w=4,3m=3,12m=6,24m=6"
+PHASES = ["inventory", "snapshot", "transfer", "prune", "sudo", "ssh"]
+
+
+class Scenario:
+    """A temporary client and destination filesystem for the stand-ins, with helpers to populate it."""
+
+    def __init__(self, root):
+        self.root = root
+        self.source = os.path.join(root, "src") + "/"
+        self.destRootSubvol = os.path.join(root, "dest") + "/"
+        self.destContainer = os.path.join(root, "dest", "c") + "/"
+        self.now = int(time.time())
+        os.makedirs(self.source)
+        os.makedirs(self.destContainer)
+
+    def snapshot(self, age, onDest=True):
+        """Creates a client snapshot age seconds old and, if onDest, its received copy on the destination."""
+        name = "%s_%s" % (SNAPSHOT_NAME, self.now - age)
+        snapshotUUID = str(uuid.uuid4())
+        self.writeMeta(os.path.join(self.source, name), {"uuid": snapshotUUID})
+        if onDest:
+            self.destSnapshot(age, snapshotUUID)
+        return name
+
+    def destSnapshot(self, age, receivedUUID=None):
+        name = "%s_%s" % (SNAPSHOT_NAME, self.now - age)
+        self.writeMeta(os.path.join(self.destContainer, name), {"uuid": str(uuid.uuid4()),
+                                                                "receivedUUID": receivedUUID or str(uuid.uuid4())})
+        return name
+
+    def writeMeta(self, path, meta):
+        os.makedirs(path)
+        with open(os.path.join(path, ".bench"), "w") as f:
+            json.dump(meta, f)
+
+    def lockfile(self):
+        open(os.path.join(self.source, "bytterfs.lock"), "w").close()
+
+
+def setupFull(scenario, args):
+    pass
+
+
+def setupIncremental(scenario, args):
+    scenario.snapshot(3600)
+
+
+def setupLockfile(scenario, args):
+    scenario.snapshot(2 * 3600)
+    scenario.snapshot(3600)
+    scenario.lockfile()
+
+
+def setupPrune(scenario, args):
+    spacing = 2 * 365 * 24 * 3600 // args.snapshots
+    for index in range(args.snapshots - 1, 0, -1):
+        scenario.destSnapshot(index * spacing + 3600)
+    scenario.snapshot(3600)
+
+
+SCENARIOS = {"full": setupFull, "incremental": setupIncremental, "lockfile": setupLockfile, "prune": setupPrune}
+
+
+def phaseOf(tool, args):
+    if tool != "btrfs":
+        return tool
+    words = [arg for arg in args if not arg.startswith("-")]
+    if words[:1] in (["send"], ["receive"]):
+        return "transfer"
+    if words[1:2] == ["snapshot"]:
+        return "snapshot"
+    if words[1:2] == ["delete"]:
+        return "prune"
+    return "inventory"
+
+
+def readSpawns(state):
+    """Returns {phase: [spawns, seconds, bytes]} from the stand-ins' log."""
+    phases = defaultdict(lambda: [0, 0.0, 0])
+    with open(os.path.join(state, "spawns.log")) as f:
+        for line in f:
+            tool, seconds, count, args = (line.rstrip("\n").split(" ", 3) + [""])[:4]
+            phase = phases[phaseOf(tool, args.split())]
+            phase[0] += 1
+            phase[1] += float(seconds)
+            if args.split()[:1] == ["receive"]:
+                phase[2] += int(count)
+    return phases
+
+
+def runScenario(name, args):
+    root = tempfile.mkdtemp(prefix="bytterfs-bench-")
+    environ = dict(os.environ)
+    try:
+        binDir = os.path.join(root, "bin")
+        os.makedirs(binDir)
+        for tool in ("btrfs", "ssh", "sudo"):
+            os.symlink(os.path.join(BENCH_DIR, "fakebin.py"), os.path.join(binDir, tool))
+        scenario = Scenario(os.path.join(root, "state"))
+        SCENARIOS[name](scenario, args)
+        os.environ.update({"PATH": "%s:%s" % (binDir, os.environ["PATH"]), "BENCH_STATE": scenario.root,
+                           "BENCH_FULL_SIZE": str(parseRate(args.fullSize)),
+                           "BENCH_INC_SIZE": str(parseRate(args.incSize)),
+                           "BENCH_LIST_EXTRA": str(args.listExtra), "BENCH_LATENCY": str(args.latency),
+                           "BENCH_SEND_STALLS": args.sendStalls or "", "BENCH_RECV_STALLS": args.recvStalls or "",
+                           "BENCH_DELETE_TIME": str(args.deleteTime)})
+        os.environ.pop("BYTTERFS_SSH", None)
+        open(os.path.join(scenario.root, "spawns.log"), "w").close()
+        bytterfs = Bytterfs(SNAPSHOT_NAME, scenario.source, scenario.destRootSubvol, scenario.destContainer, KEEP,
+                            "bench@localhost", "22", "/dev/null", relay=args.relay, agent=args.agent,
+                            buffer=args.buffer, checksum=args.checksum, archive=args.archive,
+                            archiveWriters=args.archiveWriters, stateDir=os.path.join(root, "var") + "/",
+                            overlapPrune=args.overlapPrune)
+        start = time.perf_counter()
+        try:
+            bytterfs.run()
+        except SystemExit:
+            pass  # Bytterfs ends every run with exit().
+        elapsed = time.perf_counter() - start
+        return elapsed, bytterfs.completed, readSpawns(scenario.root)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark Bytterfs.run() against simulated btrfs, ssh and sudo.")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run: %s. Default: all." % ", ".join(SCENARIOS))
+    parser.add_argument("--snapshots", type=int, default=2000,
+                        help="Destination snapshots of the prune scenario, spread over two years. Default: 2000.")
+    parser.add_argument("--listExtra", type=int, default=0,
+                        help="Unrelated subvolumes in every btrfs subvol list output. Default: 0.")
+    parser.add_argument("--fullSize", default="64M", help="Size of a full send stream. Default: 64M.")
+    parser.add_argument("--incSize", default="4M", help="Size of an incremental send stream. Default: 4M.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated link latency in seconds per SSH round trip. Default: 0.")
+    parser.add_argument("--relay", action="store_true", help="Relay the stream in-process.")
+    parser.add_argument("--agent", action="store_true", help="Answer destination queries with the remote agent.")
+    parser.add_argument("--buffer", help="Ring buffer between send and receive, e.g. 64M.")
+    parser.add_argument("--checksum", action="store_true", help="Hash the stream and write manifests.")
+    parser.add_argument("--archive", action="store_true", help="Store the streams as chunks in an archive directory.")
+    parser.add_argument("--archiveWriters", type=int, help="Chunk writer threads of --archive.")
+    parser.add_argument("--overlapPrune", action="store_true", help="Delete snapshots while the stream is sent.")
+    parser.add_argument("--deleteTime", type=float, default=0.0,
+                        help="Simulated seconds to delete one subvolume. Default: 0.")
+    parser.add_argument("--sendStalls", metavar="MB:SECONDS", help="Pause send for SECONDS after every MB MiB.")
+    parser.add_argument("--recvStalls", metavar="MB:SECONDS", help="Pause receive for SECONDS after every MB MiB.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the bytterfs log.")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s" % name)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    print("%-12s %-10s %8s %10s %14s" % ("scenario", "phase", "spawns", "time [s]", "bytes"))
+    for name in args.scenarios or ["full", "incremental", "lockfile", "prune"]:
+        elapsed, completed, phases = runScenario(name, args)
+        for phase in PHASES:
+            if phase in phases:
+                spawns, seconds, count = phases[phase]
+                print("%-12s %-10s %8s %10.3f %14s" % (name, phase, spawns, seconds, count or ""))
+        print("%-12s %-10s %8s %10.3f %14s %s" % (
+            name, "total", sum(phase[0] for phase in phases.values()), elapsed,
+            sum(phase[2] for phase in phases.values()), "ok" if completed else "FAILED"))
+
+
+if __name__ == "__main__":
+    main()
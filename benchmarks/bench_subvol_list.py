@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+"""Benchmark of the `btrfs subvol list` parser (iterSubvolList) against the former split(" ") parsing.
+
+Generates a listing like that of a filesystem with docker and snapper trees next to the backup container and
+parses it from memory and from a pipe, once unfiltered and filtered down to the backup snapshots in several ways.
+
+Usage: python3 benchmarks/bench_subvol_list.py [--lines N] [--snapshots N]
+"""
+import os
+import sys
+import time
+import uuid
+import tempfile
+import tracemalloc
+
+from argparse import ArgumentParser
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bytterfs import iterSubvolList  # noqa: E402
+
+SNAPSHOT_NAME = "home"
+CONTAINER = "backups/home"
+
+
+def listing(lines, snapshots):
+    """Returns `btrfs subvol list -u -R` output with snapshots backup snapshots among lines rows."""
+    rows = []
+    for index in range(lines):
+        if index < snapshots:
+            path = "%s/%s_%s" % (CONTAINER, SNAPSHOT_NAME, 1500000000 + index * 3600)
+        elif index % 3:
+            path = "var/lib/docker/btrfs/subvolumes/%s" % uuid.UUID(int=index).hex
+        else:
+            path = "@/.snapshots/%s/snapshot" % index
+        rows.append("ID %s gen %s top level 5 uuid %s received_uuid %s path %s\n" % (
+            256 + index, 1000 + index, uuid.UUID(int=index), "-" if index % 2 else uuid.UUID(int=~index & 2 ** 128 - 1),
+            path))
+    return "".join(rows).encode("latin-1")
+
+
+def legacyParse(out):
+    """The parsing of the former clientSubvolList/destSubvolList, kept for comparison."""
+    subvolList = []
+    for row in filter(None, out.decode('latin-1').split("\n")):
+        splitLine = row.split(" ")
+        subvolUUID = splitLine[8]
+        subvolName = "".join(splitLine[10:])
+        if SNAPSHOT_NAME in os.path.basename(os.path.normpath(subvolName)):
+            subvolList.append((subvolName.rstrip("\r"), subvolUUID))
+    return subvolList
+
+
+def measure(function):
+    """Returns (result, seconds, peak traced memory in bytes) of function(), timed without tracing."""
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def fromPipe(path, **filters):
+    p1 = Popen(["cat", path], stdout=PIPE)
+    records = list(iterSubvolList(p1.stdout, **filters))
+    p1.wait()
+    return records
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark parsing of btrfs subvol list output.")
+    parser.add_argument("--lines", type=int, default=50000, help="Rows of the listing. Default: 50000.")
+    parser.add_argument("--snapshots", type=int, default=500, help="Backup snapshots among them. Default: 500.")
+    args = parser.parse_args()
+    out = listing(args.lines, args.snapshots)
+    pattern = r"%s_\d+" % SNAPSHOT_NAME
+    snapshotPrefix = "%s_" % SNAPSHOT_NAME  # What SubvolInventory passes along with the pattern.
+    with tempfile.NamedTemporaryFile(prefix="bytterfs-subvol-list-") as f:
+        f.write(out)
+        f.flush()
+        cases = [("legacy split", lambda: legacyParse(out)),
+                 ("records", lambda: list(iterSubvolList(out.splitlines()))),
+                 ("records pattern", lambda: list(iterSubvolList(out.splitlines(), pattern=pattern))),
+                 ("records prefix", lambda: list(iterSubvolList(out.splitlines(), prefix=CONTAINER))),
+                 ("records name", lambda: list(iterSubvolList(out.splitlines(), pattern=pattern, name=snapshotPrefix))),
+                 ("pipe pattern", lambda: fromPipe(f.name, pattern=pattern)),
+                 ("pipe name", lambda: fromPipe(f.name, pattern=pattern, name=snapshotPrefix))]
+        print("%s rows, %s backup snapshots, %.1f MB" % (args.lines, args.snapshots, len(out) / 1e6))
+        print("%-16s %10s %10s %12s" % ("parser", "rows", "time [ms]", "peak [MB]"))
+        for name, function in cases:
+            result, elapsed, peak = measure(function)
+            print("%-16s %10s %10.1f %12.1f" % (name, len(result), elapsed * 1000, peak / 1e6))
+
+
+if __name__ == "__main__":
+    main()
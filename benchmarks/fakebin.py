@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Stand-in for btrfs, ssh and sudo used by bench_run.py. Dispatches on the name it is called by.
+
+The simulated subvolumes are directories with a .bench file holding their uuid and received_uuid, so a container
+is a plain directory below BENCH_STATE. The stand-ins are configured through the environment:
+
+    BENCH_STATE        directory with the simulated filesystems and the logs (required)
+    BENCH_FULL_SIZE    bytes of a full send stream (default 64M)
+    BENCH_INC_SIZE     bytes of an incremental send stream (default 4M)
+    BENCH_LIST_EXTRA   unrelated subvolumes added to every listing (default 0)
+    BENCH_LATENCY      seconds of link latency per ssh round trip; a new connection costs three (default 0)
+    BENCH_SEND_STALLS  "MB:SECONDS": send pauses for SECONDS after every MB MiB, like a disk seeking (default none)
+    BENCH_RECV_STALLS  "MB:SECONDS": receive pauses likewise, like a stalling link (default none)
+    BENCH_DELETE_TIME  seconds that deleting one subvolume takes (default 0)
+    BENCH_CLONE_SHARED fraction of a send stream left out when clone sources are given with -c (default 0)
+    BENCH_RECV_FAIL    container whose receives fail at the end of the stream, leaving an incomplete subvolume
+
+A subvolume holding a .busy file can't be deleted, like a mounted one.
+
+Every invocation appends "<tool> <seconds> <bytes> <args>" to BENCH_STATE/spawns.log.
+"""
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+BLOCK = 1024 * 1024
+STATE = os.environ["BENCH_STATE"]
+
+
+def logSpawn(tool, started, args, count=0):
+    with open(os.path.join(STATE, "spawns.log"), "a") as f:
+        f.write("%s %.6f %s %s\n" % (tool, time.time() - started, count, " ".join(args).replace("\n", " ")))
+
+
+def size(name, default):
+    return int(os.environ.get(name, default))
+
+
+def stalls(name):
+    """Returns (bytes, seconds) of the BENCH_*_STALLS setting name, or None."""
+    value = os.environ.get(name)
+    if not value:
+        return None
+    every, sep, seconds = value.partition(":")
+    return int(float(every) * BLOCK), float(seconds)
+
+
+def stall(setting, before, after):
+    if setting is not None and before // setting[0] != after // setting[0]:
+        time.sleep(setting[1])
+
+
+def readMeta(path):
+    try:
+        with open(os.path.join(path, ".bench")) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def writeMeta(path, meta):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".bench"), "w") as f:
+        json.dump(meta, f)
+
+
+def subvolList(args):
+    path = args[-1]
+    rows = []
+    for index, name in enumerate(sorted(os.listdir(path)) if os.path.isdir(path) else []):
+        if not os.path.isdir(os.path.join(path, name)):
+            continue  # e.g. the lockfile in the source
+        meta = readMeta(os.path.join(path, name)) or {
+            "uuid": str(uuid.uuid5(uuid.NAMESPACE_URL, os.path.join(path, name)))}
+        row = "ID %s gen %s top level 5" % (256 + index, 10 + index)
+        if "-u" in args:
+            row += " uuid %s" % meta["uuid"]
+        if "-R" in args:
+            row += " received_uuid %s" % (meta.get("receivedUUID") or "-")
+        rows.append("%s path %s" % (row, os.path.relpath(os.path.join(path, name), STATE)))
+    for index in range(size("BENCH_LIST_EXTRA", 0)):
+        rows.append("ID %s gen 1 top level 5 uuid %s path other/volume_%s" % (100000 + index, uuid.uuid4(), index))
+    sys.stdout.write("".join(row + "\n" for row in rows))
+    return 0
+
+
+def send(args):
+    snapshot = args[-1].rstrip("/")
+    meta = readMeta(snapshot)
+    if meta is None:
+        sys.stderr.write("ERROR: cannot find %s\n" % snapshot)
+        return -1
+    remaining = size("BENCH_INC_SIZE", 4 * BLOCK) if "-p" in args else size("BENCH_FULL_SIZE", 64 * BLOCK)
+    if "-c" in args:
+        remaining = int(remaining * (1 - float(os.environ.get("BENCH_CLONE_SHARED", 0))))
+    out = sys.stdout.buffer
+    header = (json.dumps({"name": os.path.basename(snapshot), "uuid": meta["uuid"]}) + "\n").encode()
+    out.write(header)
+    block = b"\0" * BLOCK
+    sent = len(header)
+    setting = stalls("BENCH_SEND_STALLS")
+    while remaining > 0:
+        chunk = block[:min(remaining, BLOCK)]
+        out.write(chunk)
+        remaining -= len(chunk)
+        stall(setting, sent, sent + len(chunk))
+        sent += len(chunk)
+    out.flush()
+    return sent
+
+
+def receive(args):
+    stream = sys.stdin.buffer
+    header = json.loads(stream.readline().decode())
+    received = 0
+    setting = stalls("BENCH_RECV_STALLS")
+    while True:
+        chunk = stream.read(BLOCK)
+        if not chunk:
+            break
+        stall(setting, received, received + len(chunk))
+        received += len(chunk)
+    path = os.path.join(args[-1], header["name"])
+    if os.environ.get("BENCH_RECV_FAIL") == args[-1]:
+        writeMeta(path, {"uuid": str(uuid.uuid4())})  # received_uuid is only set once a receive completed.
+        sys.stderr.write("ERROR: short read from stream\n")
+        return -1
+    writeMeta(path, {"uuid": str(uuid.uuid4()), "receivedUUID": header["uuid"]})
+    sys.stdout.write("At subvol %s\n" % header["name"])
+    return received
+
+
+def btrfs(args):
+    """Returns the number of stream bytes handled, or -1 for a failure."""
+    command = [arg for arg in args if not arg.startswith("-") or arg in ("-p", "-r")]
+    if command[:1] in (["sub"], ["subvolume"]):
+        command[0] = "subvol"
+    if command[:2] == ["subvol", "list"]:
+        return subvolList(args)
+    if command[:2] == ["subvol", "snapshot"]:
+        writeMeta(args[-1], {"uuid": str(uuid.uuid4())})
+        return 0
+    if command[:2] == ["subvol", "show"]:
+        meta = readMeta(args[-1])
+        if meta is None:
+            sys.stderr.write("ERROR: cannot find %s\n" % args[-1])
+            return -1
+        sys.stdout.write("%s\n\tName: \t\t\t%s\n\tUUID: \t\t\t%s\n" % (
+            args[-1], os.path.basename(args[-1].rstrip("/")), meta["uuid"]))
+        return 0
+    if command[:2] == ["subvol", "find-new"]:
+        remaining = size("BENCH_INC_SIZE", 4 * BLOCK)
+        index = 0
+        while remaining > 0:
+            length = min(remaining, BLOCK)
+            sys.stdout.write("inode %s file offset 0 len %s disk start 0 offset 0 gen %s flags NONE file_%s\n" % (
+                257 + index, length, 100 + index, index))
+            remaining -= length
+            index += 1
+        sys.stdout.write("transid marker was %s\n" % (100 + index))
+        return 0
+    if command[:2] == ["subvol", "delete"]:
+        status = 0
+        for path in args[2:]:
+            if path.startswith("--"):
+                continue
+            time.sleep(float(os.environ.get("BENCH_DELETE_TIME", 0)))
+            if os.path.exists(os.path.join(path, ".busy")):
+                sys.stderr.write("ERROR: Could not destroy subvolume/snapshot: Device or resource busy\n")
+                status = -1
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            sys.stdout.write("Delete subvolume (no-commit): '%s'\n" % path)
+        return status
+    if command[:2] == ["filesystem", "du"]:
+        sys.stdout.write("     Total   Exclusive  Set shared  Filename\n%10s %10s %10s  %s\n" % (
+            size("BENCH_FULL_SIZE", 64 * BLOCK), 0, 0, args[-1]))
+        return 0
+    if command[:1] == ["send"]:
+        return send(args)
+    if command[:1] == ["receive"]:
+        return receive(args)
+    sys.stderr.write("fakebin: unsupported btrfs command %s\n" % " ".join(args))
+    return -1
+
+
+def ssh(args):
+    """Runs the remote command locally after sleeping for the simulated link latency."""
+    latency = float(os.environ.get("BENCH_LATENCY", 0))
+    options = {}
+    index = 0
+    while index < len(args) and args[index].startswith("-"):
+        if args[index] in ("-i", "-p", "-O"):
+            options[args[index]] = args[index + 1]
+            index += 2
+        elif args[index] == "-o":
+            key, sep, value = args[index + 1].partition("=")
+            options[key] = value
+            index += 2
+        else:
+            options[args[index]] = True
+            index += 1
+    controlPath = options.get("ControlPath")
+    if options.get("-O") == "exit":
+        if controlPath and os.path.exists(controlPath):
+            os.remove(controlPath)
+        return []
+    if options.get("ControlMaster") == "yes":
+        time.sleep(3 * latency)
+        open(controlPath, "w").close()
+        return []
+    time.sleep(latency if controlPath and os.path.exists(controlPath) else 3 * latency)
+    remote = args[index + 1:]
+    if remote[:1] == ["-t"]:
+        remote = remote[1:]
+    return remote
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    started = time.time()
+    if tool == "sudo":
+        logSpawn(tool, started, args)
+        while args[0].startswith("-"):
+            args = args[1:]  # e.g. -n
+        os.execvp(args[0], args)
+    if tool == "ssh":
+        remote = ssh(args)
+        logSpawn(tool, started, args)
+        if remote:
+            os.execvp("sh", ["sh", "-c", " ".join(remote)])
+        return 0
+    count = btrfs(args)
+    logSpawn(tool, started, args, max(count, 0))
+    return 1 if count < 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
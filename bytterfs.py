@@ -2,24 +2,35 @@
 __author__ = 'eayin'
 __version__ = '0.1.0'
 
-import traceback
 import os
 import logging
-import logging.handlers
 import sys
 import heapq
 import time
 import re
 import copy
-import inspect
 import errno
+import shutil
+import tempfile
+import threading
+import queue
+import shlex
+import zlib
+import json
+import struct
+import fcntl
+import bisect
+import random
+import contextlib
 
 from math import ceil
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
 from argparse import ArgumentParser, ArgumentTypeError
 from collections import defaultdict
+from itertools import compress
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
+logger = logging.getLogger(app_name)  # Handlers are only added by main(), importing bytterfs configures nothing.
 
 
 class ColoredConsoleHandler(logging.StreamHandler):
@@ -44,23 +55,29 @@ class ColoredConsoleHandler(logging.StreamHandler):
         logging.StreamHandler.emit(self, myrecord)
 
 #### Functions
-def logInfo(message):
+def logRecord(level, message, args):
     "Automatically log the current function details."
-    # Get the previous frame in the stack, otherwise it would be this function.
-    func = inspect.currentframe().f_back.f_code
-    logger.info("%s:%i  %s" % (func.co_name, func.co_firstlineno, message))
+    # Get the frame of the log*() caller, otherwise it would be this function or log*().
+    func = sys._getframe(2).f_code
+    logger.log(level, "%s:%i  %s", func.co_name, func.co_firstlineno, message % args if args else message)
 
-def logError(message):
-    func = inspect.currentframe().f_back.f_code
-    logger.error("%s:%i  %s" % (func.co_name, func.co_firstlineno, message))
+# The level check comes first, so a disabled level costs neither the frame lookup nor formatting. Pass the values
+# of message as extra arguments instead of formatting it beforehand to get the same for the message itself.
+def logInfo(message, *args):
+    if logger.isEnabledFor(logging.INFO):
+        logRecord(logging.INFO, message, args)
 
-def logWarning(message):
-    func = inspect.currentframe().f_back.f_code
-    logger.warning("%s:%i  %s" % (func.co_name, func.co_firstlineno, message))
+def logError(message, *args):
+    if logger.isEnabledFor(logging.ERROR):
+        logRecord(logging.ERROR, message, args)
 
-def logDebug(message):
-    func = inspect.currentframe().f_back.f_code
-    logger.debug("%s:%i  %s" % (func.co_name, func.co_firstlineno, message))
+def logWarning(message, *args):
+    if logger.isEnabledFor(logging.WARNING):
+        logRecord(logging.WARNING, message, args)
+
+def logDebug(message, *args):
+    if logger.isEnabledFor(logging.DEBUG):
+        logRecord(logging.DEBUG, message, args)
 
 def is_number(s):
     try:
@@ -84,8 +101,14 @@ def evenSpread(sequence, num):
     for i in range(num):
         yield sequence[int(ceil(i * length / num))]
 
+GYMAIL = "/usr/bin/gymail.py"
+
+
 def sendmail(event, subject, message):
-    p = Popen(["/usr/bin/gymail.py", "-e", event, "-s", subject, "-m", message], stdout=PIPE, stderr=PIPE)
+    if not os.path.isfile(GYMAIL):
+        logWarning("%s is not installed. Not sending %s mail: %s", GYMAIL, event, subject)
+        return
+    p = Popen([GYMAIL, "-e", event, "-s", subject, "-m", message], stdout=PIPE, stderr=PIPE)
     out, err = p.communicate()
 
 def checkPath(string):
@@ -96,74 +119,2546 @@ def checkPath(string):
     return value
 
 def checkTimespan(string):
-    stringList = string.split(",")
-    daysList = []
-    for element in stringList:
-        match = re.search("([0-9]+)([m|w])=([0-9]+)", element)
-        if match.group(2) == "w":
-            days = int(match.group(1))*7
-        elif match.group(2) == "m":
-            days = int(match.group(1))*30
+    RetentionPolicy.parse(string)
+    return string
+
+def touch(fname, times=None):
+    with open(fname, 'a'):
+        os.utime(fname, times)
+
+DEFAULT_MOUNT_DIR = "/mnt/bytterfs/"
+BTRFS_IOC_FS_INFO = 0x8400941f  # _IOR(0x94, 31, struct btrfs_ioctl_fs_info_args), 1024 bytes
+
+
+def unescapeMountinfo(field):
+    """Decodes the octal escapes of a mountinfo field, e.g. \\040 for a space."""
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+
+def iterMountinfo():
+    """Yields the entries of /proc/self/mountinfo as dicts with mountPoint, root (the mounted path inside the
+    filesystem, e.g. the subvolume), devNumber (major:minor, the same for all mounts of one filesystem), fsType,
+    device and superOptions."""
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            fields, sep, tail = line.rstrip("\n").partition(" - ")
+            fields = fields.split(" ")
+            tail = tail.split(" ")
+            yield {"mountPoint": unescapeMountinfo(fields[4]), "root": unescapeMountinfo(fields[3]),
+                   "devNumber": fields[2], "fsType": tail[0], "device": tail[1],
+                   "superOptions": tail[2] if len(tail) > 2 else ""}
+
+
+def findMount(path):
+    """Returns the /proc/self/mountinfo entry of the mount containing path as dict, or None if unknown."""
+    path = os.path.realpath(path)
+    best = None
+    try:
+        for entry in iterMountinfo():
+            mountPoint = entry["mountPoint"]
+            if path != mountPoint and not path.startswith(mountPoint.rstrip("/") + "/"):
+                continue
+            if best is None or len(mountPoint) >= len(best["mountPoint"]):
+                best = entry
+    except (IOError, IndexError):
+        return None
+    return best
+
+
+def btrfsFsid(path):
+    """Returns the UUID of the btrfs filesystem containing the directory path from BTRFS_IOC_FS_INFO, or None."""
+    import uuid
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except (IOError, OSError):
+        return None
+    try:
+        args = bytearray(1024)  # max_id, num_devices, then the 16 byte fsid.
+        fcntl.ioctl(fd, BTRFS_IOC_FS_INFO, args, True)
+    except (IOError, OSError):
+        return None
+    finally:
+        os.close(fd)
+    return str(uuid.UUID(bytes=bytes(args[16:32])))
+
+
+class SharedMount:
+    """Top level (subvolid=5) of a btrfs filesystem mounted at mountDir/name, shared by all local jobs on it.
+
+    Every user holds a shared flock on <name>.users while it needs the mount, and mounting and unmounting happen
+    under an exclusive flock on <name>.lock. The last user, i.e. the one that can lock <name>.users exclusively,
+    unmounts on release. The kernel drops the locks of a run that died, so the count can't go stale, and it works
+    across threads of one process as well as across processes. A top level mounted elsewhere, e.g. from fstab, is
+    used as it is.
+    """
+
+    def __init__(self, name, device, devNumber, mountDir=DEFAULT_MOUNT_DIR):
+        self.name = name
+        self.device = device
+        self.devNumber = devNumber
+        self.mountPoint = os.path.join(mountDir, name)
+        self.users = None  # File holding the shared lock while acquired.
+        self.path = None  # Mount point of the top level while acquired.
+
+    @contextlib.contextmanager
+    def mutex(self):
+        with open("%s.lock" % self.mountPoint, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def topLevel(self):
+        """Returns the mount point of a top level mount of the filesystem, our own first, or None."""
+        found = None
+        for entry in iterMountinfo():
+            if entry["devNumber"] == self.devNumber and entry["root"] == "/" and entry["fsType"] == "btrfs":
+                if entry["mountPoint"] == self.mountPoint:
+                    return self.mountPoint
+                found = found or entry["mountPoint"]
+        return found
+
+    def acquire(self, command):
+        """Counts this user, mounts the top level unless it is already, and returns its mount point or None."""
+        if self.path is not None:
+            return self.path
+        mkdir_p(self.mountPoint)
+        with self.mutex():
+            self.users = open("%s.users" % self.mountPoint, "a")
+            fcntl.flock(self.users, fcntl.LOCK_SH)
+            path = self.topLevel()
+            if path is None:
+                result = command(["sudo", "mount", "-t", "btrfs", "-o", "subvolid=5", self.device, self.mountPoint])
+                if result.returncode != 0:
+                    logError("Could not mount the top level of %s at %s: %s", self.device, self.mountPoint,
+                             result.stderr.decode("utf-8", "replace").strip())
+                    self.users.close()
+                    self.users = None
+                    return None
+                path = self.mountPoint
+                logDebug("Mounted the top level of %s at %s", self.device, path)
+        self.path = path
+        return path
+
+    def release(self, command):
+        """Drops this user and unmounts our mount if it was the last one. Returns False if unmounting failed."""
+        if self.users is None:
+            return True
+        with self.mutex():
+            self.users.close()
+            self.users = None
+            self.path = None
+            if self.topLevel() != self.mountPoint:
+                return True  # Mounted by someone else, or unmounted behind our back.
+            with open("%s.users" % self.mountPoint, "a") as users:
+                try:
+                    fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return True  # Another job still uses it.
+                logDebug("Umounting %s", self.mountPoint)
+                result = command(["sudo", "umount", self.mountPoint])
+                return result.returncode == 0
+
+
+class RetentionPolicy:
+    """Parsed -dk/--destKeep spec: a list of (seconds, keep) buckets with ascending time spans.
+
+    Bucket i holds the snapshots whose age is at least the span of bucket i-1 and less than its own span, so a
+    snapshot exactly on a boundary belongs to the older bucket instead of falling through. Snapshots older than the
+    last span are not managed and always kept.
+    """
+
+    units = {"w": 7 * 24 * 60 * 60, "m": 30 * 24 * 60 * 60}
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    @classmethod
+    def parse(cls, spec):
+        buckets = []
+        for element in spec.split(","):
+            match = re.match(r"^([0-9]+)([a-z])=([0-9]+)$", element.strip())
+            if match is None:
+                raise ArgumentTypeError("%r Syntax is <time span>[w|m]=<number of snapshots>, e.g. 5w=6." % spec)
+            if match.group(2) not in cls.units:
+                raise ArgumentTypeError("%r Only w (for weeks) and m (for months) are accepted syntax." % spec)
+            buckets.append((int(match.group(1)) * cls.units[match.group(2)], int(match.group(3)), element.strip()))
+        if [bucket[0] for bucket in buckets] != sorted(bucket[0] for bucket in buckets):
+            raise ArgumentTypeError("%r time spans are unsorted." % spec)
+        return cls(buckets)
+
+    def plan(self, timestamps, now=None):
+        """Returns the RetentionPlan for the given snapshot timestamps (ints or digit strings)."""
+        now = int(time.time() if now is None else now)
+        timestamps = sorted(map(int, timestamps))
+        plan = RetentionPlan()
+        upper = len(timestamps)  # Bucket 0 also takes timestamps from the future.
+        for seconds, keep, label in self.buckets:
+            # Bucket members have now - seconds < ts, found by bisecting the sorted timestamps once per bucket.
+            lower = bisect.bisect_right(timestamps, now - seconds)
+            members = timestamps[lower:upper]
+            length = len(members)
+            count = length - keep
+            if count > 0:
+                # Same picks as evenSpread(members, count), in integer arithmetic.
+                victimIndexes = [-(-i * length // count) for i in range(count)]
+                victims = [members[index] for index in victimIndexes]
+                plan.delete.extend(victims)
+                keepMask = [True] * length
+                for index in victimIndexes:
+                    keepMask[index] = False
+                plan.keep.extend(compress(members, keepMask))
+                victims = set(victims)
+            else:
+                victims = set()
+                plan.keep.extend(members)
+            plan.buckets.append((label, keep, members, victims))
+            upper = lower
+        plan.unmanaged = timestamps[:upper]
+        plan.keep[:0] = plan.unmanaged
+        plan.keep.sort()
+        plan.delete.sort()
+        return plan
+
+
+class RetentionPlan:
+    """Result of RetentionPolicy.plan(): sorted timestamps to keep and to delete, and the bucket breakdown."""
+
+    def __init__(self):
+        self.keep = []
+        self.delete = []
+        self.unmanaged = []
+        self.buckets = []  # (label, keep, member timestamps, victim timestamps)
+
+    def describe(self, snapshotName):
+        lines = []
+        for label, keep, members, victims in self.buckets:
+            lines.append("%s: %s snapshots, keeping %s" % (label, len(members), min(keep, len(members))))
+            for ts in members:
+                lines.append("  %-6s %s_%s" % ("delete" if ts in victims else "keep", snapshotName, ts))
+        if self.unmanaged:
+            lines.append("older than all time spans: %s snapshots, keeping all" % len(self.unmanaged))
+            for ts in self.unmanaged:
+                lines.append("  %-6s %s_%s" % ("keep", snapshotName, ts))
+        return lines
+
+
+class LocalTransport:
+    """Runs destination commands on the local machine (used with --local)."""
+
+    def __init__(self):
+        self.connections = 0
+        self.commands = 0
+
+    def wrap(self, cmd, tty=True):
+        self.commands += 1
+        return list(cmd)
+
+    def wrapShell(self, cmdString, tty=True):
+        """Returns the argument list that runs the shell command line cmdString on the destination."""
+        return self.wrap(["sh", "-c", cmdString])
+
+    def submit(self, cmds, timeout=None):
+        return None  # No agent, see SshTransport.submit().
+
+    def run(self, cmds, timeout=None):
+        """Runs destination commands concurrently and returns their CommandResults."""
+        return runCommands([self.wrap(cmd) for cmd in cmds], timeout)
+
+    def close(self):
+        logDebug("Local transport: ran %s destination command(s).", self.commands)
+
+
+class SshTransport:
+    """Sends every destination command through one multiplexed SSH connection.
+
+    The first command opens a ControlMaster session with a private ControlPath; all later commands are sent over
+    that socket, so a run costs one SSH handshake instead of one per btrfs call. If the master can't be started,
+    commands fall back to separate ssh processes. The ssh binary can be replaced with a stand-in by setting
+    BYTTERFS_SSH.
+
+    With useAgent, btrfs queries and deletions go to a RemoteAgent started on the first of them instead, batched
+    into one round trip per call of run() or submit().
+    """
+
+    def __init__(self, sshHost, sshPort, sshKey, useAgent=False):
+        self.sshHost = sshHost
+        self.sshPort = sshPort
+        self.sshKey = sshKey
+        self.sshBinary = os.environ.get("BYTTERFS_SSH", "ssh")
+        self.controlDir = None
+        self.controlPath = None
+        self.multiplexed = False
+        self.connections = 0
+        self.commands = 0
+        self.useAgent = useAgent
+        self.agent = None
+        self.agentLock = threading.Lock()
+
+    def baseArgs(self):
+        args = [self.sshBinary, "-i", self.sshKey, "-p", self.sshPort]
+        if self.multiplexed:
+            args += ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % self.controlPath]
+        return args
+
+    def open(self):
+        if self.controlDir is not None:
+            return self.multiplexed
+        self.controlDir = tempfile.mkdtemp(prefix="bytterfs-ssh-")
+        self.controlPath = os.path.join(self.controlDir, "master")
+        # -f backgrounds ssh after authentication, so wait() returns once the master socket is usable. The
+        # backgrounded master keeps its std streams, hence DEVNULL instead of pipes we would block on.
+        p1 = Popen([self.sshBinary, "-i", self.sshKey, "-p", self.sshPort, "-o", "ControlMaster=yes",
+                    "-o", "ControlPath=%s" % self.controlPath, "-o", "ControlPersist=yes", "-f", "-N",
+                    self.sshHost], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        p1.wait()
+        self.connections += 1
+        if p1.returncode != 0:
+            logWarning("Could not open multiplexed SSH connection to %s. Falling back to one connection per "
+                       "command.", self.sshHost)
+            return False
+        self.multiplexed = True
+        logDebug("Opened multiplexed SSH connection to %s (ControlPath %s)", self.sshHost, self.controlPath)
+        return True
+
+    def wrap(self, cmd, tty=True):
+        """Returns the argument list that runs cmd on the destination, in a pty unless tty is False."""
+        self.open()
+        self.commands += 1
+        if not self.multiplexed:
+            self.connections += 1
+        return self.baseArgs() + [self.sshHost] + (["-t"] if tty else []) + list(cmd)
+
+    def wrapShell(self, cmdString, tty=True):
+        """Returns the argument list that runs the shell command line cmdString on the destination."""
+        return self.wrap([cmdString], tty)  # ssh hands its command to the remote shell anyway.
+
+    def submit(self, cmds, timeout=None):
+        """Sends cmds to the remote agent as one batch and returns a function that waits for their CommandResults.
+
+        Returns None if the agent is disabled or can't run one of the commands, so the caller runs them directly.
+        """
+        ops = [agentOp(cmd) for cmd in cmds]
+        if not self.useAgent or None in ops:
+            return None
+        if self.agent is None:
+            self.agent = RemoteAgent(self)
+            if not self.agent.start(timeout):
+                self.stopAgent("could not be started")
+                return None
+        if not self.agent.send(ops):
+            self.stopAgent("stopped")
+            return None
+
+        def results():
+            found = self.agent.receive(cmds, timeout) if self.agent is not None else None
+            if found is None:
+                self.stopAgent("stopped answering")
+                return runCommands([self.wrap(cmd) for cmd in cmds], timeout)
+            return found
+        return results
+
+    def run(self, cmds, timeout=None):
+        """Runs destination commands concurrently, or in one agent round trip, and returns their CommandResults."""
+        with self.agentLock:  # The agent answers one batch at a time, e.g. with a PruneWorker beside a transfer.
+            pending = self.submit(cmds, timeout)
+            if pending is not None:
+                return pending()
+        return runCommands([self.wrap(cmd) for cmd in cmds], timeout)
+
+    def stopAgent(self, reason):
+        if self.agent is not None:
+            logWarning("Remote agent on %s %s. Falling back to one SSH command per query.", self.sshHost, reason)
+            self.agent.close()
+        self.agent = None
+        self.useAgent = False
+
+    def close(self):
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+        if self.controlDir is None:
+            return
+        if self.multiplexed:
+            p1 = Popen([self.sshBinary, "-o", "ControlPath=%s" % self.controlPath, "-O", "exit", self.sshHost],
+                       stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+            out, err = p1.communicate()
+            logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+        shutil.rmtree(self.controlDir, ignore_errors=True)
+        self.controlDir = None
+        self.multiplexed = False
+        logInfo("SSH transport: opened %s connection(s) for %s remote command(s).", self.connections, self.commands)
+
+
+AUTO_COMPRESS_SAMPLE = 4 * 1024 * 1024  # Bytes of the send stream sampled by --compress auto.
+AUTO_COMPRESS_RATIO = 0.9  # Compress only if the sample shrinks below this ratio.
+COMPRESS_CHOICES = ["none", "auto", "zstd", "lz4", "gzip"]
+DELETE_COMMIT_CHOICES = ["none", "after", "each"]  # Wait for no commit, one after each batch or one per snapshot.
+
+
+class Compressor:
+    """Command lines of an external compression tool for the send/receive pipeline."""
+
+    defaultLevels = {"zstd": 3, "lz4": 1, "gzip": 6}
+
+    def __init__(self, name, level=None, threads=None):
+        self.name = name
+        self.level = level if level is not None else self.defaultLevels[name]
+        self.threads = threads
+
+    def compressCmd(self):
+        if self.name == "zstd":
+            return ["zstd", "-q", "-c", "-%s" % self.level, "-T%s" % (self.threads or 0)]
+        if self.name == "lz4":
+            return ["lz4", "-q", "-c", "-%s" % self.level]
+        if self.threads != 1 and shutil.which("pigz"):
+            cmd = ["pigz", "-c", "-%s" % self.level]
+            return cmd + ["-p", str(self.threads)] if self.threads else cmd
+        return ["gzip", "-c", "-%s" % self.level]
+
+    def decompressCmd(self):
+        if self.name == "zstd":
+            return ["zstd", "-q", "-d", "-c"]
+        if self.name == "lz4":
+            return ["lz4", "-q", "-d", "-c"]
+        return ["gzip", "-d", "-c"]
+
+
+def readSample(stream, size):
+    """Reads up to size bytes from stream, fewer only at the end of the stream."""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = os.read(stream.fileno(), min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def chooseCompressor(sample, level=None, threads=None):
+    """Picks the compressor for --compress auto, or None if the sample doesn't compress well."""
+    if not sample:
+        return None
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > AUTO_COMPRESS_RATIO:
+        logInfo("Send stream sample compresses to %.2f of its size. Sending uncompressed.", ratio)
+        return None
+    for name in ("zstd", "lz4", "gzip"):
+        if shutil.which(name):
+            logInfo("Send stream sample compresses to %.2f of its size. Compressing with %s.", ratio, name)
+            return Compressor(name, level, threads)
+    logWarning("No compression tool found. Sending uncompressed.")
+    return None
+
+
+F_SETPIPE_SZ = 1031  # fcntl command from linux/fcntl.h, not exported by the fcntl module before Python 3.10.
+
+
+def writeAll(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def growPipe(fd, size):
+    """Raises the kernel buffer of pipe fd to size bytes where permitted, so every syscall moves more data."""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        pass  # Not a pipe, or above /proc/sys/fs/pipe-max-size.
+
+
+class TransferProgress:
+    """Byte counter of a transfer that logs throughput and writes a JSON status file at a fixed interval."""
+
+    def __init__(self, name, interval=None, statusFile=None):
+        self.name = name
+        self.interval = interval
+        self.statusFile = statusFile
+        self.bytes = 0
+        self.start = time.time()
+        self.lastReport = self.start
+        self.lastBytes = 0
+        self.currentRate = 0.0
+        self.state = "running"
+        self.lock = threading.Lock()
+        self.writeStatus()
+
+    def update(self, count):
+        with self.lock:
+            self.bytes += count
+            now = time.time()
+            if self.interval is None or now - self.lastReport < self.interval:
+                return
+            self.currentRate = (self.bytes - self.lastBytes) / (now - self.lastReport)
+            self.lastReport = now
+            self.lastBytes = self.bytes
+        logInfo("%s: %.1f MB sent, %.1f MB/s now, %.1f MB/s average.", self.name, self.bytes / 1e6,
+                self.currentRate / 1e6, self.averageRate() / 1e6)
+        self.writeStatus()
+
+    def averageRate(self):
+        return self.bytes / max(time.time() - self.start, 0.001)
+
+    def finish(self, returncode):
+        self.state = "done" if returncode == 0 else "failed"
+        self.writeStatus()
+
+    def writeStatus(self):
+        if self.statusFile is None:
+            return
+        status = {"name": self.name, "state": self.state, "pid": os.getpid(), "bytes": self.bytes,
+                  "started": self.start, "updated": time.time(), "elapsed": time.time() - self.start,
+                  "currentBytesPerSecond": self.currentRate, "averageBytesPerSecond": self.averageRate()}
+        tmpFile = "%s.tmp" % self.statusFile
+        try:
+            with open(tmpFile, "w") as f:
+                json.dump(status, f)
+            os.replace(tmpFile, self.statusFile)  # Pollers never see a half written file.
+        except (IOError, OSError) as e:
+            logWarning("Could not write status file %s: %s", self.statusFile, e)
+
+
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def parseRate(string):
+    """Parses a rate like 500K, 10M or 1G (bytes per second, binary units) into bytes per second. 0 is unlimited."""
+    match = re.match(r"^([0-9]+(?:\.[0-9]+)?)([KMG]?)$", string.strip().upper())
+    if match is None:
+        raise ArgumentTypeError("%r is not a rate like 500K, 10M or 1G." % string)
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+def parseBwSchedule(string):
+    """Parses a schedule like mon-fri@08:00-18:00=10M,22:00-06:00=0 into (days, startMinute, endMinute, rate) rules.
+
+    Days are optional (default: every day) and either a single weekday or a range. A time range may cross midnight.
+    The first matching rule wins.
+    """
+    rules = []
+    for element in string.split(","):
+        match = re.match(r"^(?:([a-z]{3})(?:-([a-z]{3}))?@)?([0-9]{1,2}):([0-9]{2})-([0-9]{1,2}):([0-9]{2})=(.+)$",
+                         element.strip().lower())
+        if match is None or (match.group(1) and match.group(1) not in WEEKDAYS) or \
+                (match.group(2) and match.group(2) not in WEEKDAYS):
+            raise ArgumentTypeError("%r is not a schedule rule like mon-fri@08:00-18:00=10M." % element)
+        if match.group(1):
+            first = WEEKDAYS.index(match.group(1))
+            last = WEEKDAYS.index(match.group(2) or match.group(1))
+            days = set(range(first, last + 1)) if first <= last else set(range(first, 7)) | set(range(last + 1))
         else:
-            msg = "%r Only w (for weeks) and m (for months) are accepted syntax." % string
-            raise ArgumentTypeError(msg)
-        if is_number(match.group(3)) is False:
-            msg = "%s Keep Value is not a number." % string
-            raise ArgumentTypeError(msg)
-        daysList.append(days)
-    if sorted(daysList) == daysList:
+            days = set(range(7))
+        rules.append((days, int(match.group(3)) * 60 + int(match.group(4)),
+                      int(match.group(5)) * 60 + int(match.group(6)), parseRate(match.group(7))))
+    return rules
+
+
+def checkRate(string):
+    parseRate(string)
+    return string
+
+
+def checkCompress(string):
+    if string not in COMPRESS_CHOICES:
+        raise ArgumentTypeError("%r is not one of %s" % (string, ", ".join(COMPRESS_CHOICES)))
+    return string
+
+
+def checkDeleteCommit(string):
+    if string not in DELETE_COMMIT_CHOICES:
+        raise ArgumentTypeError("%r is not one of %s" % (string, ", ".join(DELETE_COMMIT_CHOICES)))
+    return string
+
+
+def checkBwSchedule(string):
+    parseBwSchedule(string)
+    return string
+
+
+class RateLimiter:
+    """Token bucket that caps the throughput of a StreamRelay.
+
+    The rate is the first matching rule of the schedule, else the fixed limit; 0 or None means unlimited. It is
+    looked up again every recheckInterval seconds, so a transfer started during business hours speeds up once the
+    schedule allows it.
+    """
+
+    def __init__(self, limit=None, schedule=None, recheckInterval=30):
+        self.limit = parseRate(limit) if limit else 0
+        self.schedule = parseBwSchedule(schedule) if schedule else []
+        self.recheckInterval = recheckInterval
+        self.rate = None
+        self.lastCheck = 0
+        self.tokens = 0.0
+        self.lastRefill = time.time()
+
+    def scheduledRate(self, now):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for days, start, end, rate in self.schedule:
+            if start <= end:
+                if local.tm_wday in days and start <= minute < end:
+                    return rate
+            elif (local.tm_wday in days and minute >= start) or ((local.tm_wday - 1) % 7 in days and minute < end):
+                return rate
+        return self.limit
+
+    def currentRate(self):
+        now = time.time()
+        if self.rate is None or now - self.lastCheck >= self.recheckInterval:
+            rate = self.scheduledRate(now)
+            if rate != self.rate:
+                logInfo("Transfer rate limit: %s", "%.1f MB/s" % (rate / 1e6) if rate else "unlimited")
+            self.rate = rate
+            self.lastCheck = now
+        return self.rate
+
+    def chunkSize(self, bufferSize):
+        """Caps the relay chunk size at a tenth of a second worth of data, so limited transfers stay smooth."""
+        rate = self.currentRate()
+        return max(4096, min(bufferSize, rate // 10)) if rate else bufferSize
+
+    def consume(self, count):
+        rate = self.currentRate()
+        now = time.time()
+        if not rate:
+            self.lastRefill = now
+            return
+        self.tokens = min(float(rate), self.tokens + (now - self.lastRefill) * rate)  # At most 1s of burst.
+        self.lastRefill = now
+        self.tokens -= count
+        if self.tokens < 0:
+            time.sleep(-self.tokens / rate)
+
+
+class StreamRelay(threading.Thread):
+    """Copies src to dst in a thread, counting the bytes. Closes both ends when done.
+
+    The copy uses os.splice between the two pipes, so the data never enters user space, and falls back to
+    read/write where splice isn't available or when observers need to see the data. Observers are called with
+    every chunk; progress (a TransferProgress) is updated with every byte count and limiter (a RateLimiter) throttles
+    the copy.
+    """
+
+    def __init__(self, src, dst, prefix=b"", bufferSize=1024 * 1024, progress=None, observers=(), limiter=None):
+        threading.Thread.__init__(self, name=threading.current_thread().name, daemon=True)
+        self.src = src
+        self.dst = dst
+        self.prefix = prefix
+        self.bufferSize = bufferSize
+        self.progress = progress
+        self.limiter = limiter
+        self.observers = list(observers)
+        self.bytes = 0
+        self.error = None
+
+    def count(self, count):
+        self.bytes += count
+        if self.progress is not None:
+            self.progress.update(count)
+        if self.limiter is not None:
+            self.limiter.consume(count)
+
+    def chunkSize(self):
+        return self.limiter.chunkSize(self.bufferSize) if self.limiter is not None else self.bufferSize
+
+    def copyChunks(self, srcFd, dstFd):
+        while True:
+            chunk = os.read(srcFd, self.chunkSize())
+            if not chunk:
+                return
+            for observer in self.observers:
+                observer(chunk)
+            writeAll(dstFd, chunk)
+            self.count(len(chunk))
+
+    def splice(self, srcFd, dstFd):
+        """Copies with os.splice. Returns False if the kernel refused before any data was moved."""
+        while True:
+            try:
+                count = os.splice(srcFd, dstFd, self.chunkSize())
+            except OSError as e:
+                if e.errno in (errno.EINVAL, errno.ENOSYS) and self.bytes == len(self.prefix):
+                    return False
+                raise
+            if count == 0:
+                return True
+            self.count(count)
+
+    def run(self):
+        try:
+            srcFd = self.src.fileno()
+            dstFd = self.dst.fileno()
+            growPipe(srcFd, self.bufferSize)
+            growPipe(dstFd, self.bufferSize)
+            if self.prefix:
+                for observer in self.observers:
+                    observer(self.prefix)
+                writeAll(dstFd, self.prefix)
+                self.count(len(self.prefix))
+            if self.observers or not hasattr(os, "splice") or not self.splice(srcFd, dstFd):
+                self.copyChunks(srcFd, dstFd)
+        except (IOError, OSError) as e:
+            self.error = e
+            logError("Stream relay failed after %s bytes: %s", self.bytes, e)
+        finally:
+            for stream in (self.dst, self.src):
+                try:
+                    stream.close()
+                except (IOError, OSError):
+                    pass
+
+
+DEFAULT_BUFFER_WATERMARKS = "100:75"
+
+
+def parseWatermarks(string):
+    """Parses "HIGH:LOW" fill levels in percent, e.g. "100:75", into fractions (1.0, 0.75)."""
+    high, sep, low = string.partition(":")
+    try:
+        high, low = int(high), int(low)
+    except ValueError:
+        raise ValueError("invalid watermarks %r, expected HIGH:LOW in percent, e.g. 100:75" % string)
+    if not 0 < low < high <= 100:
+        raise ValueError("invalid watermarks %r, expected 0 < LOW < HIGH <= 100" % string)
+    return high / 100.0, low / 100.0
+
+
+def checkWatermarks(string):
+    try:
+        parseWatermarks(string)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+    return string
+
+
+class StreamBuffer(threading.Thread):
+    """Ring buffer of size bytes between src and dst, so a stall on one side doesn't stop the other (like mbuffer).
+
+    An inner thread reads src into the ring while this thread writes the ring to dst. Reading pauses when the fill
+    reaches the high watermark and resumes once it dropped to the low one, so src is read in long bursts instead
+    of a chunk whenever dst took one. The ring is an anonymous memory map, which takes memory only as it fills, or
+    a map of a temporary file in backingDir. Counts how often and how long each side waited for the other: dst
+    starving means src is the bottleneck, src blocking means dst is. Otherwise used like StreamRelay.
+    """
+
+    def __init__(self, src, dst, size, prefix=b"", bufferSize=1024 * 1024, progress=None, observers=(), limiter=None,
+                 watermarks=DEFAULT_BUFFER_WATERMARKS, backingDir=None):
+        threading.Thread.__init__(self, name=threading.current_thread().name, daemon=True)
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.prefix = prefix
+        self.bufferSize = bufferSize
+        self.progress = progress
+        self.observers = list(observers)
+        self.limiter = limiter
+        high, low = parseWatermarks(watermarks)
+        self.highBytes = int(size * high)
+        self.lowBytes = int(size * low)
+        self.backingDir = backingDir
+        self.condition = threading.Condition()
+        self.head = 0  # Bytes read from src so far; head - tail is the fill.
+        self.tail = 0  # Bytes written to dst so far.
+        self.eof = False
+        self.paused = False
+        self.peak = 0
+        self.srcWaits = 0
+        self.srcWaitTime = 0.0
+        self.dstWaits = 0
+        self.dstWaitTime = 0.0
+        self.bytes = 0
+        self.error = None
+
+    def mapRing(self):
+        import mmap  # Imported here to keep it out of the startup time when buffering is off.
+        if self.backingDir is None:
+            return mmap.mmap(-1, self.size)
+        with tempfile.TemporaryFile(dir=self.backingDir, prefix="bytterfs-buffer-") as f:
+            f.truncate(self.size)
+            return mmap.mmap(f.fileno(), self.size)  # The map keeps the unlinked file alive.
+
+    def fill(self, ring):
+        """Reads src into the ring until its end. Runs in the inner thread."""
+        srcFd = self.src.fileno()
+        growPipe(srcFd, self.bufferSize)
+        try:
+            while True:
+                with self.condition:
+                    if self.head - self.tail >= self.highBytes:
+                        self.paused = True
+                    if self.paused:
+                        self.srcWaits += 1
+                        start = time.monotonic()
+                        while self.head - self.tail > self.lowBytes and self.error is None:
+                            self.condition.wait()
+                        self.srcWaitTime += time.monotonic() - start
+                        self.paused = False
+                    # A read into a full ring would return 0 and look like the end of src.
+                    while self.head - self.tail >= self.size and self.error is None:
+                        self.condition.wait()
+                    if self.error is not None:
+                        return
+                    position = self.head % self.size
+                    count = min(self.size - (self.head - self.tail), self.size - position, self.bufferSize)
+                count = os.readv(srcFd, [ring[position:position + count]])
+                if self.observers and count:
+                    chunk = bytes(ring[position:position + count])  # The ring slot is reused once written out.
+                    for observer in self.observers:
+                        observer(chunk)
+                with self.condition:
+                    self.head += count
+                    self.peak = max(self.peak, self.head - self.tail)
+                    self.condition.notify_all()
+                if count == 0:
+                    return
+        except (IOError, OSError) as e:
+            with self.condition:
+                self.error = self.error or e
+        finally:
+            with self.condition:
+                self.eof = True
+                self.condition.notify_all()
+
+    def drain(self, ring):
+        """Writes the ring to dst until src ended and the ring is empty."""
+        dstFd = self.dst.fileno()
+        growPipe(dstFd, self.bufferSize)
+        if self.prefix:
+            writeAll(dstFd, self.prefix)
+            self.count(len(self.prefix))
+        while True:
+            with self.condition:
+                if self.head == self.tail and not self.eof:
+                    self.dstWaits += 1
+                    start = time.monotonic()
+                    while self.head == self.tail and not self.eof:
+                        self.condition.wait()
+                    self.dstWaitTime += time.monotonic() - start
+                if self.error is not None or self.head == self.tail:
+                    return
+                position = self.tail % self.size
+                limit = self.limiter.chunkSize(self.bufferSize) if self.limiter is not None else self.bufferSize
+                count = min(self.head - self.tail, self.size - position, limit)
+            writeAll(dstFd, ring[position:position + count])
+            with self.condition:
+                self.tail += count
+                self.condition.notify_all()
+            self.count(count)
+
+    def count(self, count):
+        self.bytes += count
+        if self.progress is not None:
+            self.progress.update(count)
+        if self.limiter is not None:
+            self.limiter.consume(count)
+
+    def run(self):
+        mapped = ring = reader = None
+        try:
+            for observer in self.observers:
+                if self.prefix:
+                    observer(self.prefix)
+            mapped = self.mapRing()
+            ring = memoryview(mapped)
+            reader = threading.Thread(target=self.fill, args=(ring,), name=threading.current_thread().name,
+                                      daemon=True)
+            reader.start()
+            self.drain(ring)
+        except (IOError, OSError) as e:
+            with self.condition:
+                self.error = self.error or e
+                self.condition.notify_all()
+        finally:
+            if reader is not None:
+                reader.join()
+            if self.error is not None:
+                logError("Stream buffer failed after %s bytes: %s", self.bytes, self.error)
+            for stream in (self.dst, self.src):
+                try:
+                    stream.close()
+                except (IOError, OSError):
+                    pass
+            if ring is not None:
+                ring.release()
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass  # The traceback of self.error still holds a slice; the map goes away with it.
+        logInfo("Stream buffer of %s MB: peak fill %.0f%%, receive starved %s times for %.1fs, send blocked %s "
+                "times for %.1fs.", self.size // (1024 * 1024), 100.0 * self.peak / self.size, self.dstWaits,
+                self.dstWaitTime, self.srcWaits, self.srcWaitTime)
+
+
+def newStreamHash():
+    """Returns (name, hash object) of the fastest available stream hash: BLAKE3 or XXH3 if installed, else SHA-256.
+
+    hashlib's SHA-256 uses the SHA extensions of current CPUs and outruns its BLAKE2b by a factor of about four there.
+    """
+    try:
+        import blake3
+        return "blake3", blake3.blake3()
+    except ImportError:
         pass
-    else:
-        msg = "%r time spans are unsorted." % string
-        raise ArgumentTypeError(msg)
+    try:
+        import xxhash
+        return "xxh3_128", xxhash.xxh3_128()
+    except ImportError:
+        pass
+    import hashlib
+    return "sha256", hashlib.sha256()
+
+
+class StreamHasher(threading.Thread):
+    """Hashes the chunks passed to update() in its own thread, so the copy it observes only pays for a queue put.
+
+    Pass update as an observer of a StreamRelay, StreamBuffer or StreamFanOut; finish() returns the hex digest.
+    On a single CPU the thread has nothing to overlap with and only adds switches, so update() hashes directly.
+    """
+
+    def __init__(self, maxChunks=64):
+        threading.Thread.__init__(self, name=threading.current_thread().name, daemon=True)
+        self.queue = queue.Queue(maxChunks)
+        self.algorithm, self.hash = newStreamHash()
+        self.bytes = 0
+        self.inline = (os.cpu_count() or 1) < 2
+
+    def update(self, chunk):
+        if self.inline:
+            self.consume(chunk)
+        else:
+            self.queue.put(chunk)
+
+    def consume(self, chunk):
+        self.hash.update(chunk)
+        self.bytes += len(chunk)
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            self.consume(chunk)
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        return self.hash.hexdigest()
+
+
+DEFAULT_MANIFEST_DIR = "~/.bytterfs/manifests/"  # On the destination, relative to the home of the SSH user.
+
+
+def shellPath(path):
+    """Quotes path for the remote shell, keeping a leading ~/ expandable."""
+    if path.startswith("~/"):
+        return '"$HOME"/%s' % shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def manifestDirectory(manifestDir, destContainer):
+    """Directory holding the manifests of the snapshots in destContainer: one per container below manifestDir."""
+    return "%s%s/" % (manifestDir, destContainer.strip("/").replace("/", "_"))
+
+
+def subvolShowUUID(result):
+    """Returns the UUID from the `btrfs subvol show` output in result, or None."""
+    for row in result.stdout.decode("latin-1").splitlines():
+        key, sep, value = row.strip().partition(":")
+        if key == "UUID" and value.strip() not in ("", "-"):
+            return value.strip()
+    return None
+
+
+def verifyManifests(transport, snapshotName, destContainer, manifestDir=DEFAULT_MANIFEST_DIR, timeout=None,
+                    clean=False, manifestContainer=None):
+    """Cross-checks all manifests of destContainer against its snapshots with one listing and one read.
+
+    manifestContainer names the container the manifests were written for if destContainer is a local mount of it.
+
+    Returns a dict of snapshot names: verified (manifest matches the UUIDs on the destination), unverified (no
+    manifest), mismatched (the snapshot's UUID or received UUID differs from its manifest, i.e. it is not what was
+    sent) and orphaned (manifests of snapshots that are gone, removed if clean is set).
+    """
+    inventory = SubvolInventory(
+        destContainer, snapshotName, lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-u", "-R", destContainer],
+        timeout, transport)
+    manifestContainer = manifestContainer or destContainer
+    directory = shellPath(manifestDirectory(manifestDir, manifestContainer))
+    readCmd = transport.wrapShell('for f in %s*.json; do [ -f "$f" ] && cat "$f" && echo; done; true' % directory,
+                                  tty=False)
+    readResult, listResult = runQueries([(None, readCmd, lambda result: result),
+                                         (transport, inventory.listCmd(), lambda result: result)], timeout)
+    if listResult.returncode != 0:
+        raise OSError("listing %s failed: %s" % (destContainer, listResult.stderr.decode("latin-1").strip()))
+    inventory.load(listResult)
+    manifests = {}
+    for line in readResult.stdout.decode("utf-8", "replace").splitlines():
+        try:
+            manifest = json.loads(line)
+        except ValueError:
+            continue  # E.g. a manifest cut short by a full disk.
+        if isinstance(manifest, dict) and manifest.get("snapshot"):
+            manifests[manifest["snapshot"]] = manifest
+    report = {"verified": [], "unverified": [], "mismatched": [], "orphaned": []}
+    for entry in inventory.entries():
+        manifest = manifests.pop(entry["name"], None)
+        if manifest is None:
+            report["unverified"].append(entry["name"])
+        elif manifest.get("destUUID") not in (None, entry["uuid"]) or \
+                manifest.get("sourceUUID") not in (None, entry["receivedUUID"]):
+            report["mismatched"].append(entry["name"])
+            logError("%s%s does not match its manifest: uuid %s, received uuid %s, manifest %s", destContainer,
+                     entry["name"], entry["uuid"], entry["receivedUUID"], manifest)
+        else:
+            report["verified"].append(entry["name"])
+    report["orphaned"] = sorted(manifests)
+    if clean and manifests:
+        directory = manifestDirectory(manifestDir, manifestContainer)
+        paths = [shellPath("%s%s.json" % (directory, name)) for name in report["orphaned"]]
+        runCommand(transport.wrapShell("rm -f %s" % " ".join(paths)), timeout)
+    return report
+
+
+FANOUT_STALL_TIMEOUT = 60  # Seconds a mirror's buffer may stay full before the mirror is dropped.
+DEFAULT_MIRROR_BUFFER = 64 * 1024 * 1024
+
+
+class FanOutSink(threading.Thread):
+    """Feeds one receive process from a bounded queue that StreamFanOut fills, so a slow sink only delays itself.
+
+    The thread carries the name of the thread that created it, so its log lines end up in the same job log.
+    """
+
+    def __init__(self, name, process, queueChunks):
+        threading.Thread.__init__(self, name=threading.current_thread().name, daemon=True)
+        self.sinkName = name
+        self.process = process
+        self.queue = queue.Queue(max(1, queueChunks))
+        self.bytes = 0
+        self.error = None
+        self.dropped = False
+
+    def run(self):
+        fd = self.process.stdin.fileno()
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                continue  # Keep draining, so the fan-out never blocks on a dead sink.
+            try:
+                writeAll(fd, chunk)
+                self.bytes += len(chunk)
+            except (IOError, OSError) as e:
+                self.error = e
+                logError("Sending to %s failed after %s bytes: %s", self.sinkName, self.bytes, e)
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def drop(self, reason):
+        """Gives up on this sink. Killing the receive process makes a blocked write fail, so the queue drains."""
+        self.dropped = True
+        logError("Dropping %s from the transfer after %s bytes: %s", self.sinkName, self.bytes, reason)
+        self.process.kill()
+        self.queue.put(None)
+
+
+class StreamFanOut:
+    """Reads src once and hands every chunk to all FanOutSinks.
+
+    A sink that fails, or whose queue stays full for stallTimeout seconds, is dropped and the others continue.
+    Reading stops only when src ends or no sink is left. progress and limiter work as in StreamRelay.
+    """
+
+    def __init__(self, src, sinks, prefix=b"", bufferSize=1024 * 1024, progress=None, limiter=None,
+                 stallTimeout=FANOUT_STALL_TIMEOUT, observers=()):
+        self.src = src
+        self.sinks = sinks
+        self.prefix = prefix
+        self.bufferSize = bufferSize
+        self.progress = progress
+        self.observers = list(observers)
+        self.limiter = limiter
+        self.stallTimeout = stallTimeout
+        self.bytes = 0
+        self.error = None
+
+    def offer(self, chunk):
+        """Queues chunk for every live sink. Returns False once all sinks are dropped."""
+        for sink in self.sinks:
+            if sink.dropped:
+                continue
+            if sink.error is not None:
+                sink.drop("receive stopped reading")
+                continue
+            try:
+                sink.queue.put(chunk, timeout=self.stallTimeout)
+            except queue.Full:
+                sink.drop("fell more than %s bytes behind for %ss" % (sink.queue.maxsize * self.bufferSize,
+                                                                       self.stallTimeout))
+        return any(not sink.dropped for sink in self.sinks)
+
+    def run(self):
+        for sink in self.sinks:
+            sink.start()
+        try:
+            srcFd = self.src.fileno()
+            growPipe(srcFd, self.bufferSize)
+            chunk = self.prefix
+            while True:
+                if not chunk:
+                    chunk = os.read(srcFd, self.limiter.chunkSize(self.bufferSize) if self.limiter is not None
+                                    else self.bufferSize)
+                if not chunk:
+                    break
+                for observer in self.observers:
+                    observer(chunk)
+                if not self.offer(chunk):
+                    logError("All destinations were dropped. Aborting the transfer.")
+                    break
+                self.bytes += len(chunk)
+                if self.progress is not None:
+                    self.progress.update(len(chunk))
+                if self.limiter is not None:
+                    self.limiter.consume(len(chunk))
+                chunk = b""
+        except (IOError, OSError) as e:
+            self.error = e
+            logError("Stream fan-out failed after %s bytes: %s", self.bytes, e)
+        finally:
+            for sink in self.sinks:
+                if not sink.dropped:
+                    sink.queue.put(None)
+            try:
+                self.src.close()  # Makes the sender fail if we stopped early.
+            except (IOError, OSError):
+                pass
+        for sink in self.sinks:
+            sink.join()
+
+
+DEFAULT_REMOTE_SPOOL = "/var/tmp/bytterfs-spool/"
+DEFAULT_SPOOL_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class SpooledTransfer:
+    """Sends one snapshot as checksummed chunks through a local and a remote spool directory.
+
+    The send stream is cut into chunks in <spool>/<snapshot>/ and listed with their size and sha256 in
+    manifest.json. Chunks are then copied to <remoteSpool>/<snapshot>/ and marked as uploaded once the
+    destination confirmed their checksum, which it computes right after storing each one. Only when every chunk is
+    confirmed, the chunks are concatenated into `btrfs receive` on the destination. Every step records its progress
+    in the manifest, so an interrupted run continues where it stopped: the stream is not regenerated once spooled
+    completely, and confirmed chunks are never copied again.
+    """
+
+    def __init__(self, bytterfs, snapshot, sendCmd=None):
+        self.bytterfs = bytterfs
+        self.snapshot = os.path.basename(os.path.normpath(snapshot))
+        self.sendCmd = sendCmd
+        self.localDir = os.path.join(bytterfs.spoolDir, self.snapshot)
+        self.remoteDir = "%s%s/" % (bytterfs.remoteSpoolDir, self.snapshot)
+        self.manifestPath = os.path.join(self.localDir, "manifest.json")
+        self.manifest = None
+
+    def exists(self):
+        return os.path.isfile(self.manifestPath)
+
+    def loadManifest(self):
+        if self.exists():
+            with open(self.manifestPath) as f:
+                self.manifest = json.load(f)
+            if self.sendCmd is None:
+                self.sendCmd = self.manifest["sendCmd"]
+        else:
+            self.manifest = {"snapshot": self.snapshot, "sendCmd": self.sendCmd,
+                             "chunkSize": self.bytterfs.spoolChunkSize, "complete": False, "chunks": []}
+
+    def saveManifest(self):
+        tmpFile = "%s.tmp" % self.manifestPath
+        with open(tmpFile, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmpFile, self.manifestPath)
+
+    def chunkPath(self, index):
+        return os.path.join(self.localDir, "chunk-%06d" % index)
+
+    def spool(self):
+        """Writes the send stream into chunks, keeping chunks that an earlier run already spooled identically."""
+        chunks = self.manifest["chunks"]
+        chunkSize = self.manifest["chunkSize"]
+        p1 = Popen(self.sendCmd, stdout=PIPE)
+        index = 0
+        import hashlib  # Imported here to keep it out of the startup time when spooling is off.
+        while True:
+            data = readSample(p1.stdout, chunkSize)
+            if not data:
+                break
+            digest = hashlib.sha256(data).hexdigest()
+            if index < len(chunks) and chunks[index]["sha256"] == digest:
+                index += 1
+                continue
+            if index < len(chunks):
+                logWarning("Send stream differs from the spooled one at chunk %s. Respooling from there.", index)
+                del chunks[index:]
+            with open(self.chunkPath(index) + ".part", "wb") as f:
+                f.write(data)
+            os.replace(self.chunkPath(index) + ".part", self.chunkPath(index))
+            chunks.append({"index": index, "size": len(data), "sha256": digest, "uploaded": False})
+            self.saveManifest()
+            index += 1
+        p1.wait()
+        if p1.returncode != 0:
+            logError("btrfs send failed while spooling %s.", self.snapshot)
+            return False
+        del chunks[index:]
+        self.manifest["complete"] = True
+        self.saveManifest()
+        logInfo("Spooled %s in %s chunks (%s bytes).", self.snapshot, len(chunks),
+                sum(chunk["size"] for chunk in chunks))
+        return True
+
+    def upload(self):
+        """Copies every unconfirmed chunk to the destination, which answers with the checksum of what it stored."""
+        chunks = self.manifest["chunks"]
+        progress = TransferProgress(self.snapshot, self.bytterfs.progressInterval, self.bytterfs.statusFile)
+        limiter = RateLimiter(self.bytterfs.bwLimit, self.bytterfs.bwSchedule) \
+            if self.bytterfs.bwLimit or self.bytterfs.bwSchedule else None
+        for chunk in chunks:
+            if chunk["uploaded"]:
+                continue
+            name = os.path.basename(self.chunkPath(chunk["index"]))
+            target = shlex.quote(self.remoteDir + name)
+            p1 = Popen(self.bytterfs.transport.wrapShell(
+                "mkdir -p %s && cat > %s.part && mv %s.part %s && sha256sum %s" % (
+                    shlex.quote(self.remoteDir), target, target, target, target), tty=False), stdin=PIPE, stdout=PIPE)
+            relay = StreamRelay(open(self.chunkPath(chunk["index"]), "rb"), p1.stdin, progress=progress,
+                                limiter=limiter)
+            relay.start()
+            out = p1.stdout.read()
+            p1.wait()
+            relay.join()
+            if p1.returncode != 0 or relay.error is not None:
+                logError("Uploading spool chunk %s failed: %s", name, out)
+                progress.finish(1)
+                self.saveManifest()
+                return False
+            chunk["uploaded"] = out.decode("latin-1").split()[:1] == [chunk["sha256"]]
+            if not chunk["uploaded"]:
+                logError("Spool chunk %s arrived corrupted on the destination. It is resent next run.", name)
+            self.saveManifest()
+        progress.finish(0 if all(chunk["uploaded"] for chunk in chunks) else 1)
+        return all(chunk["uploaded"] for chunk in chunks)
+
+    def receive(self):
+        if self.snapshot in self.bytterfs.destSubvolNames():
+            logWarning("Deleting %s on the destination, left over by an interrupted receive.", self.snapshot)
+            self.bytterfs.destDeleteSubvol(self.snapshot)
+        chunkNames = " ".join(shlex.quote(os.path.basename(self.chunkPath(chunk["index"])))
+                              for chunk in self.manifest["chunks"])
+        result = runCommand(self.bytterfs.transport.wrapShell(
+            "cd %s && cat %s | sudo btrfs receive %s && cd / && rm -rf %s" % (
+                shlex.quote(self.remoteDir), chunkNames, shlex.quote(self.bytterfs.destContainer),
+                shlex.quote(self.remoteDir))))  # No timeout, this is the transfer.
+        return result.stdout, result.stderr, result.returncode
+
+    def run(self):
+        """Spools, uploads and receives the snapshot, resuming what an earlier run left. Returns out, err, code."""
+        mkdir_p(self.localDir)
+        self.loadManifest()
+        if not self.manifest["complete"]:
+            if not self.spool():
+                return b"", b"spooling failed", 1
+        else:
+            logInfo("Found completely spooled stream of %s. Skipping btrfs send.", self.snapshot)
+        if not self.upload():
+            return b"", b"uploading spool chunks failed", 1
+        out, err, returncode = self.receive()
+        if returncode == 0:
+            self.bytterfs.sentBytes = sum(chunk["size"] for chunk in self.manifest["chunks"])
+            shutil.rmtree(self.localDir, ignore_errors=True)
+        return out, err, returncode
+
+
+DEFAULT_ARCHIVE_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_ARCHIVE_WRITERS = 4
+DEFAULT_ARCHIVE_FULL_EVERY = 30  # Incrementals per chain before an archive starts a new chain with a full send.
+
+
+class ArchiveStore:
+    """Send streams stored as content-addressed chunk files in a plain directory, for destinations without btrfs.
+
+    A stream is cut into fixed-size chunks, each stored once as chunks/<xx>/<sha256>, so chunks repeated within or
+    across streams take no extra space. index/<snapshot>.json lists the chunks of a stream with its source UUID and
+    parent; it is written last, so a stream without index is incomplete and its chunks are reused by the next run or
+    removed by collectGarbage(). A chain is a full stream with all incrementals that (transitively) have it as
+    parent; it can only be restored and deleted as a whole.
+
+    Several jobs may share the directory, and with job set, streams(), chains() and plan() only see the streams of
+    snapshots named <job>_<ts>. Writers hold a shared flock on <directory>/lock from the first chunk until their
+    index is committed, and collectGarbage() takes it exclusively, so it never removes chunks of a stream in flight.
+    """
+
+    def __init__(self, directory, chunkSize=None, writers=None, job=None):
+        self.directory = directory
+        self.chunkSize = chunkSize or DEFAULT_ARCHIVE_CHUNK_SIZE
+        self.writers = max(1, writers or DEFAULT_ARCHIVE_WRITERS)
+        self.job = job
+        self.chunkDir = os.path.join(directory, "chunks")
+        self.indexDir = os.path.join(directory, "index")
+
+    @contextlib.contextmanager
+    def lock(self, operation=fcntl.LOCK_SH):
+        """Holds the flock on the store, shared for writing a stream and exclusive for collecting garbage."""
+        mkdir_p(self.directory)
+        with open(os.path.join(self.directory, "lock"), "a") as f:
+            fcntl.flock(f, operation)
+            yield
+
+    def chunkPath(self, digest):
+        return os.path.join(self.chunkDir, digest[:2], digest)
+
+    def indexPath(self, snapshot):
+        return os.path.join(self.indexDir, "%s.json" % snapshot)
+
+    def streams(self, allJobs=False):
+        """Returns the index entries of the complete streams of the job, or of all jobs, oldest first."""
+        entries = []
+        for name in os.listdir(self.indexDir) if os.path.isdir(self.indexDir) else []:
+            if not name.endswith(".json"):
+                continue
+            if self.job is not None and not allJobs and name[:-len(".json")].rpartition("_")[0] != self.job:
+                continue
+            try:
+                with open(os.path.join(self.indexDir, name)) as f:
+                    entries.append(json.load(f))
+            except (IOError, OSError, ValueError) as e:
+                logWarning("Ignoring unreadable archive index %s: %s", name, e)
+        return sorted(entries, key=lambda entry: entry["ts"])
+
+    def chains(self, entries=None):
+        """Returns the chains as lists of index entries, oldest stream first, ordered by their full stream."""
+        entries = self.streams() if entries is None else entries
+        byName = dict((entry["snapshot"], entry) for entry in entries)
+        chains = {}
+        for entry in entries:
+            root = entry
+            seen = set([root["snapshot"]])
+            while root["parent"] is not None and root["parent"] in byName and root["parent"] not in seen:
+                root = byName[root["parent"]]
+                seen.add(root["snapshot"])
+            if root["parent"] is not None:
+                logWarning("Parent %s of %s is missing in the archive. Its chain can't be restored.", root["parent"],
+                           root["snapshot"])
+            chains.setdefault(root["snapshot"], []).append(entry)
+        return list(chains.values())
+
+    def chainOf(self, snapshot):
+        """Returns the streams to receive in order to restore snapshot: its full stream, then the incrementals."""
+        byName = dict((entry["snapshot"], entry) for entry in self.streams())
+        chain = []
+        name = snapshot
+        while name is not None:
+            if name not in byName or byName[name] in chain:
+                raise OSError("%s is not in the archive %s" % (name, self.directory))
+            chain.append(byName[name])
+            name = byName[name]["parent"]
+        return chain[::-1]
+
+    def write(self, stream, entry, progress=None):
+        """Stores the chunks of the stream read from the file object stream. commit() the returned entry to add it.
+
+        The calling thread reads and cuts the stream while writer threads hash and store the chunks, so hashing and
+        disk writes overlap with btrfs send. Returns the completed entry, or None if a chunk could not be written.
+        Call it and commit() within lock(), so collectGarbage() doesn't remove the chunks in between.
+        """
+        import hashlib  # Imported here to keep it out of the startup time when no archive is used.
+        pending = queue.Queue(self.writers * 2)
+        digests = {}
+        stats = {"new": 0, "written": 0}
+        errors = []
+        lock = threading.Lock()
+
+        def writer():
+            while True:
+                job = pending.get()
+                if job is None:
+                    return
+                index, data = job
+                digest = hashlib.sha256(data).hexdigest()
+                digests[index] = (digest, len(data))
+                path = self.chunkPath(digest)
+                if errors or os.path.exists(path):
+                    continue
+                try:
+                    mkdir_p(os.path.dirname(path))
+                    tmpFile = "%s.%s.part" % (path, threading.get_ident())
+                    with open(tmpFile, "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmpFile, path)
+                    with lock:
+                        stats["new"] += 1
+                        stats["written"] += len(data)
+                except (IOError, OSError) as e:
+                    errors.append(e)
+                    logError("Writing archive chunk %s failed: %s", digest, e)
+
+        threads = [threading.Thread(target=writer, name=threading.current_thread().name, daemon=True)
+                   for i in range(self.writers)]
+        for thread in threads:
+            thread.start()
+        count = 0
+        try:
+            while not errors:
+                data = readSample(stream, self.chunkSize)
+                if not data:
+                    break
+                pending.put((count, data))
+                count += 1
+                if progress is not None:
+                    progress.update(len(data))
+        finally:
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            return None
+        entry = dict(entry, chunkSize=self.chunkSize, chunks=[digests[index] for index in range(count)],
+                     bytes=sum(digests[index][1] for index in range(count)), created=int(time.time()))
+        logInfo("Archived %s: %s bytes in %s chunks, %s of them new (%s bytes written).", entry["snapshot"],
+                entry["bytes"], count, stats["new"], stats["written"])
+        return entry
+
+    def commit(self, entry):
+        """Makes a written stream part of the archive by storing its index entry."""
+        mkdir_p(self.indexDir)
+        tmpFile = "%s.tmp" % self.indexPath(entry["snapshot"])
+        with open(tmpFile, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFile, self.indexPath(entry["snapshot"]))
+
+    def read(self, entry):
+        """Yields the chunks of a stream, checking each against its digest."""
+        import hashlib
+        for digest, size in entry["chunks"]:
+            with open(self.chunkPath(digest), "rb") as f:
+                data = f.read()
+            if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+                raise OSError("archive chunk %s of %s is corrupted" % (digest, entry["snapshot"]))
+            yield data
+
+    def plan(self, retention, now=None):
+        """Returns (chains to keep, chains to delete) under the RetentionPolicy retention.
+
+        A chain is kept if the policy keeps any of its snapshots; the newest chain is always kept, it holds the
+        parent of the next incremental.
+        """
+        chains = self.chains()
+        plan = retention.plan([entry["ts"] for chain in chains for entry in chain], now)
+        keep = set(plan.keep)
+        kept, deleted = [], []
+        for position, chain in enumerate(chains):
+            if position == len(chains) - 1 or any(int(entry["ts"]) in keep for entry in chain):
+                kept.append(chain)
+            else:
+                deleted.append(chain)
+        return kept, deleted
+
+    def delete(self, chain):
+        for entry in reversed(chain):  # Incrementals first, so an interruption never leaves orphaned children.
+            os.remove(self.indexPath(entry["snapshot"]))
+        logWarning("Deleted archive chain %s (%s streams).", chain[0]["snapshot"], len(chain))
+
+    def collectGarbage(self):
+        """Removes chunks no stream of any job references anymore, and leftovers of interrupted writes.
+
+        Waits for running writers of all jobs to commit. Returns the bytes freed.
+        """
+        freed = 0
+        with self.lock(fcntl.LOCK_EX):
+            referenced = set(digest for entry in self.streams(allJobs=True) for digest, size in entry["chunks"])
+            for directory, dirs, files in os.walk(self.chunkDir):
+                for name in files:
+                    if name in referenced:
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                    except OSError as e:
+                        logWarning("Could not remove archive chunk %s: %s", path, e)
+        if freed:
+            logInfo("Removed %s bytes of unreferenced archive chunks.", freed)
+        return freed
+
+
+DEFAULT_COMMAND_TIMEOUT = 900  # Seconds a query or deletion may take before it is killed.
+
+
+class CommandResult:
+    """Outcome of one command: returncode, stdout and stderr as bytes, duration in seconds and whether it timed out.
+
+    data is the full response if a RemoteAgent ran the command, e.g. with the parsed fields of `subvol show`.
+    """
+
+    def __init__(self, cmd, returncode, stdout, stderr, duration, timedOut=False, data=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timedOut = timedOut
+        self.data = data
+
+
+async def runCommandAsync(cmd, timeout=None):
+    import asyncio  # Imported here to keep it out of the startup time.
+    start = time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        return CommandResult(cmd, 127, b"", str(e).encode("utf-8"), time.monotonic() - start)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        stdout, stderr = await process.communicate()
+        logError("Killed after %ss: %s", timeout, " ".join(cmd))
+        return CommandResult(cmd, process.returncode, stdout, stderr, time.monotonic() - start, timedOut=True)
+    return CommandResult(cmd, process.returncode, stdout, stderr, time.monotonic() - start)
+
+
+def runCommands(cmds, timeout=None):
+    """Runs the commands concurrently and returns their CommandResults in the same order.
+
+    Independent queries cost the time of the slowest one instead of the sum of all of them.
+    """
+    import asyncio
+
+    async def gather():
+        return await asyncio.gather(*[runCommandAsync(cmd, timeout) for cmd in cmds])
+    start = time.monotonic()
+    results = asyncio.run(gather())
+    if len(cmds) > 1 and logger.isEnabledFor(logging.DEBUG):
+        logDebug("Ran %s commands concurrently in %.3fs, the slowest took %.3fs", len(cmds),
+                 time.monotonic() - start, max(result.duration for result in results))
+    for result in results:
+        logDebug("%s: returncode %s in %.3fs", " ".join(result.cmd), result.returncode, result.duration)
+    return results
+
+
+def runCommand(cmd, timeout=None):
+    return runCommands([cmd], timeout)[0]
+
+
+AGENT_VERSION = 2
+# Destination-side helper run by RemoteAgent. Sent as source to the remote python3, so nothing is installed there.
+# Frames are a 4 byte big endian length and a JSON payload, a batch of requests or their responses. Only the listed
+# btrfs operations on absolute paths run, each through `sudo -n`.
+AGENT_SOURCE = r"""
+import json, os, struct, subprocess, sys, time
+
+AGENT_VERSION = %s
+LIST_FLAGS = {"-o", "-u", "-R", "-q", "-p", "-a", "-c", "-g", "-r", "-s"}
+DELETE_FLAGS = {"-c", "-C", "--commit-after", "--commit-each"}
+
+
+def readExact(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def readFrame(stream):
+    header = readExact(stream, 4)
+    return None if header is None else readExact(stream, struct.unpack(">I", header)[0])
+
+
+def writeFrame(stream, payload):
+    stream.write(struct.pack(">I", len(payload)) + payload)
+    stream.flush()
+
+
+def checked(request, flags, allowed, paths):
+    for flag in flags:
+        if flag not in allowed:
+            raise ValueError("option %%s is not allowed for %%s" %% (flag, request["op"]))
+    for path in paths:
+        if not path.startswith("/"):
+            raise ValueError("path %%s is not absolute" %% path)
+
+
+def run(cmd, stdin=subprocess.DEVNULL):
+    start = time.time()
+    p = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return {"returncode": p.returncode, "stdout": out.decode("latin-1"), "stderr": err.decode("latin-1"),
+            "duration": time.time() - start}
+
+
+def opList(request, stream):
+    checked(request, request["flags"], LIST_FLAGS, [request["path"]])
+    return run(["sudo", "-n", "btrfs", "subvol", "list"] + request["flags"] + [request["path"]])
+
+
+def opShow(request, stream):
+    checked(request, [], (), [request["path"]])
+    result = run(["sudo", "-n", "btrfs", "subvol", "show", request["path"]])
+    rows = [row.partition(":") for row in result["stdout"].splitlines()]
+    result["fields"] = dict((key.strip(), value.strip()) for key, sep, value in rows if sep and value.strip())
+    return result
+
+
+def opDelete(request, stream):
+    checked(request, request["flags"], DELETE_FLAGS, request["paths"])
+    return run(["sudo", "-n", "btrfs", "subvol", "delete"] + request["flags"] + request["paths"])
+
+
+def opFree(request, stream):
+    checked(request, [], (), [request["path"]])
+    stat = os.statvfs(request["path"])
+    return {"returncode": 0, "stdout": "", "stderr": "", "duration": 0, "total": stat.f_blocks * stat.f_frsize,
+            "free": stat.f_bfree * stat.f_frsize, "available": stat.f_bavail * stat.f_frsize}
+
+
+OPS = {"list": opList, "show": opShow, "delete": opDelete, "free": opFree}
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    writeFrame(stdout, json.dumps({"agent": AGENT_VERSION, "pid": os.getpid()}).encode("utf-8"))
+    while True:
+        frame = readFrame(stdin)
+        if frame is None:
+            return
+        results = []
+        for request in json.loads(frame.decode("utf-8"))["ops"]:
+            try:
+                results.append(OPS[request["op"]](request, stdin))
+            except Exception as e:
+                results.append({"returncode": 1, "stdout": "", "stderr": "bytterfs agent: %%r" %% e, "duration": 0})
+        writeFrame(stdout, json.dumps({"results": results}).encode("utf-8"))
+
+
+main()
+""" % AGENT_VERSION
+
+
+def agentOp(cmd):
+    """Returns the RemoteAgent operation for a destination `sudo btrfs subvol ...` command, or None."""
+    if cmd[:2] != ["sudo", "btrfs"] or len(cmd) < 5 or cmd[2] not in ("subvol", "sub", "subvolume"):
+        return None
+    action = cmd[3]
+    flags = [arg for arg in cmd[4:] if arg.startswith("-")]
+    paths = [arg for arg in cmd[4:] if not arg.startswith("-")]
+    if action == "list" and len(paths) == 1:
+        return {"op": "list", "flags": flags, "path": paths[0]}
+    if action == "show" and len(paths) == 1 and not flags:
+        return {"op": "show", "path": paths[0]}
+    if action == "delete" and paths:
+        return {"op": "delete", "flags": flags, "paths": paths}
+    return None
+
+
+class RemoteAgent:
+    """Client of the destination-side helper in AGENT_SOURCE, started once over the transport and kept open.
+
+    The helper runs without a pty, so its output carries no carriage returns, and answers a whole batch of
+    operations (list, show, delete, free) with one frame. roundTrips counts the batches sent. It runs as
+    the SSH user and calls `sudo -n btrfs ...` for every operation, so it needs no more sudo rights than the
+    commands it replaces.
+    """
+
+    def __init__(self, transport, python="python3"):
+        self.transport = transport
+        self.python = python
+        self.process = None
+        self.roundTrips = 0
+
+    def start(self, timeout=None):
+        source = AGENT_SOURCE.encode("utf-8")
+        bootstrap = "import sys; exec(sys.stdin.buffer.read(%s))" % len(source)
+        self.process = Popen(self.transport.wrapShell("%s -c %s" % (self.python, shlex.quote(bootstrap)), tty=False),
+                             stdin=PIPE, stdout=PIPE, bufsize=0)
+        if not self.writeAll(source):
+            return False
+        hello = self.readFrame(timeout)
+        if hello is None or json.loads(hello.decode("utf-8")).get("agent") != AGENT_VERSION:
+            return False
+        logDebug("Started remote agent: %s", hello)
+        return True
+
+    def writeAll(self, data):
+        try:
+            writeAll(self.process.stdin.fileno(), data)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def writeFrame(self, payload):
+        return self.writeAll(struct.pack(">I", len(payload)) + payload)
+
+    def readExact(self, size, deadline):
+        import select
+        fd = self.process.stdout.fileno()
+        data = bytearray()
+        while len(data) < size:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    logError("Remote agent did not answer within the command timeout.")
+                    return None
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def readFrame(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout else None
+        header = self.readExact(4, deadline)
+        return None if header is None else self.readExact(struct.unpack(">I", header)[0], deadline)
+
+    def send(self, ops):
+        self.roundTrips += 1
+        return self.writeFrame(json.dumps({"ops": ops}).encode("utf-8"))
+
+    def receive(self, cmds, timeout=None):
+        """Waits for the answer to the last send() of cmds. Returns their CommandResults, or None if the agent died."""
+        frame = self.readFrame(timeout)
+        if frame is None:
+            return None
+        return [CommandResult(cmd, result["returncode"], result["stdout"].encode("latin-1"),
+                              result["stderr"].encode("latin-1"), result["duration"], data=result)
+                for cmd, result in zip(cmds, json.loads(frame.decode("utf-8"))["results"])]
+
+    def call(self, ops, timeout=None):
+        """Runs ops in one round trip and returns their raw result dicts, or None if the agent died."""
+        if not self.send(ops):
+            return None
+        results = self.receive([["agent", op["op"]] for op in ops], timeout)
+        return None if results is None else [result.data for result in results]
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()  # The agent exits at the end of its input.
+            self.process.wait(10)
+        except (IOError, OSError):
+            pass
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        logDebug("Remote agent answered %s batch(es).", self.roundTrips)
+        self.process = None
+
+
+def runQueries(queries, timeout=None):
+    """Runs independent queries concurrently, hands every result to its consumer and returns what they return.
+
+    queries is a list of (transport, cmd, consumer) triples, with transport None for commands on the client.
+    Batches for remote agents are sent first, so their round trip overlaps the other commands. Consumers are
+    called in list order, so checks that should win over later errors come first.
+    """
+    results = [None] * len(queries)
+    byTransport = defaultdict(list)
+    for index, (transport, cmd, consumer) in enumerate(queries):
+        if transport is not None:
+            byTransport[transport].append(index)
+    pending = []
+    for transport, indices in byTransport.items():
+        wait = transport.submit([queries[index][1] for index in indices], timeout)
+        if wait is not None:
+            pending.append((indices, wait))
+    submitted = set(index for indices, wait in pending for index in indices)
+    direct = [index for index in range(len(queries)) if index not in submitted]
+    if direct:
+        cmds = [queries[index][1] if queries[index][0] is None else queries[index][0].wrap(queries[index][1])
+                for index in direct]
+        for index, result in zip(direct, runCommands(cmds, timeout)):
+            results[index] = result
+    for indices, wait in pending:
+        for index, result in zip(indices, wait()):
+            results[index] = result
+    return [consumer(result) for (transport, cmd, consumer), result in zip(queries, results)]
+
+
+def subvolListUUID(value):
+    return None if value == "-" else value
+
+
+# `btrfs subvol list` column -> SubvolRecord attribute and conversion. "top level" and otime are handled apart.
+SUBVOL_LIST_COLUMNS = {"ID": ("id", int), "gen": ("gen", int), "parent": ("parent", int),
+                       "uuid": ("uuid", subvolListUUID), "parent_uuid": ("parentUUID", subvolListUUID),
+                       "received_uuid": ("receivedUUID", subvolListUUID)}
+
+
+class SubvolRecord:
+    """One row of `btrfs subvol list`. Columns the listing was not asked for (e.g. -u, -q, -R) are None.
+
+    parent is the parent subvolume ID of -p, or else the top level ID.
+    """
+    __slots__ = ("id", "gen", "parent", "uuid", "parentUUID", "receivedUUID", "path")
+
+    def __init__(self, path):
+        self.path = path
+        self.id = self.gen = self.parent = self.uuid = self.parentUUID = self.receivedUUID = None
+
+    @classmethod
+    def parse(cls, head, path):
+        """Reads the columns before ' path ' as key/value pairs, so their set and widths don't matter."""
+        record = cls(path)
+        tokens = head.split()
+        index = 0
+        while index < len(tokens) - 1:
+            key = tokens[index]
+            if key == "top" and tokens[index + 1] == "level":
+                if record.parent is None and index + 2 < len(tokens):
+                    record.parent = int(tokens[index + 2])
+                index += 3
+            elif key == "otime":
+                index += 3  # Date and time.
+            else:
+                column = SUBVOL_LIST_COLUMNS.get(key)
+                if column is not None:
+                    setattr(record, column[0], column[1](tokens[index + 1]))
+                index += 2
+        return record
+
+    @property
+    def name(self):
+        return self.path.rpartition("/")[2]
+
+    def __repr__(self):
+        return "SubvolRecord(id=%s, path=%r)" % (self.id, self.path)
+
+
+def iterSubvolList(lines, prefix=None, pattern=None, name=None):
+    """Parses `btrfs subvol list` output line by line and yields a SubvolRecord for every matching row.
+
+    lines is any iterable of bytes or str lines, e.g. the stdout pipe of the listing. prefix keeps only the path
+    itself and paths below it, pattern (a regex, compiled or not) only rows whose name fully matches. Both filters
+    look at the path alone, so skipped rows cost no column parsing. name, e.g. the snapshot name with its "_", drops
+    every row that doesn't contain it before the row is even decoded; the other filters still decide on the rest.
+    The <FS_TREE>/ of -a is stripped.
+    """
+    if prefix is not None:
+        prefix = prefix.strip("/")
+        below = prefix + "/"
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    nameBytes = name.encode("latin-1") if name is not None else None
+    for line in lines:
+        if isinstance(line, bytes):
+            if nameBytes is not None and nameBytes not in line:
+                continue
+            line = line.decode("latin-1")
+        elif name is not None and name not in line:
+            continue
+        head, sep, path = line.partition(" path ")
+        if not sep:
+            continue
+        path = path.rstrip("\r\n")  # ssh -t appends \r to every line
+        if path.startswith("<FS_TREE>/"):
+            path = path[len("<FS_TREE>/"):]
+        if prefix is not None and path != prefix and not path.startswith(below):
+            continue
+        if pattern is not None and not pattern.fullmatch(path.rpartition("/")[2]):
+            continue
+        yield SubvolRecord.parse(head, path)
+
+
+class SubvolInventory:
+    """Snapshots of one container, listed once per run and served from indexed dicts.
+
+    listCmd is a callable returning the `btrfs subvol list` command, so the container path may still change before
+    the first lookup. It runs through transport, or locally if transport is None. Callers keep the inventory current
+    with add()/remove() after creating or deleting snapshots and invalidate() after a receive. listings counts how
+    many listings were actually run, seconds how long the ones run by load() itself took. A failed listing ends the
+    run, unless the inventory is not required and is left empty instead.
+    """
+
+    def __init__(self, label, snapshotName, listCmd, timeout=None, transport=None, required=True):
+        self.label = label
+        self.required = required
+        self.snapshotName = snapshotName
+        self.listCmd = listCmd
+        self.timeout = timeout
+        self.transport = transport
+        self.namePattern = re.compile(r"%s_\d+" % re.escape(snapshotName))
+        self.listings = 0
+        self.seconds = 0.0
+        self.loaded = False
+        self.byName = {}
+        self.byTs = {}
+        self.byUUID = {}
+        self.byReceivedUUID = {}
+
+    def load(self, result=None):
+        """Lists the container, or takes the listing from result if it already ran, e.g. in Bytterfs.prefetch().
+
+        A listing run here is parsed from the pipe while it arrives, see stream(), unless the remote agent runs it.
+        """
+        start = time.time() if result is None else None
+        if result is None and getattr(self.transport, "useAgent", False):
+            result = self.transport.run([self.listCmd()], self.timeout)[0]
+        if result is None:
+            records, result = self.stream()
+        else:
+            records = self.parse(result.stdout.splitlines())
+        err = result.stderr
+        self.listings += 1
+        logDebug("%s listing: %s matching rows \nsubprocess error: %s", self.label, len(records), err)
+        if result.returncode != 0 and not self.required:
+            logWarning("Could not list %s subvolumes: %s", self.label, err.decode("utf-8", "replace").strip())
+            records = []
+        elif result.returncode != 0:
+            logError("Subprocess returncode != 0 when listing %s subvolumes. Exiting Backup.", self.label)
+            sendmail("error", "Bytterfs", "Subprocess returncode != 0 when listing %s subvolumes. Exiting Backup"
+                     % self.label)
+            exit(0)
+        self.byName.clear()
+        self.byTs.clear()
+        self.byUUID.clear()
+        self.byReceivedUUID.clear()
+        for record in records:
+            self.add(record.path, record.uuid, record.receivedUUID, record.gen)
+        self.loaded = True
+        if start is not None:
+            self.seconds += time.time() - start
+        logDebug("%s inventory: %s snapshots (listing #%s)", self.label, len(self.byName), self.listings)
+
+    def parse(self, lines):
+        return list(iterSubvolList(lines, pattern=self.namePattern, name="%s_" % self.snapshotName))
+
+    def stream(self):
+        """Runs the listing and parses its rows straight from the pipe, so the whole output is never held in memory.
+        Returns the records and a CommandResult without stdout."""
+        cmd = self.listCmd()
+        if self.transport is not None:
+            cmd = self.transport.wrap(cmd, tty=False)
+        start = time.monotonic()
+        with tempfile.TemporaryFile() as err:
+            p1 = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=err)
+            timer = threading.Timer(self.timeout, p1.kill) if self.timeout else None
+            if timer is not None:
+                timer.start()
+            try:
+                records = self.parse(p1.stdout)
+                p1.stdout.close()
+                p1.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            err.seek(0)
+            result = CommandResult(cmd, p1.returncode, b"", err.read(), time.monotonic() - start,
+                                   timedOut=p1.returncode == -9)
+        if result.timedOut:
+            logError("Killed after %ss: %s", self.timeout, " ".join(cmd))
+        return records, result
+
+    def ensureLoaded(self):
+        if not self.loaded:
+            self.load()
+
+    def invalidate(self):
+        self.loaded = False
+
+    def add(self, path, uuid=None, receivedUUID=None, gen=None):
+        name = os.path.basename(os.path.normpath(path))
+        prefix, sep, ts = name.rpartition("_")
+        if prefix != self.snapshotName or not ts.isdigit():
+            return  # Not one of our snapshots.
+        entry = {"name": name, "path": path, "ts": ts, "uuid": uuid, "receivedUUID": receivedUUID, "gen": gen}
+        self.remove(name)
+        self.byName[name] = entry
+        self.byTs[ts] = entry
+        if uuid and uuid != "-":
+            self.byUUID[uuid] = entry
+        if receivedUUID and receivedUUID != "-":
+            self.byReceivedUUID[receivedUUID] = entry
+
+    def remove(self, name):
+        entry = self.byName.pop(os.path.basename(os.path.normpath(name)), None)
+        if entry is None:
+            return
+        self.byTs.pop(entry["ts"], None)
+        self.byUUID.pop(entry["uuid"], None)
+        self.byReceivedUUID.pop(entry["receivedUUID"], None)
+
+    def entries(self):
+        """Returns all snapshot entries, oldest first."""
+        self.ensureLoaded()
+        return sorted(self.byName.values(), key=lambda entry: int(entry["ts"]))
+
+    def timestamps(self):
+        return [entry["ts"] for entry in self.entries()]
+
+    def newest(self):
+        entries = self.entries()
+        return entries[-1] if entries else None
+
+    def find(self, name):
+        self.ensureLoaded()
+        return self.byName.get(os.path.basename(os.path.normpath(name)))
+
+    def findTs(self, ts):
+        self.ensureLoaded()
+        return self.byTs.get(str(ts))
+
+    def findUUID(self, uuid):
+        self.ensureLoaded()
+        return self.byUUID.get(uuid)
+
+    def findReceivedUUID(self, uuid):
+        self.ensureLoaded()
+        return self.byReceivedUUID.get(uuid)
+
+
+def parseMirror(string):
+    """Splits a mirror spec user@host:port:sshKey:destRootSubvol:destContainer into its five fields."""
+    fields = string.split(":")
+    if len(fields) != 5 or not fields[1].isdigit() or not all(fields):
+        raise ArgumentTypeError("%r is not a mirror of the form user@host:port:sshKey:destRootSubvol:destContainer"
+                                % string)
+    checkPath(fields[3])
+    checkPath(fields[4])
+    return tuple(fields)
+
+
+def checkMirror(string):
+    parseMirror(string)
+    return string
+
+
+def checkMirrors(string):
+    """Config file variant of checkMirror: one or more mirror specs separated by whitespace or newlines."""
+    return [checkMirror(spec) for spec in string.split()]
+
+
+def parseCloneSource(string):
+    """Splits a clone source spec snapshotName:source:destContainer of a sibling job into its three fields."""
+    fields = string.split(":")
+    if len(fields) != 3 or not all(fields):
+        raise ArgumentTypeError("%r is not a clone source of the form snapshotName:source:destContainer" % string)
+    checkPath(fields[1])
+    checkPath(fields[2])
+    return tuple(fields)
+
+
+def checkCloneSource(string):
+    parseCloneSource(string)
+    return string
+
+
+def checkCloneSources(string):
+    """Config file variant of checkCloneSource: one or more specs separated by whitespace or newlines."""
+    return [checkCloneSource(spec) for spec in string.split()]
+
+
+def hasContainer(result, destRootSubvol, destContainer):
+    """Tells if the `btrfs subvol list -o destRootSubvol` in result lists destContainer."""
+    strippedContainer = destContainer.replace(destRootSubvol, "").strip("/")
+    lines = result.stdout.decode("utf-8", "replace").splitlines()
+    return any(record.path == strippedContainer or record.path.endswith("/" + strippedContainer)
+               for record in iterSubvolList(lines))
+
+
+DEFAULT_STATE_DIR = "/var/lib/bytterfs/"
+THROUGHPUT_SAMPLES = 20  # Transfers remembered per job to predict the next one.
+MIN_THROUGHPUT_SAMPLE = 16 * 1024 * 1024  # Smaller transfers mostly measure latency, not throughput.
+MAX_DEFERRALS = 3  # Runs in a row --oversize defer may skip before an oversized send goes ahead anyway.
+
+
+def parseOversize(string):
+    """Parses the --oversize action: "run", "defer" or "throttle:RATE". Returns (action, bytes per second)."""
+    action, sep, rate = string.partition(":")
+    if action in ("run", "defer") and not sep:
+        return action, None
+    if action == "throttle" and rate:
+        return action, parseRate(rate)
+    raise ArgumentTypeError("%r is not run, defer or throttle:RATE, e.g. throttle:10M" % string)
+
+
+def checkOversize(string):
+    parseOversize(string)
     return string
 
-def touch(fname, times=None):
-    with open(fname, 'a'):
-        os.utime(fname, times)
+
+def checkDuration(string):
+    return parseInterval(string)
+
+
+def findNewBytes(lines):
+    """Sums the extent lengths in `btrfs subvol find-new` output: the data written since the given generation."""
+    total = 0
+    for line in lines:
+        tokens = line.split()
+        for index in range(len(tokens) - 1):
+            if tokens[index] == b"len" and tokens[index + 1].isdigit():
+                total += int(tokens[index + 1])
+                break
+    return total
+
+
+class JobState:
+    """What a job remembers between runs on the client, in its stateFile (<stateDir>/<snapshotName>.json): the
+    throughput of recent transfers, the incrementals sent since the last full send and how many runs in a row were
+    deferred."""
+
+    def __init__(self, path):
+        self.path = path
+        self.transfers = []  # [timestamp, bytes, seconds]
+        self.chainLength = 0
+        self.deferred = 0
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.transfers = state.get("transfers", [])
+            self.chainLength = state.get("chainLength", 0)
+            self.deferred = state.get("deferred", 0)
+        except (IOError, OSError, ValueError):
+            pass  # First run, or an unreadable file that the next save replaces.
+
+    def save(self):
+        try:
+            mkdir_p(os.path.dirname(self.path))
+            tmpFile = "%s.tmp" % self.path
+            with open(tmpFile, "w") as f:
+                json.dump({"transfers": self.transfers, "chainLength": self.chainLength, "deferred": self.deferred}, f)
+            os.replace(tmpFile, self.path)
+        except (IOError, OSError) as e:
+            logWarning("Could not save the job state %s: %s", self.path, e)
+
+    def recordTransfer(self, count, seconds, full):
+        if count >= MIN_THROUGHPUT_SAMPLE and seconds > 0:
+            self.transfers = (self.transfers + [[int(time.time()), count, round(seconds, 3)]])[-THROUGHPUT_SAMPLES:]
+        self.chainLength = 0 if full else self.chainLength + 1
+        self.deferred = 0
+        self.save()
+
+    def rate(self):
+        """Returns the median throughput of the remembered transfers in bytes per second, or None."""
+        rates = sorted(count / seconds for ts, count, seconds in self.transfers)
+        return rates[len(rates) // 2] if rates else None
+
+
+def statePath(snapshotName, options):
+    """The JobState file of a job: its stateFile option, else <snapshotName>.json in its stateDir."""
+    return options.get("stateFile") or os.path.join(options.get("stateDir") or DEFAULT_STATE_DIR,
+                                                    "%s.json" % snapshotName)
+
+
+RUN_PHASES = ["listing", "snapshot", "transfer", "prune", "cleanup"]
+REGRESSION_RUNS = 5  # Recent runs compared against the ones before them.
+REGRESSION_FACTOR = 1.5  # A phase counts as regressed once its recent median is this much slower.
+QUANTILES = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]
+
+
+class PhaseTimer:
+    """Adds up the wall time a run spends in each of the RUN_PHASES. A phase entered again while it is already
+    running, e.g. a listing inside a listing, is counted once."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.started = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        outer = name not in self.started
+        if outer:
+            self.started[name] = time.time()
+        try:
+            yield
+        finally:
+            if outer:
+                self.seconds[name] += time.time() - self.started.pop(name)
+
+
+class RunHistory:
+    """SQLite table of past runs: one row per run with its outcome, stream and the seconds spent in each phase.
+
+    The jobs of one process write from several threads, so every call opens its own connection; WAL mode lets the
+    history subcommand read while a daemon writes.
+    """
+
+    COLUMNS = ["job", "started", "duration", "status", "mode", "snapshot", "uuid", "parent", "parentUUID", "bytes"] + \
+        ["%sSeconds" % phase for phase in RUN_PHASES]
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import sqlite3  # Imported here to keep it out of the startup time of runs that never touch the history.
+        mkdir_p(os.path.dirname(self.path) or ".")
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, job TEXT NOT NULL, started REAL, "
+                           "duration REAL, status TEXT, mode TEXT, snapshot TEXT, uuid TEXT, parent TEXT, "
+                           "parentUUID TEXT, bytes INTEGER, %s)" % ", ".join("%sSeconds REAL" % phase
+                                                                               for phase in RUN_PHASES))
+        connection.execute("CREATE INDEX IF NOT EXISTS runsByJob ON runs (job, started)")
+        return connection
+
+    def record(self, row):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO runs (%s) VALUES (%s)" % (", ".join(self.COLUMNS), ", ".join(
+                    "?" * len(self.COLUMNS))), [row.get(key) for key in self.COLUMNS])
+        finally:
+            connection.close()
+
+    def runs(self, jobs=None, since=None):
+        """Returns the runs as dicts, oldest first, optionally only of jobs and from the timestamp since on."""
+        query = "SELECT %s FROM runs WHERE started >= ?" % ", ".join(self.COLUMNS)
+        parameters = [since or 0]
+        if jobs:
+            query += " AND job IN (%s)" % ", ".join("?" * len(jobs))
+            parameters.extend(jobs)
+        connection = self.connect()
+        try:
+            return [dict(zip(self.COLUMNS, row)) for row in connection.execute(query + " ORDER BY started", parameters)]
+        finally:
+            connection.close()
+
+
+def historyPath(options):
+    """The run history database of a job: its historyDb option, else history.db in its stateDir."""
+    return options.get("historyDb") or os.path.join(options.get("stateDir") or DEFAULT_STATE_DIR, "history.db")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, or None if there are none."""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(ceil(fraction * len(values))) - 1))]
+
+
+def growthPerDay(runs):
+    """Least-squares slope of the stream size over time in bytes per day, or None with fewer than three runs."""
+    points = [(run["started"] / 86400.0, run["bytes"]) for run in runs if run["bytes"] is not None]
+    if len(points) < 3:
+        return None
+    meanX = sum(x for x, y in points) / len(points)
+    meanY = sum(y for x, y in points) / len(points)
+    variance = sum((x - meanX) ** 2 for x, y in points)
+    if variance == 0:
+        return None
+    return sum((x - meanX) * (y - meanY) for x, y in points) / variance
+
+
+def runStats(runs):
+    """Summarizes the runs of one job: counts, phase percentiles, growth of the incremental streams, regressions."""
+    successful = [run for run in runs if run["status"] == "ok"]
+    stats = {"runs": len(runs), "statuses": defaultdict(int), "last": runs[-1] if runs else None, "phases": {},
+             "growth": None, "meanBytes": None, "regressions": []}
+    for run in runs:
+        stats["statuses"][run["status"]] += 1
+    for name in ["duration"] + ["%sSeconds" % phase for phase in RUN_PHASES] + ["bytes"]:
+        values = [run[name] for run in successful]
+        stats["phases"][name] = dict((label, percentile(values, fraction)) for label, fraction in QUANTILES)
+    incrementals = [run for run in successful if run["mode"] == "incremental"]
+    stats["growth"] = growthPerDay(incrementals)
+    if incrementals:
+        stats["meanBytes"] = sum(run["bytes"] or 0 for run in incrementals) / len(incrementals)
+    if len(successful) >= 2 * REGRESSION_RUNS:
+        recent, before = successful[-REGRESSION_RUNS:], successful[:-REGRESSION_RUNS]
+        for name in ["duration"] + ["%sSeconds" % phase for phase in RUN_PHASES]:
+            now, then = percentile([run[name] for run in recent], 0.5), percentile([run[name] for run in before], 0.5)
+            if now is not None and then and now > REGRESSION_FACTOR * then and now - then >= 1:
+                stats["regressions"].append((name, then, now))
+    return stats
+
+
+def prometheusText(statsByJob):
+    """Renders the run statistics in the Prometheus text exposition format, for node_exporter's textfile collector."""
+    lines = []
+
+    def metric(name, kind, helpText, samples):
+        lines.append("# HELP bytterfs_%s %s" % (name, helpText))
+        lines.append("# TYPE bytterfs_%s %s" % (name, kind))
+        for labels, value in samples:
+            if value is not None:
+                lines.append("bytterfs_%s{%s} %s" % (name, ",".join('%s="%s"' % (key, str(labelValue).replace(
+                    "\\", "\\\\").replace('"', '\\"')) for key, labelValue in labels), repr(float(value))))
+
+    jobs = sorted(statsByJob)
+    last = dict((job, statsByJob[job]["last"]) for job in jobs)
+    metric("last_run_timestamp_seconds", "gauge", "Start of the last run.",
+           [([("job", job)], last[job]["started"]) for job in jobs])
+    metric("last_run_success", "gauge", "1 if the last run succeeded or was deferred, else 0.",
+           [([("job", job)], 1 if last[job]["status"] in ("ok", "deferred") else 0) for job in jobs])
+    metric("last_run_bytes", "gauge", "Stream bytes of the last run.",
+           [([("job", job)], last[job]["bytes"]) for job in jobs])
+    metric("last_run_phase_seconds", "gauge", "Seconds the last run spent per phase.",
+           [([("job", job), ("phase", phase)], last[job]["%sSeconds" % phase]) for job in jobs for phase in RUN_PHASES]
+           + [([("job", job), ("phase", "total")], last[job]["duration"]) for job in jobs])
+    metric("runs", "gauge", "Runs in the reported period by status.",
+           [([("job", job), ("status", status)], count) for job in jobs
+            for status, count in sorted(statsByJob[job]["statuses"].items())])
+    metric("phase_seconds", "gauge", "Percentiles of the seconds successful runs spent per phase.",
+           [([("job", job), ("phase", "total" if name == "duration" else name.replace("Seconds", "")),
+              ("quantile", fraction)], statsByJob[job]["phases"][name][label]) for job in jobs
+            for name in ["duration"] + ["%sSeconds" % phase for phase in RUN_PHASES] for label, fraction in QUANTILES])
+    metric("incremental_growth_bytes_per_day", "gauge", "Trend of the incremental stream size.",
+           [([("job", job)], statsByJob[job]["growth"]) for job in jobs])
+    metric("regression", "gauge", "1 if the recent runs of a phase are slower than before.",
+           [([("job", job), ("phase", name.replace("Seconds", ""))], 1) for job in jobs
+            for name, then, now in statsByJob[job]["regressions"]])
+    return "\n".join(lines) + "\n"
+
+
+class PruneWorker(threading.Thread):
+    """Runs snapshot deletions in the background while the stream is sent, see Bytterfs.startPrune().
+
+    deletions is a list of (label, transport, container, names, phase) handed to Bytterfs.deleteSubvols() one after
+    the other, without an inventory since those belong to the main thread. The worker times its phases on its own
+    PhaseTimer for the same reason. join() is the completion barrier: afterwards deleted and failed hold (label,
+    container, names) of every deletion and error the exception that stopped the worker, if any.
+    """
+
+    def __init__(self, bytterfs, deletions):
+        threading.Thread.__init__(self, name=threading.current_thread().name, daemon=True)
+        self.bytterfs = bytterfs
+        self.deletions = deletions
+        self.timer = PhaseTimer()
+        self.deleted = []
+        self.failed = []
+        self.error = None
+
+    def run(self):
+        try:
+            for label, transport, container, names, phase in self.deletions:
+                if not names:
+                    continue
+                with self.timer.phase(phase):
+                    deleted, failed = self.bytterfs.deleteSubvols(transport, container, None, names)
+                self.deleted.append((label, container, deleted))
+                if failed:
+                    self.failed.append((label, container, failed))
+        except Exception as e:  # Anything that ends the thread has to reach finishPrune().
+            self.error = e
+            logError("Background deletion failed: %s", e)
+
+
+class Destination:
+    """One receiving end of a fan-out backup: its transport, container and snapshot inventory."""
+
+    def __init__(self, name, transport, destRootSubvol, destContainer, inventory):
+        self.name = name
+        self.transport = transport
+        self.destRootSubvol = destRootSubvol
+        self.destContainer = destContainer
+        self.inventory = inventory
+
+    @classmethod
+    def fromSpec(cls, spec, snapshotName, timeout=None, agent=False):
+        sshHost, sshPort, sshKey, destRootSubvol, destContainer = parseMirror(spec)
+        transport = SshTransport(sshHost, sshPort, sshKey, useAgent=agent)
+        name = "%s:%s" % (sshHost, destContainer)
+        inventory = SubvolInventory(
+            name, snapshotName, lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-u", "-R", destContainer], timeout,
+            transport)
+        return cls(name, transport, destRootSubvol, destContainer, inventory)
+
+    def hasContainerCmd(self):
+        return ["sudo", "btrfs", "subvol", "list", "-o", self.destRootSubvol]
+
+    def hasContainer(self, result=None):
+        if result is None:
+            result = self.transport.run([self.hasContainerCmd()], self.inventory.timeout)[0]
+        return hasContainer(result, self.destRootSubvol, self.destContainer)
+
+
+class CloneSource:
+    """Snapshots of a sibling job that may serve as `btrfs send -c` clone sources: the job's client snapshots in
+    source and the ones it received in destContainer on the same destination."""
+
+    def __init__(self, snapshotName, source, clientInventory, destInventory):
+        self.snapshotName = snapshotName
+        self.source = source
+        self.clientInventory = clientInventory
+        self.destInventory = destInventory
+
+    @classmethod
+    def fromSpec(cls, spec, transport, timeout=None):
+        snapshotName, source, destContainer = parseCloneSource(spec)
+        clientInventory = SubvolInventory(
+            "%s client" % snapshotName, snapshotName,
+            lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-r", "-u", source], timeout, required=False)
+        destInventory = SubvolInventory(
+            "%s destination" % snapshotName, snapshotName,
+            lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-u", "-R", destContainer], timeout, transport,
+            required=False)
+        return cls(snapshotName, source, clientInventory, destInventory)
+
+    def invalidate(self):
+        self.clientInventory.invalidate()
+        self.destInventory.invalidate()
+
+    def common(self):
+        """Returns the entry of the newest client snapshot of the sibling that the destination received, or None."""
+        for entry in reversed(self.clientInventory.entries()):
+            if entry["uuid"] and self.destInventory.findReceivedUUID(entry["uuid"]) is not None:
+                return entry
+        return None
 
 
 class Bytterfs:
 
-    def __init__(self, snapshotName, source, destRootSubvol, destContainer, keep, sshHost, sshPort, sshKey):
+    def __init__(self, snapshotName, source, destRootSubvol, destContainer, keep, sshHost, sshPort, sshKey,
+                 compress=None, compressLevel=None, compressThreads=None, relay=False, progressInterval=None,
+                 statusFile=None, bwLimit=None, bwSchedule=None, spool=None, remoteSpool=None, spoolChunkSize=None,
+                 deleteBatch=None, deleteCommit=None, dryRun=False, mirrors=None, mirrorBuffer=None,
+                 commandTimeout=None, agent=False, buffer=None, bufferWatermarks=None, bufferDir=None,
+                 checksum=False, manifestDir=None, archive=False, archiveChunkSize=None, archiveWriters=None,
+                 fullEvery=None, maxDuration=None, oversize=None, stateDir=None, stateFile=None,
+                 historyDb=None, overlapPrune=False, cloneSources=None):
         self.snapshotName = snapshotName
         self.source = source
         self.destContainer = destContainer
         self.destRootSubvol = destRootSubvol
         self.keep = keep
+        self.retention = RetentionPolicy.parse(keep)
         self.sshHost = sshHost
         self.sshPort = sshPort
         self.sshKey = sshKey
         if sshHost == None or sshPort == None or sshKey == None:
-            self.sshArgs = list()  # Workaround for empty list - will run subprocess locally.
+            self.transport = LocalTransport()
         else:
-            self.sshArgs = ["ssh", "-i", self.sshKey, "-p", self.sshPort, self.sshHost, "-t"]
+            self.transport = SshTransport(self.sshHost, self.sshPort, self.sshKey, useAgent=agent)
         self.lockfile = "%s%s" % (self.source, "bytterfs.lock")
+        self.completed = False  # Set once a backup went through, since every path ends with exit(0).
+        self.sentBytes = None  # Stream size of the last transfer, if it went through the relay or the spool.
+        self.fallbackParent = False
+        self.warm = False  # Set by the daemon: keep transport, inventories and the local mount for the next run.
+        self.containerChecked = False
+        self.localPrepared = False
+        self.sharedMount = None  # Top level of the local destination filesystem, see prepareLocal().
+        self.destPaths = (destRootSubvol, destContainer)  # prepareLocal() replaces both with mounted paths.
+        self.compress = compress if compress != "none" else None
+        self.compressLevel = compressLevel
+        self.compressThreads = compressThreads
+        self.compressor = None
+        self.progressInterval = progressInterval
+        self.statusFile = statusFile.replace("{snapshotName}", snapshotName) if statusFile else None
+        self.bwLimit = bwLimit
+        self.configuredBwLimit = bwLimit  # --oversize throttle lowers bwLimit for one run.
+        self.bwSchedule = bwSchedule
+        self.buffer = parseRate(buffer) if buffer else None
+        self.bufferWatermarks = bufferWatermarks or DEFAULT_BUFFER_WATERMARKS
+        self.bufferDir = bufferDir
+        self.checksum = checksum
+        self.manifestDir = manifestDir or DEFAULT_MANIFEST_DIR
+        self.streamHash = None  # (algorithm, hex digest, bytes) of the last stream sent with checksum on.
+        self.relay = bool(relay or progressInterval or statusFile or bwLimit or bwSchedule or self.buffer or checksum)
+        self.spoolDir = spool
+        self.remoteSpoolDir = remoteSpool or DEFAULT_REMOTE_SPOOL
+        self.spoolChunkSize = parseRate(spoolChunkSize) if spoolChunkSize else DEFAULT_SPOOL_CHUNK_SIZE
+        self.deleteBatch = max(1, deleteBatch or 32)
+        self.deleteCommit = deleteCommit
+        self.overlapPrune = overlapPrune
+        self.dryRun = dryRun
+        if self.compress is not None and isinstance(self.transport, LocalTransport):
+            logInfo("Ignoring compression for a local transfer.")
+            self.compress = None
+        elif self.compress in Compressor.defaultLevels:
+            self.compressor = Compressor(self.compress, compressLevel, compressThreads)
+        self.commandTimeout = commandTimeout or DEFAULT_COMMAND_TIMEOUT
+        self.mirrors = [Destination.fromSpec(spec, snapshotName, self.commandTimeout, agent) for spec in mirrors or []]
+        self.mirrorBuffer = parseRate(mirrorBuffer) if mirrorBuffer else DEFAULT_MIRROR_BUFFER
+        if self.mirrors and isinstance(self.transport, LocalTransport):
+            logWarning("Mirrors need an SSH destination. Ignoring them for a local backup.")
+            self.mirrors = []
+        if self.mirrors and self.spoolDir is not None:
+            logWarning("Spooling is not supported with mirrors. Streaming to all destinations directly.")
+            self.spoolDir = None
+        self.archive = ArchiveStore(destContainer, parseRate(archiveChunkSize) if archiveChunkSize else None,
+                                    archiveWriters, job=snapshotName) if archive else None
+        self.fullEvery = fullEvery
+        self.maxDuration = maxDuration
+        self.oversize, self.oversizeLimit = parseOversize(oversize or "run")
+        self.state = JobState(statePath(snapshotName, {"stateDir": stateDir, "stateFile": stateFile}))
+        self.deferred = False  # Set if --oversize defer postponed the run.
+        self.plannedBytes = None  # Estimated size of the next send stream.
+        self.transferSeconds = None
+        self.history = RunHistory(historyPath({"stateDir": stateDir, "historyDb": historyDb}))
+        self.timer = PhaseTimer()
+        self.runInfo = {}  # Mode, snapshot and parent of the current run for the history.
+        if self.archive is not None:
+            if not isinstance(self.transport, LocalTransport):
+                logWarning("An archive is a directory on this machine. Ignoring the SSH settings.")
+            if self.mirrors or self.spoolDir is not None:
+                logWarning("Mirrors and spooling are not supported with an archive. Ignoring them.")
+                self.mirrors = []
+                self.spoolDir = None
+        self.cloneSources = [CloneSource.fromSpec(spec, self.transport, self.commandTimeout)
+                             for spec in cloneSources or [] if parseCloneSource(spec)[0] != snapshotName]
+        self.clones = []  # Paths of the clone sources of the current send.
+        self.clientInventory = SubvolInventory(
+            "client", snapshotName, lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-r", "-u", self.source],
+            self.commandTimeout)
+        self.destInventory = SubvolInventory(
+            "destination", snapshotName,
+            lambda: ["sudo", "btrfs", "subvol", "list", "-o", "-u", "-R", self.destContainer], self.commandTimeout,
+            self.transport)
 
     def inc(self, newSnapshot, prevSnapshot):
         logInfo("Creating /bytterfs.lockfile and beginning incremental backup.")
         prevSnapshot = os.path.basename(os.path.normpath(prevSnapshot))
-        logDebug("Snapshot with stripped path and appended source: %s%s" % (self.source, prevSnapshot))
+        logDebug("Snapshot with stripped path and appended source: %s%s", self.source, prevSnapshot)
         newSnapshot = os.path.basename(os.path.normpath(newSnapshot))
-        logDebug("Snapshot with stripped path and appended source: %s%s" % (self.source, newSnapshot))
+        logDebug("Snapshot with stripped path and appended source: %s%s", self.source, newSnapshot)
+        self.runInfo.update(mode="incremental", snapshot=newSnapshot, parent=prevSnapshot,
+                            parentUUID=(self.clientInventory.find(prevSnapshot) or {}).get("uuid"),
+                            uuid=(self.clientInventory.find(newSnapshot) or {}).get("uuid"))
         touch(self.lockfile)
-        p1 = Popen(["sudo", "btrfs", "send", "-p", "%s%s" % (self.source, prevSnapshot),
-                    "%s%s" % (self.source, newSnapshot)], stdout=PIPE)
-        p2 = Popen(self.sshArgs + ["sudo", "btrfs", "receive", self.destContainer], stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()
-        out, err = p2.communicate()
-        if p2.returncode != 0:
+        sendCmd = ["sudo", "btrfs", "send", "-p", "%s%s" % (self.source, prevSnapshot)] + self.cloneArgs() + \
+            ["%s%s" % (self.source, newSnapshot)]
+        pruner = self.startPrune(newSnapshot, prevSnapshot)
+        try:
+            out, err, returncode = self.sendStream(sendCmd, newSnapshot)
+        finally:
+            pruneFailed = self.finishPrune(pruner)
+        if returncode != 0:
             logError("Error when doing incremental backup. Sending Mail and exiting. Output:%s Error: "
-                     "%s" % (out, err))
+                     "%s", out, err)
             sendmail("error", "Bytterfs", "Error when doing incremental backup. Output:%s Error: %s" % (out, err))
             exit(0)
-        logDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
+        logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+        if self.fallbackParent:
+            self.logSavedBytes(newSnapshot)
+        self.logCloneSavings(newSnapshot, self.clientInventory.find(prevSnapshot))
+        self.destRecordReceived(newSnapshot)
+        self.recordSend(full=False)
+        self.writeManifest(self.transport, self.destContainer, newSnapshot, prevSnapshot, self.destPaths[1])
         os.remove(self.lockfile)
+        self.reportPruneFailures(pruneFailed)
         logInfo('destKeepSnapshots()')
         self.destKeepSnapshots()
         logInfo('clientDeleteOlderSnapshots()')
         self.clientDeleteOlderSnapshots()
-        logInfo('Backup %s created successfully' % self.snapshotName)
+        self.logDestFree()
+        logInfo('Backup %s created successfully', self.snapshotName)
+        self.completed = True
         self.destUmount()
         exit(0)
 
@@ -171,26 +2666,294 @@ class Bytterfs:
         logInfo("Creating /bytterfs.lockfile and beginning full backup.")
         touch(self.lockfile)
         snapshot = os.path.basename(os.path.normpath(snapshot))
-        logDebug("Snapshot with stripped path and appended source: %s%s" % (self.source, snapshot))
-        p1 = Popen(["sudo", "btrfs", "send", "%s%s" % (self.source, snapshot)], stdout=PIPE)
-        p2 = Popen(self.sshArgs + ["sudo", "btrfs", "receive", self.destContainer], stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()
-        out, err = p2.communicate()
-        if p2.returncode != 0:
-            logError("Error when doing full backup. Sending Mail and exiting. Output:%s Error: %s"
-                     % (out, err))
+        logDebug("Snapshot with stripped path and appended source: %s%s", self.source, snapshot)
+        self.runInfo.update(mode="full", snapshot=snapshot,
+                            uuid=(self.clientInventory.find(snapshot) or {}).get("uuid"))
+        sendCmd = ["sudo", "btrfs", "send"] + self.cloneArgs() + ["%s%s" % (self.source, snapshot)]
+        pruner = self.startPrune(snapshot)
+        try:
+            out, err, returncode = self.sendStream(sendCmd, snapshot)
+        finally:
+            pruneFailed = self.finishPrune(pruner)
+        if returncode != 0:
+            logError("Error when doing full backup. Sending Mail and exiting. Output:%s Error: %s", out, err)
             sendmail("error", "Bytterfs", "Error when doing full backup. Output:%s Error: %s" % (out, err))
             exit(0)
-        logInfo("subprocess output: %s \nsubprocess error: %s" % (out, err))
+        logInfo("subprocess output: %s \nsubprocess error: %s", out, err)
+        self.logCloneSavings(snapshot)
+        self.destRecordReceived(snapshot)
+        self.recordSend(full=True)
+        self.writeManifest(self.transport, self.destContainer, snapshot, manifestContainer=self.destPaths[1])
         os.remove(self.lockfile)
+        self.reportPruneFailures(pruneFailed)
         logInfo('destKeepSnapshots()')
         self.destKeepSnapshots()
         logInfo('clientDeleteOlderSnapshotss()')
         self.clientDeleteOlderSnapshots()
-        logInfo('Backup %s created successfully' % self.snapshotName)
+        self.logDestFree()
+        logInfo('Backup %s created successfully', self.snapshotName)
+        self.completed = True
+        self.destUmount()
+        exit(0)
+
+    def command(self, cmd):
+        """Runs a query or deletion with the command timeout and returns its CommandResult."""
+        return runCommand(cmd, self.commandTimeout)
+
+    def destCommand(self, cmd):
+        """Runs a query or deletion on the destination, through the remote agent if one runs."""
+        return self.transport.run([cmd], self.commandTimeout)[0]
+
+    def prefetch(self, queries):
+        """Runs independent queries concurrently with runQueries(), see there."""
+        with self.timer.phase("listing"):
+            return runQueries(queries, self.commandTimeout)
+
+    def prefetchRemote(self):
+        """Starts a remote run with the container check and both listings at once, skipping what is still warm."""
+        queries = []
+        if not self.containerChecked:
+            queries.append((self.transport, self.destHasContainerCmd(), self.destHasContainer))
+        if not self.clientInventory.loaded:
+            queries.append((None, self.clientInventory.listCmd(), self.clientInventory.load))
+        if not self.destInventory.loaded:
+            queries.append((self.transport, self.destInventory.listCmd(), self.destInventory.load))
+        for clone in self.cloneSources:
+            queries.append((None, clone.clientInventory.listCmd(), clone.clientInventory.load))
+            queries.append((self.transport, clone.destInventory.listCmd(), clone.destInventory.load))
+        self.prefetch(queries)
+
+    def logDestFree(self):
+        """Logs the free space of the destination filesystem if the remote agent runs, which answers it directly."""
+        agent = getattr(self.transport, "agent", None)
+        if agent is None:
+            return
+        results = agent.call([{"op": "free", "path": self.destContainer}], self.commandTimeout)
+        if results and results[0]["returncode"] == 0:
+            logInfo("Destination %s: %.1f GB of %.1f GB available.", self.destContainer, results[0]["available"] / 1e9,
+                    results[0]["total"] / 1e9)
+
+    def destRecordReceived(self, snapshot):
+        """Adds a snapshot that was just received to the destination inventory instead of listing it again."""
+        entry = self.clientInventory.find(snapshot)
+        if entry is None or not entry["uuid"]:
+            self.destInventory.invalidate()
+            return
+        self.destInventory.add("%s%s" % (self.destContainer, entry["name"]), receivedUUID=entry["uuid"])
+
+    def sendStream(self, sendCmd, snapshot):
+        """Sends the output of sendCmd to the destination, through the spool if one is configured."""
+        with self.timer.phase("transfer"):
+            start = time.time()
+            try:
+                if self.spoolDir is not None:
+                    return SpooledTransfer(self, snapshot, sendCmd).run()
+                return self.transfer(sendCmd)
+            finally:
+                self.transferSeconds = time.time() - start
+
+    def estimateSendSize(self, parent):
+        """Returns the approximate size in bytes of the next send stream, incremental from parent if it is given.
+
+        A full stream is about the referenced size of the newest client snapshot (or of the source, if there is
+        none). An incremental stream is about the data written to the source since the generation of parent, which
+        `btrfs subvol find-new` lists from the extent tree without reading any file data.
+        """
+        if parent is None:
+            newest = self.clientInventory.newest()
+            return self.fullSendSize(newest["name"] if newest is not None else "")
+        if parent.get("gen") is None:
+            return None
+        result = self.command(["sudo", "btrfs", "subvol", "find-new", self.source, str(parent["gen"])])
+        if result.returncode != 0:
+            logDebug("btrfs subvol find-new failed: %s", result.stderr)
+            return None
+        return findNewBytes(result.stdout.splitlines())
+
+    def planSend(self, parent, defer=True):
+        """Estimates the next send and predicts its duration from the throughput of past runs.
+
+        If the prediction exceeds --maxDuration, the --oversize action applies: throttle lowers the bandwidth limit
+        for this run, defer postpones the run (at most MAX_DEFERRALS times in a row, and only if defer is set).
+        Returns False if the run is to be deferred.
+        """
+        if self.maxDuration is None:
+            return True
+        self.plannedBytes = self.estimateSendSize(parent)
+        kind = "incremental" if parent is not None else "full"
+        rate = self.state.rate()
+        if self.plannedBytes is None or rate is None:
+            logInfo("Planning the %s send: estimated %s bytes, %s.", kind,
+                    self.plannedBytes if self.plannedBytes is not None else "unknown",
+                    "%.1f MB/s measured in past runs" % (rate / 1e6) if rate else "no throughput measured yet")
+            return True
+        seconds = self.plannedBytes / rate
+        logInfo("Planning the %s send: estimated %s bytes, about %.0fs at %.1f MB/s measured in past runs.", kind,
+                self.plannedBytes, seconds, rate / 1e6)
+        if seconds <= self.maxDuration:
+            return True
+        if self.oversize == "throttle":
+            if not self.bwLimit or parseRate(self.bwLimit) > self.oversizeLimit:
+                self.bwLimit = str(self.oversizeLimit)
+            self.relay = True
+            logWarning("The %s send exceeds --maxDuration %ss. Throttling it to %.1f MB/s.", kind, self.maxDuration,
+                       parseRate(self.bwLimit) / 1e6)
+        elif self.oversize == "defer" and defer and self.state.deferred < MAX_DEFERRALS:
+            self.state.deferred += 1
+            self.state.save()
+            logWarning("The %s send exceeds --maxDuration %ss. Deferring the run (%s of at most %s in a row).", kind,
+                       self.maxDuration, self.state.deferred, MAX_DEFERRALS)
+            return False
+        else:
+            logWarning("The %s send exceeds --maxDuration %ss. Sending anyway.", kind, self.maxDuration)
+        return True
+
+    def deferRun(self):
+        self.deferred = True
         self.destUmount()
         exit(0)
 
+    def recordSend(self, full):
+        """Remembers the throughput of the send that just went through and the length of the incremental chain."""
+        count = self.sentBytes if self.sentBytes is not None else self.plannedBytes
+        seconds = self.transferSeconds or 0
+        if self.sentBytes is not None and self.plannedBytes is not None:
+            logInfo("Sent %s bytes in %.1fs, estimated were %s bytes.", self.sentBytes, seconds, self.plannedBytes)
+        self.state.recordTransfer(count or 0, seconds, full)
+
+    def resumeSpool(self):
+        """Finishes a spooled transfer that an earlier run left behind. Returns True if there was one."""
+        if self.spoolDir is None:
+            return False
+        for entry in self.clientInventory.entries():
+            spooled = SpooledTransfer(self, entry["name"])
+            if not spooled.exists():
+                continue
+            logWarning("Resuming spooled transfer of %s instead of resending it.", entry["name"])
+            out, err, returncode = spooled.run()
+            if returncode != 0:
+                logError("Error when resuming spooled transfer of %s. Sending Mail and exiting. Output:%s Error: %s",
+                         entry["name"], out, err)
+                sendmail("error", "Bytterfs", "Error when resuming spooled transfer of %s. Output:%s Error: %s"
+                         % (entry["name"], out, err))
+                exit(0)
+            self.destInventory.invalidate()
+            os.remove(self.lockfile)
+            return True
+        return False
+
+    def transfer(self, sendCmd):
+        """Pipes sendCmd into `btrfs receive` on the destination, through the compression stage if enabled.
+
+        Returns the receive output, error and a returncode that is non-zero if any stage of the pipeline failed.
+        """
+        receiveCmd = ["sudo", "btrfs", "receive", self.destContainer]
+        start = time.time()
+        p1 = Popen(sendCmd, stdout=PIPE)
+        compressor = self.compressor
+        sample = b""
+        if self.compress == "auto":
+            sample = readSample(p1.stdout, AUTO_COMPRESS_SAMPLE)
+            compressor = chooseCompressor(sample, self.compressLevel, self.compressThreads)
+        if compressor is None and not sample and not self.relay:
+            p2 = Popen(self.transport.wrap(receiveCmd), stdin=p1.stdout, stdout=PIPE)
+            p1.stdout.close()
+            out, err = p2.communicate()
+            p1.wait()
+            return out, err, p2.returncode or p1.returncode
+        stages = [p1]
+        relays = []
+        progress = TransferProgress(self.snapshotName, self.progressInterval, self.statusFile)
+        limiter = RateLimiter(self.bwLimit, self.bwSchedule) if self.bwLimit or self.bwSchedule else None
+        hasher = self.startHasher()
+        observers = [hasher.update] if hasher is not None else []
+        if compressor is None:
+            p2 = Popen(self.transport.wrap(receiveCmd), stdin=PIPE, stdout=PIPE)
+            relays.append(self.wireStage(p1.stdout, p2.stdin, prefix=sample, progress=progress, observers=observers,
+                                         limiter=limiter))
+        else:
+            remoteCmd = "%s | %s" % (" ".join(map(shlex.quote, compressor.decompressCmd())),
+                                     " ".join(map(shlex.quote, receiveCmd)))
+            pc = Popen(compressor.compressCmd(), stdin=PIPE, stdout=PIPE)
+            p2 = Popen(self.transport.wrapShell(remoteCmd), stdin=PIPE, stdout=PIPE)
+            stages.append(pc)
+            relays.append(StreamRelay(p1.stdout, pc.stdin, prefix=sample, progress=progress, observers=observers))
+            relays.append(self.wireStage(pc.stdout, p2.stdin, limiter=limiter))  # Limit what goes over the wire.
+        for relay in relays:
+            relay.start()
+        out, err = p2.stdout.read(), None  # communicate() would close p2.stdin under the relay.
+        p2.wait()
+        for relay in relays:
+            relay.join()
+        returncode = p2.returncode
+        for stage in stages:
+            stage.wait()
+            returncode = returncode or stage.returncode
+        returncode = returncode or (1 if any(relay.error is not None for relay in relays) else 0)
+        self.finishHasher(hasher)
+        progress.finish(returncode)
+        elapsed = max(time.time() - start, 0.001)
+        rawBytes = relays[0].bytes
+        wireBytes = relays[-1].bytes
+        self.sentBytes = rawBytes
+        if compressor is None:
+            logInfo("Sent %s bytes uncompressed in %.1fs (%.1f MB/s).", rawBytes, elapsed, rawBytes / elapsed / 1e6)
+        else:
+            logInfo("Sent %s bytes as %s bytes of %s (ratio %.2f) in %.1fs: %.1f MB/s stream, %.1f MB/s on the "
+                    "wire.", rawBytes, wireBytes, compressor.name, wireBytes / max(rawBytes, 1), elapsed,
+                    rawBytes / elapsed / 1e6, wireBytes / elapsed / 1e6)
+        return out, err, returncode
+
+    def startHasher(self):
+        self.streamHash = None
+        if not self.checksum:
+            return None
+        hasher = StreamHasher()
+        hasher.start()
+        return hasher
+
+    def finishHasher(self, hasher):
+        if hasher is not None:
+            self.streamHash = (hasher.algorithm, hasher.finish(), hasher.bytes)
+            logInfo("%s of the send stream: %s (%s bytes).", *self.streamHash)
+
+    def writeManifest(self, transport, destContainer, snapshot, parent=None, manifestContainer=None):
+        """Records the stream hash and the UUIDs of a snapshot just received in its manifest on the destination.
+
+        manifestContainer names the container the manifest belongs to if destContainer is a local mount of it.
+        Failing to write the manifest only leaves the snapshot unverified, so it is logged and not fatal.
+        """
+        if self.streamHash is None:
+            return
+        algorithm, digest, count = self.streamHash
+        snapshot = os.path.basename(os.path.normpath(snapshot))
+        entry = self.clientInventory.find(snapshot)
+        parentEntry = self.clientInventory.find(parent) if parent else None
+        showCmd = ["sudo", "btrfs", "subvol", "show", "%s%s" % (destContainer, snapshot)]
+        destUUID = subvolShowUUID(transport.run([showCmd], self.commandTimeout)[0])
+        manifest = {"snapshot": snapshot, "algorithm": algorithm, "digest": digest, "bytes": count,
+                    "sourceUUID": entry["uuid"] if entry is not None else None,
+                    "parent": os.path.basename(os.path.normpath(parent)) if parent else None,
+                    "parentUUID": parentEntry["uuid"] if parentEntry is not None else None,
+                    "destUUID": destUUID, "created": int(time.time())}
+        directory = shellPath(manifestDirectory(self.manifestDir, manifestContainer or destContainer))
+        target = "%s%s" % (directory, shlex.quote("%s.json" % snapshot))
+        p1 = Popen(transport.wrapShell("mkdir -p %s && cat > %s.part && mv %s.part %s" % (directory, target, target,
+                                                                                           target), tty=False),
+                   stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        out, err = p1.communicate((json.dumps(manifest, sort_keys=True) + "\n").encode("utf-8"))
+        if p1.returncode != 0:
+            logWarning("Could not write the manifest of %s: %s", snapshot, err.decode("latin-1").strip())
+        else:
+            logDebug("Wrote manifest %s: %s", target, manifest)
+
+    def wireStage(self, src, dst, **kwargs):
+        """Returns the stage that feeds the receive side: the ring buffer if --buffer is set, else a relay."""
+        if self.buffer:
+            return StreamBuffer(src, dst, self.buffer, watermarks=self.bufferWatermarks, backingDir=self.bufferDir,
+                                **kwargs)
+        return StreamRelay(src, dst, **kwargs)
+
     def subvolSplitTsList(self, subvolList):
         tsList = []
         for subvol in subvolList:
@@ -204,14 +2967,17 @@ class Bytterfs:
         if os.path.isfile(self.lockfile) is False:
             logInfo("No lockfile found. Seems last backup was not interrupted. Continuing. \n")
             pass
+        elif self.resumeSpool():
+            logInfo("Interrupted transfer resumed from the spool. Continuing.")
         else:
             logError("Lockfile found. Last backup was interrupted. Deleting possible incomplete snapshot on "
                      "destination.\n")
             sendmail("error", "Bytterfs", "Lockfile found. Deleting possible left over on destination and continuing "
                      "with backup. See local syslog for more details.")
+            self.planSend(None, defer=False)  # The recovery mostly sends in full and must not be postponed.
             clientSubvolList = self.clientSubvolList(withUUID=False)
-            clientTsList = self.subvolSplitTsList(clientSubvolList)
-            destTsList = self.subvolSplitTsList(self.destSubvolList(withUUID=False))
+            clientTsList = self.clientInventory.timestamps()
+            destTsList = self.destInventory.timestamps()
             destLatestSnapshot = self.destLatestSnapshot()
             if destLatestSnapshot is None:
                 logError("No Snapshots found on destination. Something is wrong. Exiting and sending mail.")
@@ -223,7 +2989,7 @@ class Bytterfs:
                 self.full(self.clientCreateSnapshot())
             elif len(clientSubvolList) == 1:
                 logWarning("isLockfile(): Found one snapshot on client.")
-                logDebug("Checking if destHasSnapshot(clientTsList[0]), where clientTsList[0] is: %s" % clientTsList[0])
+                logDebug("Checking if destHasSnapshot(clientTsList[0]), where clientTsList[0] is: %s", clientTsList[0])
                 if self.destHasSnapshot(clientTsList[0]):
                     logWarning("isLockfile(): Found client snapshot on destination. Deleting it, because it might be "
                                "incomplete.")
@@ -242,8 +3008,9 @@ class Bytterfs:
                            "on client and get the previous snapshot on dest / client.")
                 # Alternatively the last snapshot that is found on destination could be deleted.
                 clientTsTmpList = []
+                destNewestTs = self.destNewestSnapshot()  # Only changes once we delete it below.
                 for ts in clientTsList:
-                    if ts == self.destNewestSnapshot():
+                    if ts == destNewestTs:
                         # Delete Newest Snapshot on destination
                         self.destDeleteSubvol("%s_%s" % (self.snapshotName, ts))
                         for ts2 in clientTsList:
@@ -272,356 +3039,1210 @@ class Bytterfs:
         if len(subvolList) == 0:
             logError("Found no snapshot on client. Sending mail. Ignore this error, if you run bytterfs the first time")
             sendmail("error", "Bytterfs", "Found no snapshot on client. Ignore error, if you run    bytterfs first time.")
+            if not self.planSend(None):
+                self.deferRun()
             newSnapshot = self.clientCreateSnapshot()
             self.full(newSnapshot)
         elif len(subvolList) >= 1:
             logInfo("Found one or more than one matching snapshot on client. Checking if dest has subvol of client and "
                      "then proceeding with backup.")
             clientLatestTs = self.clientLatestSnapshot(onlyTs=True)
-            logInfo("Checking if clientLatestTs: %s is on destination." % clientLatestTs)
-            if self.destHasSnapshot(clientLatestTs) is True:
-                logInfo("Found clientLatestTs on destination. Initiating incremental backup")
-                newSnapshot = self.clientCreateSnapshot()
-                self.inc(newSnapshot, "%s_%s" % (self.snapshotName, clientLatestTs))
-            elif self.destHasSnapshot(clientLatestTs) is False:
-                logInfo("Did not find clientLatestTs on destination. Initiating full backup")
+            parent = self.commonParent()
+            if parent is None:
+                logInfo("Did not find a snapshot of the client on destination. Initiating full backup")
+                if not self.planSend(None):
+                    self.deferRun()
                 self.full("%s_%s" % (self.snapshotName, clientLatestTs))
+                return
+            if self.fullEvery and self.state.chainLength >= self.fullEvery:
+                logInfo("%s incrementals were sent since the last full send. Sending a fresh full stream "
+                        "(--fullEvery %s).", self.state.chainLength, self.fullEvery)
+                if not self.planSend(None):
+                    self.deferRun()
+                self.full(self.clientCreateSnapshot())
+                return
+            if parent["ts"] == clientLatestTs:
+                logInfo("Found clientLatestTs: %s on destination. Initiating incremental backup", clientLatestTs)
+            else:
+                logWarning("clientLatestTs: %s is not on destination. Using the newest common snapshot %s as parent "
+                           "instead of sending a full stream.", clientLatestTs, parent["name"])
+                self.fallbackParent = True
+                self.relay = True  # Count the bytes of the incremental stream to log what the fallback saved.
+            if not self.planSend(parent):
+                self.deferRun()
+            newSnapshot = self.clientCreateSnapshot()
+            self.inc(newSnapshot, parent["name"])
+
+    def commonParent(self, inventory=None):
+        """Returns the inventory entry of the newest client snapshot the destination received, or None.
+
+        A snapshot only counts as common if the destination holds a subvolume whose received_uuid is the UUID of the
+        client snapshot, so a same-named snapshot that was recreated on either side is never used as parent.
+        """
+        inventory = inventory or self.destInventory
+        for entry in reversed(self.clientInventory.entries()):
+            if entry["uuid"] and inventory.findReceivedUUID(entry["uuid"]) is not None:
+                return entry
+            if inventory.findTs(entry["ts"]) is not None:
+                logWarning("%s on destination was not received from the client snapshot with UUID %s. Not using it "
+                           "as parent.", entry["name"], entry["uuid"])
+        return None
+
+    def fullSendSize(self, snapshot):
+        """Returns the referenced size of a client snapshot in bytes as reported by `btrfs filesystem du`, or None."""
+        result = self.command(["sudo", "btrfs", "filesystem", "du", "-s", "--raw", "%s%s" % (self.source, snapshot)])
+        out, err = result.stdout, result.stderr
+        if result.returncode != 0:
+            logDebug("btrfs filesystem du failed: %s", err)
+            return None
+        for row in out.decode("utf-8").splitlines()[1:]:
+            fields = row.split()
+            if fields and fields[0].isdigit():
+                return int(fields[0])
+        return None
+
+    def logSavedBytes(self, snapshot):
+        """Logs how much less the incremental stream from a fallback parent sent compared to a full send."""
+        fullSize = self.fullSendSize(snapshot)
+        if fullSize is None or self.sentBytes is None:
+            return
+        logInfo("Incremental stream from the fallback parent sent %s bytes, a full send would have been about %s "
+                "bytes (saved %s bytes).", self.sentBytes, fullSize, max(fullSize - self.sentBytes, 0))
+
+    def cloneArgs(self):
+        """Returns the `-c` arguments for the snapshots of sibling jobs that both ends hold, see --cloneSource.
+
+        A sibling counts if its source is on the same client filesystem and the destination received its newest
+        common snapshot, so `btrfs receive` finds the shared extents there by UUID. Turns on the relay to count the
+        stream for logCloneSavings().
+        """
+        self.clones = []
+        mount = findMount(self.source)
+        for clone in self.cloneSources:
+            cloneMount = findMount(clone.source)
+            if mount is not None and cloneMount is not None and mount["device"] != cloneMount["device"]:
+                logWarning("%s is not on the filesystem of %s. Not using %s as clone source.", clone.source,
+                           self.source, clone.snapshotName)
+                continue
+            entry = clone.common()
+            if entry is None:
+                logInfo("The destination has no snapshot of %s that is also on the client. Not using it as clone "
+                        "source.", clone.snapshotName)
+                continue
+            self.clones.append("%s%s" % (clone.source, entry["name"]))
+        if self.clones:
+            logInfo("Using clone sources %s.", ", ".join(self.clones))
+            self.relay = True
+        return [arg for path in self.clones for arg in ("-c", path)]
+
+    def logCloneSavings(self, snapshot, parent=None):
+        """Logs how much less the stream with clone sources sent compared to one from the parent (or a full one)
+        alone, estimated like planSend() does."""
+        if not self.clones or self.sentBytes is None:
+            return
+        estimate = self.estimateSendSize(parent) if parent is not None else self.fullSendSize(snapshot)
+        if estimate is None:
+            return
+        logInfo("Stream with %s clone source(s) sent %s bytes, a %s stream would have been about %s bytes (saved %s "
+                "bytes).", len(self.clones), self.sentBytes, "-p only" if parent is not None else "full", estimate,
+                max(estimate - self.sentBytes, 0))
 
     def clientLatestSnapshot(self, onlyTs):
-        clientTsList = self.subvolSplitTsList(self.clientSubvolList(withUUID=False))
+        newest = self.clientInventory.newest()
+        if newest is None:
+            return None
         if onlyTs is True:
-            return heapq.nlargest(1, clientTsList)[0]
-        else:
-            for subvol in self.clientSubvolList(withUUID=False):
-                if heapq.nlargest(1, clientTsList)[0] in subvol:
-                    logInfo("isLockfile(): Newest client subvolume is %s" % subvol)
-                    return subvol
+            return newest["ts"]
+        logInfo("isLockfile(): Newest client subvolume is %s", newest["path"])
+        return newest["path"]
 
     def clientDeleteSubvol(self, subvolume):
         subvolume = os.path.basename(os.path.normpath(subvolume))
-        p1 = Popen(["sudo", "btrfs", "subvol", "delete", "%s" % subvolume], stdout=PIPE)
-        out, err = p1.communicate()
-        logDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
-        if p1.returncode != 0:
+        result = self.command(["sudo", "btrfs", "subvol", "delete", "%s" % subvolume])
+        out, err = result.stdout, result.stderr
+        logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+        if result.returncode != 0:
             logError("Subprocess returncode != 0 for clientDeleteSuvol() method. Exiting Backup.")
             sendmail("error", "Bytterfs", "Subprocess returncode != 0 for clientDeleteSuvol() method. Exiting Backup")
-        logWarning("Deleted %s" % subvolume)
+        self.clientInventory.remove(subvolume)
+        logWarning("Deleted %s", subvolume)
 
     def clientDeleteOlderSnapshots(self):
-        clientSubvolList = self.clientSubvolList(withUUID=False)
-        logDebug("Received this clientSubvolList: %s" % clientSubvolList)
-        tsList = self.subvolSplitTsList(clientSubvolList)
-        smallestTsList = heapq.nsmallest(len(tsList)-1, tsList)
-        logWarning("Going to delete following clientSubvols: %s \n If latter list is empty, then there is only one"
-                   " or none client subvolume." % smallestTsList)
-        for subvolTs in smallestTsList:
-            process = Popen(["sudo", "btrfs", "subvol", "delete", "%s%s_%s" % (self.source, self.snapshotName,
-                                                                               subvolTs)], stdout=PIPE, stderr=PIPE)
-            out, err = process.communicate()
-            logDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
-            if process.returncode != 0:
+        with self.timer.phase("cleanup"):
+            clientSubvolList = self.clientSubvolList(withUUID=False)
+            logDebug("Received this clientSubvolList: %s", clientSubvolList)
+            tsList = self.clientInventory.timestamps()
+            smallestTsList = heapq.nsmallest(len(tsList)-1, tsList)
+            logWarning("Going to delete following clientSubvols: %s \n If latter list is empty, then there is only one"
+                       " or none client subvolume.", smallestTsList)
+            deleted, failed = self.deleteSubvols(None, self.source, self.clientInventory,
+                                                 ["%s_%s" % (self.snapshotName, ts) for ts in smallestTsList])
+            if failed:
                 logError("Error when deleting older snapshots on client. Exiting Backup.")
-                sendmail("error", "Bytterfs", "Error when deleting older snapshots on client.")
+                sendmail("error", "Bytterfs", "Error when deleting older snapshots on client: %s" % ", ".join(failed))
                 exit(0)
-        logInfo("Delete older subvolume successfully.")
-        clientLatestTs = heapq.nlargest(1, tsList)[0]  # heapq always returns a list, not a string.
-        logDebug("clientLatestTs: %s" % clientLatestTs)
-        return clientLatestTs  # Returning only timestamp, because that's sufficient for further usage.
+            logInfo("Delete older subvolume successfully.")
+            clientLatestTs = heapq.nlargest(1, tsList)[0]  # heapq always returns a list, not a string.
+            logDebug("clientLatestTs: %s", clientLatestTs)
+            return clientLatestTs  # Returning only timestamp, because that's sufficient for further usage.
 
     def clientSubvolList(self, withUUID):
-        process = Popen(["sudo", "btrfs", "subvol", "list", "-o", "-r", "-u", self.source], stdout=PIPE, stderr=PIPE)
-        out, err = process.communicate()
-        splitRows = out.decode('latin-1').split("\n")
-        splitRows = filter(None, splitRows)  # filters out empty list elements
-        subvolList = []
-        for row in splitRows:
-            splitLine = row.split(" ")
-            subvolUUID = splitLine[8]
-            subvolName = "".join(splitLine[10:])  # slices will work for subvolNames with spaces
-            if self.snapshotName in os.path.basename(os.path.normpath(subvolName)):  # Assuring to catch right subvol.
-                if withUUID is True:
-                    subvolList.append((subvolName, subvolUUID))
-                else:
-                    subvolList.append(subvolName)
-        logDebug("Returned subvolList:  %s" % subvolList)
+        if withUUID is True:
+            subvolList = [(entry["path"], entry["uuid"]) for entry in self.clientInventory.entries()]
+        else:
+            subvolList = [entry["path"] for entry in self.clientInventory.entries()]
+        logDebug("Returned subvolList:  %s", subvolList)
         return subvolList
 
     def clientCreateSnapshot(self):
-        ts = int(time.time())
-        newSnapshot = "%s%s_%s" %(self.source, self.snapshotName, ts)
-        process = Popen(["sudo", "btrfs", "subvol", "snapshot", "-r", self.source, "%s" % (newSnapshot)],
-                        stdout=PIPE,stderr=PIPE)
-        out, err = process.communicate()
-        if process.returncode != 0:
-            logError("Error when creating readonly snapshot. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Error when creating readonly snapshot. Exiting Backup.")
-            exit(0)
-        return newSnapshot
+        with self.timer.phase("snapshot"):
+            ts = int(time.time())
+            newSnapshot = "%s%s_%s" %(self.source, self.snapshotName, ts)
+            result = self.command(["sudo", "btrfs", "subvol", "snapshot", "-r", self.source, "%s" % (newSnapshot)])
+            if result.returncode != 0:
+                logError("Error when creating readonly snapshot. Exiting Backup.")
+                sendmail("error", "Bytterfs", "Error when creating readonly snapshot. Exiting Backup.")
+                exit(0)
+            self.clientInventory.add(newSnapshot, self.clientSnapshotUUID(newSnapshot))
+            return newSnapshot
+
+    def clientSnapshotUUID(self, snapshot):
+        """Returns the UUID of a client snapshot from `btrfs subvol show`, or None."""
+        result = self.command(["sudo", "btrfs", "subvol", "show", snapshot])
+        snapshotUUID = subvolShowUUID(result)
+        if snapshotUUID is None:
+            logDebug("No UUID for %s in btrfs subvol show: %s", snapshot, result.stderr)
+        return snapshotUUID
 
     def destLatestSnapshot(self):
-        destTsList = self.subvolSplitTsList(self.destSubvolList(withUUID=False))
-        for subvol in self.destSubvolList(withUUID=False):
-            if heapq.nlargest(1, destTsList)[0] in subvol:
-                logInfo("isLockfile(): Newest dest subvolume is %s" % subvol)
-                return subvol
+        newest = self.destInventory.newest()
+        if newest is not None:
+            logInfo("isLockfile(): Newest dest subvolume is %s", newest["path"])
+            return newest["path"]
 
     def destSubvolList(self, withUUID):
-        p1 = Popen(self.sshArgs + ["sudo", "btrfs", "subvol", "list", "-o", "-R", self.destContainer], stdout=PIPE)
-        out, err = p1.communicate()
-        logDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
-        if p1.returncode != 0:
-            logError("Subprocess returncode != 0 for destSuvolList() method. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for destSuvolList() method. Exiting Backup")
-            exit(0)
-        splitRows = out.decode('latin-1').split("\n")
-        splitRows = filter(None, splitRows)  # filters out empty list elements
-        subvolList = []
-        for row in splitRows:
-            splitLine = row.split(" ")
-            subvolUUID = splitLine[8]
-            subvolName = "".join(splitLine[10:])
-            if self.snapshotName in subvolName:  # Making sure to catch the right snapshots
-                if withUUID is True:
-                    subvolList.append((subvolName.rstrip("\r"), subvolUUID))
-                else:
-                    subvolList.append(subvolName.rstrip("\r"))
-        logDebug("subvolList: %s" % subvolList)
+        """Returns the destination snapshots, with their received UUID if withUUID is True."""
+        if withUUID is True:
+            subvolList = [(entry["path"], entry["receivedUUID"]) for entry in self.destInventory.entries()]
+        else:
+            subvolList = [entry["path"] for entry in self.destInventory.entries()]
+        logDebug("subvolList: %s", subvolList)
         return subvolList
 
+    def destSubvolNames(self):
+        return set(entry["name"] for entry in self.destInventory.entries())
+
     def destNewestSnapshot(self):
-        subvolSplitTsList = self.subvolSplitTsList(self.destSubvolList(withUUID=False))
-        logDebug("subvolSplitTsList is: %s" % subvolSplitTsList)
-        destNewestTs = subvolSplitTsList[-1:][0]  # Which return value is sorted.
-        logDebug("destNewestTs is: %s" % destNewestTs)
+        newest = self.destInventory.newest()
+        destNewestTs = newest["ts"] if newest is not None else None
+        logDebug("destNewestTs is: %s", destNewestTs)
         return destNewestTs
 
+    def deleteSubvols(self, transport, container, inventory, names):
+        """Deletes the snapshots names in container with as few `btrfs subvol delete` calls as possible.
+
+        Runs batches of at most deleteBatch snapshots, with --commit-after or --commit-each as set by deleteCommit,
+        through transport, or on the client if transport is None. Every batch is attempted even if an earlier one
+        failed. Logs one line per snapshot, removes the deleted ones from inventory unless it is None and returns the
+        lists of deleted and failed names.
+        """
+        commitFlags = {"after": ["--commit-after"], "each": ["--commit-each"]}.get(self.deleteCommit, [])
+        deleted = []
+        failed = []
+        for start in range(0, len(names), self.deleteBatch):
+            batch = names[start:start + self.deleteBatch]
+            cmd = ["sudo", "btrfs", "subvol", "delete"] + commitFlags + ["%s%s" % (container, name) for name in batch]
+            result = self.command(cmd) if transport is None else transport.run([cmd], self.commandTimeout)[0]
+            out, err = result.stdout, result.stderr
+            logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+            # btrfs prints "Delete subvolume (...): '<path>'" for every subvolume it removed.
+            confirmations = [row for row in out.decode("latin-1").splitlines() if row.startswith("Delete subvolume")]
+            for name in batch:
+                path = "%s%s" % (container, name)
+                if any(row.rstrip("\r").endswith("'%s'" % path) for row in confirmations) or \
+                        (result.returncode == 0 and not confirmations):
+                    deleted.append(name)
+                    if inventory is not None:
+                        inventory.remove(name)
+                    logWarning("Deleted %s", path)
+                else:
+                    failed.append(name)
+                    logError("Failed to delete %s", path)
+        return deleted, failed
+
+    def destDeleteSubvols(self, names):
+        return self.deleteSubvols(self.transport, self.destContainer, self.destInventory, names)
+
     def destDeleteSubvol(self, subvolume):
         subvolume = os.path.basename(os.path.normpath(subvolume))
-        p1 = Popen(self.sshArgs + ["sudo", "btrfs", "subvol", "delete", "%s%s" % (self.destContainer, subvolume)],
-                   stdout=PIPE)
-        out, err = p1.communicate()
-        logDebug("subprocess output: %s \nsubprocess error: %s" % (out, err))
-        if p1.returncode != 0:
+        result = self.destCommand(["sudo", "btrfs", "subvol", "delete", "%s%s" % (self.destContainer, subvolume)])
+        out, err = result.stdout, result.stderr
+        logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+        if result.returncode != 0:
             logError("Subprocess returncode != 0 for destDeleteSubvol() method. Exiting Backup.")
             sendmail("error", "Bytterfs", "Subprocess returncode != 0 for destDeleteSubvol() method. Exiting Backup")
             exit(0)
-        logWarning("destDeleteSubvol: Deleted: %s" % subvolume)
+        self.destInventory.remove(subvolume)
+        logWarning("destDeleteSubvol: Deleted: %s", subvolume)
+
+    def destRetentionPlan(self):
+        return self.retention.plan(self.destInventory.timestamps())
 
     def destKeepSnapshots(self):
         ''' Makes sure, that only a maximum number of snapshots are kept on backup server. Runs after backup. '''
-        keepList = self.keep.split(",")
-        timeKeepTupelList = []
-        seconds = None
-        for element in keepList:
-            match = re.search("([0-9]+)([m|w])=([0-9]+)", element)
-            if match.group(2) == "w":
-                seconds = int(match.group(1))*7*24*60*60
-            elif match.group(2) == "m":
-                seconds = int(match.group(1))*30*24*60*60
-            else:
-                logError("Syntax of keep parameter wrong. Valid parameters 'w' or 'm' not found.")
-                sendmail("error", "bytterfs", "Syntax of keep parameter wrong. Valid parameters 'w' or 'm' not found.")
+        with self.timer.phase("prune"):
+            plan = self.destRetentionPlan()
+            deletionList = []
+            for ts in plan.delete:
+                logInfo("Deleting this snapshot: %s_%s", self.snapshotName, ts)
+                deletionList.append("%s_%s" % (self.snapshotName, ts))
+            deleted, failed = self.destDeleteSubvols(deletionList)
+            if failed:
+                logError("Could not delete %s of %s expired snapshots on destination. Exiting Backup.", len(failed),
+                         len(deletionList))
+                sendmail("error", "Bytterfs", "Could not delete expired snapshots on destination: %s" %
+                         ", ".join(failed))
                 exit(0)
-            keep = match.group(3)
-            timeKeepTupelList.append((seconds, keep))
-        logDebug("timeKeepTupelList: %s" % timeKeepTupelList)
-        destTsList = self.subvolSplitTsList(self.destSubvolList(withUUID=False))
-        currentTs = time.time()
-        tsKeepTupeldict = defaultdict(list)  # easier to append elements to key
-        logDebug("tsList: %s" % destTsList)
-        for ts in destTsList:
-            for index, element in enumerate(timeKeepTupelList, start=0):
-                deltaTs = currentTs - int(ts)
-                seconds = element[0]
-                if index == 0:
-                    if deltaTs < int(seconds):
-                        tsKeepTupeldict[seconds].append(ts)
-                    continue
-                if deltaTs > int(timeKeepTupelList[index - 1][0]) and deltaTs < int(seconds):
-                    tsKeepTupeldict[seconds].append(ts)
-        for sec, keep in timeKeepTupelList:
-            for key in tsKeepTupeldict:
-                if sec == key and len(tsKeepTupeldict[key]) > int(keep):
-                    tsListToBeRemoved = list(evenSpread(tsKeepTupeldict[key], len(tsKeepTupeldict[key])-int(keep)))
-                    for ts in tsListToBeRemoved:
-                        logInfo("Deleting this snapshot: %s_%s" % (self.snapshotName, ts))
-                        self.destDeleteSubvol("%s_%s" % (self.snapshotName, ts))
-        return True
+            return True
+
+    def startPrune(self, snapshot, parent=None):
+        """With overlapPrune, starts a PruneWorker that deletes the destination snapshots the retention policy drops
+        before the send while snapshot is sent. They are decided up front and never include the parent, which the
+        destination needs to receive the stream. Whatever only becomes due with the new snapshot is left to
+        destKeepSnapshots() after the transfer, and the client is only cleaned up once the transfer succeeded, as
+        in the serial order. Returns the worker or None."""
+        if not self.overlapPrune:
+            return None
+        keep = set([snapshot, parent])
+        destNames = [name for name in ("%s_%s" % (self.snapshotName, ts) for ts in self.destRetentionPlan().delete)
+                     if name not in keep]
+        logInfo("Deleting %s destination snapshots while sending %s.", len(destNames), snapshot)
+        pruner = PruneWorker(self, [("destination", self.transport, self.destContainer, destNames, "prune")])
+        pruner.start()
+        return pruner
+
+    def finishPrune(self, pruner, inventories=None):
+        """Waits for the PruneWorker of startPrune(), if any, and takes its deletions into the inventories, by label
+        of the deletion. Returns "container+name" of every snapshot that could not be deleted."""
+        if pruner is None:
+            return []
+        pruner.join()
+        for name, seconds in pruner.timer.seconds.items():
+            self.timer.seconds[name] += seconds
+        inventories = inventories or {"destination": self.destInventory}
+        for label, container, names in pruner.deleted:
+            for name in names:
+                inventories[label].remove(name)
+        failed = ["%s%s" % (container, name) for label, container, names in pruner.failed for name in names]
+        if pruner.error is not None:
+            failed.append(str(pruner.error))
+        return failed
+
+    def reportPruneFailures(self, failed):
+        """Fails the run with one mail for all deletions of the PruneWorker that went wrong."""
+        if not failed:
+            return
+        logError("Could not delete %s snapshots while sending. Exiting Backup.", len(failed))
+        sendmail("error", "Bytterfs", "Could not delete snapshots while sending: %s" % ", ".join(failed))
+        exit(0)
+
+    def destHasContainerCmd(self):
+        return ["sudo", "btrfs", "subvol", "list", "-o", self.destRootSubvol]
 
-    def destHasContainer(self):
-        p1 = Popen(self.sshArgs + ["sudo", "btrfs", "subvol", "list", "-o", self.destRootSubvol], stdout=PIPE)
-        out, err = p1.communicate()
-        logDebug("destContainer stripped path: %s" % self.destContainer.replace(self.destRootSubvol, "").rstrip("/"))
-        if not self.destContainer.replace(self.destRootSubvol, "").rstrip("/") in out.decode("utf-8"):
+    def destHasContainer(self, result=None):
+        if self.containerChecked:
+            return
+        if result is None:
+            result = self.destCommand(self.destHasContainerCmd())
+        if not hasContainer(result, self.destRootSubvol, self.destContainer):
             logError("Specified destination subvolume container does not seem to exist. Exiting.")
             sendmail("error", "Bytterfs", "Specified destination subvolume container does not seem to exist. Exiting.")
             exit(0)
+        self.containerChecked = True
 
     def destHasSnapshot(self, clientInfo):
         """Checks if Snapshot is also present on target dest by comparing UUID of snapshot to 'sent UUIDs' on dest."""
-        destSubvolList = self.destSubvolList(withUUID=True)
-        logDebug("clientInfo is: %s" % clientInfo)
-        for destSubvol in destSubvolList:
-            if "-" in clientInfo:
-                logDebug("clientInfo seems to contain UUID.")
-                clientUUID = clientInfo
-                for subvol in destSubvolList:
-                    if clientUUID in subvol[1]:
-                        logInfo("Last Snapshot is both on dest and client. Beginning increm. backup with send -p.")
-                        return True
-            elif is_number(clientInfo):
-                logDebug("clientInfo seems to be a number (timestamp).")
-                ts = clientInfo
-                for subvol in destSubvolList:
-                    logDebug("subvol in destSubVolList: %s\nChecking if ts %s in subvol. type(ts): %s"
-                             % (subvol, ts, type(ts)))
-                    if ts in subvol[0]:
-                        logInfo("Last Snapshot is both on dest and client. Beginning increm. backup with send -p.")
-                        return True
+        logDebug("clientInfo is: %s", clientInfo)
+        if clientInfo is None:
+            found = None
+        elif "-" in clientInfo:
+            logDebug("clientInfo seems to contain UUID.")
+            found = self.destInventory.findReceivedUUID(clientInfo)
+        elif is_number(clientInfo):
+            logDebug("clientInfo seems to be a number (timestamp).")
+            found = self.destInventory.findTs(clientInfo)
+        else:
+            found = None
+        if found is not None:
+            logInfo("Last Snapshot is both on dest and client. Beginning increm. backup with send -p.")
+            return True
         logError("Last Snapshot is not on dest. Backup will continue and send missing snapshot "
                  "without `btrfs send -p` switch.")
         return False
 
-    def destDevPath(self):
-        p1 = Popen(["df", "-k", self.destRootSubvol], stdout=PIPE)
-        out, err = p1.communicate()
-        if p1.returncode != 0:
-            logError("Subprocess returncode != 0 for destDevPath() method. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for destDevPath() method. Exiting Backup.")
-            sys.exit(0)
-        splitRows = out.decode('latin-1').split("\n")
-        destDevPath = None
-        for row in splitRows:
-            if "/dev/" in row and "%" in row:
-                line = row.split(" ")
-                destDevPath = line[0]
-        if destDevPath is None:
-            logError("Didn't find destDevPath for %s" % self.destRootSubvol)
-            sendmail("error", "Bytterfs", "Didn't find destDevPath for %s" % self.destRootSubvol)
-            sys.exit(0)
-        else:
-            return destDevPath
-
-    def destSubvolID(self):
-        container = os.path.abspath(self.destContainer)
-        logDebug("container is:" + container)
-        strippedContainer = os.path.relpath(os.path.dirname(self.destContainer), os.path.dirname(self.destRootSubvol))
-        logDebug("stripedContainer is:" + strippedContainer)
-        p1 = Popen(["sudo", "btrfs", "sub", "list", self.destRootSubvol], stdout=PIPE)
-        out, err = p1.communicate()
-        if p1.returncode != 0:
-            logError("Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sys.exit(0)
-        splitRows = out.decode('latin-1').split("\n")
-        subvolID = None
-        for row in splitRows:
-            subvolCols = list()
-            for col in row.split(" "):
-                subvolCols.append(col)
-            logDebug("join(subvolCols[8:]) is: %s" % "".join(subvolCols[8:]))
-            if strippedContainer == "".join(subvolCols[8:]):
-                try:
-                    subvolID = subvolCols[1]
-                    logDebug(subvolID)
-                    break
-                except:
-                    pass
-        if subvolID is None:
-            logError("Didn't find subvolID for %s" % strippedContainer)
-            sendmail("error", "Bytterfs", "Didn't find subvolID for %s" % strippedContainer)
+    def destUmount(self):
+        """Releases the shared top level mount of a local backup, which unmounts it once no other job uses it."""
+        if self.warm:
+            return  # The daemon keeps the destination mounted between runs, close() unmounts it.
+        if self.sharedMount is not None and not self.sharedMount.release(self.command):
+            logError("Subprocess returncode != 0 for destUmount() method. Exiting Backup.")
+            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for destUmount() method. Exiting Backup.")
             sys.exit(0)
-        else:
-            logDebug(subvolID)
-            return subvolID
-
-    def destMountSubvol(self, devPath, localMntpoint):
-        path = os.path.abspath(localMntpoint)
-        logDebug("%s %s" % (devPath, localMntpoint))
-        if os.path.ismount(path):
-            logError("localMntpoint is already mounted. Trying to unmount.")
+
+    def run(self):
+        """Performs backup run."""
+        logInfo("Source entered: %s", self.source)
+        logInfo("destContainer entered: %s", self.destContainer)
+        logInfo('Preparing environment')
+        self.completed = False
+        self.sentBytes = None
+        self.fallbackParent = False
+        self.streamHash = None
+        self.deferred = False
+        self.plannedBytes = None
+        self.transferSeconds = None
+        self.bwLimit = self.configuredBwLimit
+        self.timer = PhaseTimer()
+        self.runInfo = {}
+        self.clones = []
+        for clone in self.cloneSources:
+            clone.invalidate()  # The sibling jobs run in between, so their snapshots are listed again every run.
+        started = time.time()
+        listingSeconds = self.listingSeconds()
+        try:
+            self.runBackup()
+        finally:
+            logDebug("btrfs subvol list runs: client %s, destination %s", self.clientInventory.listings,
+                     self.destInventory.listings)
+            for mirror in self.mirrors:
+                logDebug("btrfs subvol list runs on %s: %s", mirror.name, mirror.inventory.listings)
+            self.recordHistory(started, self.listingSeconds() - listingSeconds)
+            if not self.warm:
+                self.close()
+
+    def listingSeconds(self):
+        """Seconds all inventories spent listing on their own so far, i.e. outside of prefetch()."""
+        return self.clientInventory.seconds + self.destInventory.seconds + sum(mirror.inventory.seconds
+                                                                               for mirror in self.mirrors)
+
+    def recordHistory(self, started, listingSeconds):
+        """Adds the run that began at started to the run history. A history that can't be written only warns."""
+        if self.dryRun:
+            return
+        row = dict(self.runInfo, job=self.snapshotName, started=started, duration=time.time() - started,
+                   status="ok" if self.completed else "deferred" if self.deferred else "failed",
+                   bytes=self.sentBytes if self.sentBytes is not None else self.plannedBytes)
+        for phase in RUN_PHASES:
+            row["%sSeconds" % phase] = round(self.timer.seconds.get(phase, 0.0), 3)
+        row["listingSeconds"] = round(row["listingSeconds"] + listingSeconds, 3)
+        try:
+            self.history.record(row)
+        except Exception as e:  # Runs from the finally of run(): neither sqlite3 nor the file may mask its outcome.
+            logWarning("Could not record the run in %s: %s", self.history.path, e)
+
+    def close(self):
+        """Closes the transports and releases the local destination mount if a warm or failed run still holds it."""
+        self.transport.close()
+        for mirror in self.mirrors:
+            mirror.transport.close()
+        if self.sharedMount is not None and self.sharedMount.path is not None:
+            self.warm = False
+            self.localPrepared = False
             self.destUmount()
-        p1 = Popen(["sudo", "mount", "-t", "btrfs", "-o", "subvolid=0", devPath, localMntpoint], stdout=PIPE)
-        out, err = p1.communicate()
-        if p1.returncode != 0:
-            logError("Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sys.exit(0)
-        return True
 
-    def destUmount(self):
-        if self.sshHost == None or self.sshPort == None or self.sshKey == None:
-            localMntpoint = "%s%s" % ("/mnt/bytterfs/", self.snapshotName)
-            logDebug("Umounting %s" % (localMntpoint))
-            p1 = Popen(["sudo", "umount", localMntpoint], stdout=PIPE)
-            out, err = p1.communicate()
-            if p1.returncode != 0:
-                logError("Subprocess returncode != 0 for destUmount() method. Exiting Backup.")
-                sendmail("error", "Bytterfs", "Subprocess returncode != 0 for destUmount() method. Exiting Backup.")
-                sys.exit(0)
-            logDebug(out.decode('utf-8'))
+    def verify(self, clean=False):
+        """Checks the manifests of the destination and all mirrors. Returns [(destination name, report)]."""
+        reports = []
+        mounted = False
+        try:
+            if self.sshHost == None or self.sshPort == None or self.sshKey == None:
+                mounted = self.prepareLocal()
+                if not mounted:
+                    raise OSError("could not mount the destination of %s" % self.snapshotName)
+            for destination in [self.primaryDestination()] + self.mirrors:
+                manifestContainer = self.destPaths[1] if destination.transport is self.transport else None
+                reports.append((destination.name, verifyManifests(
+                    destination.transport, self.snapshotName, destination.destContainer, self.manifestDir,
+                    self.commandTimeout, clean, manifestContainer)))
+        finally:
+            self.close()
+            if mounted:
+                self.destUmount()
+        return reports
 
-    def destMountedContainerPath(self, localMntpoint, subvolID):
-        p1 = Popen(["sudo", "btrfs", "sub", "list", localMntpoint], stdout=PIPE)
-        out, err = p1.communicate()
-        if p1.returncode != 0:
-            logError("Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sendmail("error", "Bytterfs", "Subprocess returncode != 0 for mountSubvol() method. Exiting Backup.")
-            sys.exit(0)
-        splitRows = out.decode('latin-1').split("\n")
-        destMountedContainerPath = None
-        col = list()
-        for row in splitRows:
-            cols = row.split(" ")
-            logDebug("cols: %s" % cols)
-            if cols[1] == subvolID:
-                logDebug(cols[1])
-                destMountedContainerPath = "".join(cols[8:])
-                break
-        logDebug(destMountedContainerPath)
-        if destMountedContainerPath:
-            return destMountedContainerPath
+    def primaryDestination(self):
+        return Destination("%s:%s" % (self.sshHost, self.destContainer), self.transport, self.destRootSubvol,
+                           self.destContainer, self.destInventory)
+
+    def pruneDestination(self, destination):
+        """Applies the retention policy to one destination. Returns the names it failed to delete."""
+        with self.timer.phase("prune"):
+            plan = self.retention.plan(destination.inventory.timestamps())
+            names = ["%s_%s" % (self.snapshotName, ts) for ts in plan.delete]
+            deleted, failed = self.deleteSubvols(destination.transport, destination.destContainer,
+                                                 destination.inventory, names)
+            if failed:
+                logError("Could not delete %s of %s expired snapshots on %s.", len(failed), len(names),
+                         destination.name)
+            return failed
+
+    def fanOutTransfer(self, sendCmd, destinations):
+        """Tees one run of sendCmd into `btrfs receive` on every destination. Returns (out, err, returncode) each.
+
+        The stream is compressed once if compression is enabled. Every destination gets a queue of at most
+        mirrorBuffer bytes; one that fails or stalls is dropped without holding up the others.
+        """
+        start = time.time()
+        p1 = Popen(sendCmd, stdout=PIPE)
+        stages = [p1]
+        compressor = self.compressor
+        sample = b""
+        if self.compress == "auto":
+            sample = readSample(p1.stdout, AUTO_COMPRESS_SAMPLE)
+            compressor = chooseCompressor(sample, self.compressLevel, self.compressThreads)
+        relay = None
+        source = p1.stdout
+        hasher = self.startHasher()
+        observers = [hasher.update] if hasher is not None else []
+        if compressor is not None:
+            pc = Popen(compressor.compressCmd(), stdin=PIPE, stdout=PIPE)
+            stages.append(pc)
+            relay = StreamRelay(p1.stdout, pc.stdin, prefix=sample, observers=observers)  # Hash before compression.
+            observers = []
+            relay.start()
+            source = pc.stdout
+            sample = b""
+        bufferSize = 1024 * 1024
+        sinks = []
+        for destination in destinations:
+            receiveCmd = ["sudo", "btrfs", "receive", destination.destContainer]
+            if compressor is None:
+                cmd = destination.transport.wrap(receiveCmd)
+            else:
+                cmd = destination.transport.wrapShell("%s | %s" % (
+                    " ".join(map(shlex.quote, compressor.decompressCmd())), " ".join(map(shlex.quote, receiveCmd))))
+            sinks.append(FanOutSink(destination.name, Popen(cmd, stdin=PIPE, stdout=PIPE),
+                                    self.mirrorBuffer // bufferSize))
+        fanOut = StreamFanOut(source, sinks, prefix=sample, bufferSize=bufferSize,
+                              progress=TransferProgress(self.snapshotName, self.progressInterval, self.statusFile),
+                              limiter=RateLimiter(self.bwLimit, self.bwSchedule) if self.bwLimit or self.bwSchedule
+                              else None, observers=observers)
+        fanOut.run()
+        if relay is not None:
+            relay.join()
+        self.finishHasher(hasher)
+        stageFailed = False
+        for stage in stages:
+            stage.wait()
+            stageFailed = stageFailed or stage.returncode != 0
+        stageFailed = stageFailed or fanOut.error is not None or (relay is not None and relay.error is not None)
+        fanOut.progress.finish(1 if stageFailed else 0)
+        results = []
+        for sink in sinks:
+            out = sink.process.stdout.read()
+            sink.process.wait()
+            failed = stageFailed or sink.dropped or sink.error is not None
+            results.append((out, None, sink.process.returncode or (1 if failed else 0)))
+        elapsed = max(time.time() - start, 0.001)
+        self.sentBytes = fanOut.bytes
+        logInfo("Sent %s bytes%s to %s destination(s) in %.1fs (%.1f MB/s).", fanOut.bytes,
+                " of %s" % compressor.name if compressor is not None else "", len(sinks), elapsed,
+                fanOut.bytes / elapsed / 1e6)
+        return results
+
+    def fanOutBackup(self):
+        """Backs up to the destination and all mirrors from one new snapshot.
+
+        Each destination gets its own parent (its newest common snapshot) and retention. Destinations sharing a
+        parent are fed from one `btrfs send`, so with all destinations in sync the source is read once. Recovery,
+        --fullEvery, send planning and --overlapPrune work as for a single destination; clone sources are only
+        passed to a send that goes to the primary destination alone, the only one that holds the sibling jobs.
+        """
+        destinations = [self.primaryDestination()] + self.mirrors
+
+        def checkContainer(destination):
+            def consumer(result):
+                if not destination.hasContainer(result):
+                    logError("Destination container %s does not seem to exist. Exiting.", destination.name)
+                    sendmail("error", "Bytterfs", "Destination container %s does not seem to exist." %
+                             destination.name)
+                    exit(0)
+            return consumer
+        queries = [(destination.transport, destination.hasContainerCmd(), checkContainer(destination))
+                   for destination in destinations]
+        queries += [(destination.transport, destination.inventory.listCmd(), destination.inventory.load)
+                    for destination in destinations if not destination.inventory.loaded]
+        if not self.clientInventory.loaded:
+            queries.append((None, self.clientInventory.listCmd(), self.clientInventory.load))
+        for clone in self.cloneSources:
+            queries.append((None, clone.clientInventory.listCmd(), clone.clientInventory.load))
+            queries.append((self.transport, clone.destInventory.listCmd(), clone.destInventory.load))
+        self.prefetch(queries)
+        if self.dryRun:
+            for destination in destinations:
+                print("%s:" % destination.name)
+                for line in self.retention.plan(destination.inventory.timestamps()).describe(self.snapshotName):
+                    print(line)
+            self.completed = True
+            exit(0)
+        recovering = os.path.isfile(self.lockfile)
+        if recovering:
+            self.fanOutRecover(destinations)
+        fullSend = bool(self.fullEvery) and self.state.chainLength >= self.fullEvery
+        if fullSend:
+            logInfo("%s incrementals were sent since the last full send. Sending a fresh full stream to all "
+                    "destinations (--fullEvery %s).", self.state.chainLength, self.fullEvery)
+        groups = defaultdict(list)  # Parent snapshot name, None for a full send -> destinations.
+        for destination in destinations:
+            parent = None if fullSend else self.commonParent(destination.inventory)
+            groups[parent["name"] if parent is not None else None].append(destination)
+        # The biggest stream decides: a full one if any destination needs it, else the one from the oldest parent.
+        planParent = None if None in groups else min((self.clientInventory.find(name) for name in groups),
+                                                     key=lambda entry: int(entry["ts"]))
+        if not self.planSend(planParent, defer=not recovering):  # Like isLockfile(), a recovery is not postponed.
+            self.deferRun()
+        if not self.overlapPrune:
+            for destination in destinations:
+                self.pruneDestination(destination)
+        newSnapshot = os.path.basename(self.clientCreateSnapshot())
+        self.runInfo.update(snapshot=newSnapshot, uuid=(self.clientInventory.find(newSnapshot) or {}).get("uuid"))
+        if len(groups) == 1:
+            parent = next(iter(groups))
+            self.runInfo.update(mode="incremental" if parent else "full", parent=parent,
+                                parentUUID=(self.clientInventory.find(parent) or {}).get("uuid") if parent else None)
         else:
-            logError("Didn't find subvolID %s in localMntpoint: %s" % (subvolID, localMntpoint))
-            sendmail("error", "Bytterfs", "Didn't find subvolID %s in localMntpoint: %s" % (subvolID, localMntpoint))
+            self.runInfo.update(mode="mixed")
+        with open(self.lockfile, "w") as f:
+            f.write(newSnapshot)  # Names the snapshot that fanOutRecover() deletes where it is incomplete.
+        pruner = self.startFanOutPrune(destinations, newSnapshot, groups)
+        failed = []
+        leftovers = []  # Destinations where the incomplete newSnapshot could not be deleted.
+        keepParents = set()
+        sentBytes = 0
+        start = time.time()
+        try:
+            for parent, group in groups.items():
+                cloneArgs = self.cloneArgs() if group == destinations[:1] else []
+                sendCmd = ["sudo", "btrfs", "send"] + (["-p", "%s%s" % (self.source, parent)] if parent else []) + \
+                    cloneArgs + ["%s%s" % (self.source, newSnapshot)]
+                logInfo("Sending %s %s to %s.", newSnapshot, "incrementally from %s" % parent if parent else "in full",
+                        ", ".join(destination.name for destination in group))
+                with self.timer.phase("transfer"):
+                    results = self.fanOutTransfer(sendCmd, group)
+                sentBytes += self.sentBytes or 0
+                if cloneArgs:
+                    self.logCloneSavings(newSnapshot, self.clientInventory.find(parent) if parent else None)
+                for destination, (out, err, returncode) in zip(group, results):
+                    logDebug("subprocess output: %s \nsubprocess error: %s", out, err)
+                    destination.inventory.invalidate()
+                    if returncode == 0:
+                        self.writeManifest(destination.transport, destination.destContainer, newSnapshot, parent)
+                        continue
+                    logError("Sending %s to %s failed. Output:%s", newSnapshot, destination.name, out)
+                    failed.append(destination.name)
+                    if parent:
+                        keepParents.add(parent)  # Still the common snapshot for the next run.
+                    if destination.inventory.findTs(newSnapshot.rpartition("_")[2]) is not None:
+                        if self.deleteSubvols(destination.transport, destination.destContainer,
+                                              destination.inventory, [newSnapshot])[1]:
+                            leftovers.append(destination.name)
+        finally:
+            self.transferSeconds = time.time() - start
+            pruneFailed = self.finishPrune(pruner, dict([(destination.name, destination.inventory)
+                                                         for destination in destinations]))
+        os.remove(self.lockfile)
+        self.sentBytes = sentBytes
+        if len(failed) < len(destinations):
+            self.recordSend(full=list(groups) == [None])
+        self.reportPruneFailures(pruneFailed)
+        for destination in destinations:
+            if destination.name not in failed:
+                self.pruneDestination(destination)  # What only became due with the new snapshot.
+        older = [entry["name"] for entry in self.clientInventory.entries()
+                 if entry["name"] != newSnapshot and entry["name"] not in keepParents]
+        deleted, cleanupFailed = self.deleteSubvols(None, self.source, self.clientInventory, older)
+        if cleanupFailed:
+            logError("Error when deleting older snapshots on client. Exiting Backup.")
+        if failed:
+            message = "Backup %s failed for: %s" % (newSnapshot, ", ".join(failed))
+            if leftovers:
+                message += "\nCould not delete the incomplete %s on: %s" % (newSnapshot, ", ".join(leftovers))
+            if cleanupFailed:
+                message += "\nError when deleting older snapshots on client: %s" % ", ".join(cleanupFailed)
+            sendmail("error", "Bytterfs", message)
+            exit(0)
+        if cleanupFailed:
+            sendmail("error", "Bytterfs", "Error when deleting older snapshots on client: %s" %
+                     ", ".join(cleanupFailed))
+            exit(0)
+        logInfo("Backup %s created successfully on %s destinations", self.snapshotName, len(destinations))
+        self.completed = True
+        exit(0)
+
+    def fanOutRecover(self, destinations):
+        """Deletes what an interrupted fan-out run left: the snapshot named in the lockfile, on every destination
+        where its receive did not complete. Snapshots the run did not send, e.g. made by hand, are kept."""
+        with open(self.lockfile) as f:
+            partial = f.read().strip()
+        if not partial:  # Left by a run of an older version, which sent the newest client snapshot.
+            newest = self.clientInventory.newest()
+            partial = newest["name"] if newest is not None else None
+        logError("Lockfile found. Last backup was interrupted. Deleting %s where it is incomplete.", partial)
+        sendmail("error", "Bytterfs", "Lockfile found. Deleting possible left over on the destinations and "
+                 "continuing with backup. See local syslog for more details.")
+        for destination in destinations:
+            entry = destination.inventory.find(partial) if partial else None
+            if entry is not None and entry["receivedUUID"] is None:  # A receive sets it only once it completed.
+                self.deleteSubvols(destination.transport, destination.destContainer, destination.inventory,
+                                   [partial])
+        os.remove(self.lockfile)
+
+    def startFanOutPrune(self, destinations, snapshot, groups):
+        """startPrune() for a fan-out: the expired snapshots of every destination other than the parents of the sends
+        are deleted while snapshot is sent. Returns the worker or None."""
+        if not self.overlapPrune:
+            return None
+        keep = set([snapshot]) | set(groups)
+        deletions = []
+        for destination in destinations:
+            names = [name for name in ("%s_%s" % (self.snapshotName, ts)
+                                       for ts in self.retention.plan(destination.inventory.timestamps()).delete)
+                     if name not in keep]
+            deletions.append((destination.name, destination.transport, destination.destContainer, names, "prune"))
+        logInfo("Deleting %s destination snapshots while sending %s.", sum(len(deletion[3]) for deletion in deletions),
+                snapshot)
+        pruner = PruneWorker(self, deletions)
+        pruner.start()
+        return pruner
+
+    def dryRunExit(self):
+        """Prints the retention plan of the destination instead of running a backup."""
+        for line in self.destRetentionPlan().describe(self.snapshotName):
+            print(line)
+        self.completed = True
+        self.destUmount()
+        exit(0)
+
+    def prepareLocal(self):
+        """Points destRootSubvol/destContainer into the top level of the local destination filesystem.
+
+        The path of destContainer inside the top level follows from the mount it is on in /proc/self/mountinfo (its
+        mount point and mounted subvolume), so no listing is needed. The top level is a SharedMount named after the
+        filesystem UUID, mounted only if no job did so yet. Returns False if it could not be mounted.
+        """
+        self.destRootSubvol, self.destContainer = self.destPaths
+        self.destInventory.invalidate()
+        mount = findMount(self.destContainer)
+        if mount is None or mount["fsType"] != "btrfs":
+            logError("%s is not on a mounted btrfs filesystem. Exiting Backup.", self.destContainer)
+            sendmail("error", "Bytterfs", "%s is not on a mounted btrfs filesystem." % self.destContainer)
             sys.exit(0)
+        if self.sharedMount is None or self.sharedMount.devNumber != mount["devNumber"]:
+            name = btrfsFsid(mount["mountPoint"]) or "dev-%s" % mount["devNumber"].replace(":", "_")
+            self.sharedMount = SharedMount(name, mount["device"], mount["devNumber"])
+        topLevel = self.sharedMount.acquire(self.command)
+        if topLevel is None:
+            return False
+        relative = os.path.relpath(os.path.realpath(self.destContainer), mount["mountPoint"])
+        self.destRootSubvol = "%s/" % topLevel.rstrip("/")
+        self.destContainer = "%s/" % os.path.normpath(os.path.join(topLevel, mount["root"].lstrip("/"), relative))
+        logDebug("Local destination container in the top level: %s", self.destContainer)
+        self.localPrepared = self.warm
+        return True
 
-    def run(self):
-        """Performs backup run."""
-        logInfo("Source entered: %s" % self.source)
-        logInfo("destContainer entered: %s" % self.destContainer)
-        logInfo('Preparing environment')
+    def archiveBackup(self):
+        """Backs up into the archive directory destContainer.
+
+        The new snapshot is sent incrementally onto the newest chain while the client still has the newest snapshot
+        of that chain and the chain has fewer than fullEvery incrementals, else in full as the start of a new chain.
+        Afterwards the retention policy decides which chains to keep.
+        """
+        store = self.archive
+        fullEvery = self.fullEvery or DEFAULT_ARCHIVE_FULL_EVERY
+        if self.dryRun:
+            kept, deleted = store.plan(self.retention)
+            for action, chains in (("keep", kept), ("delete", deleted)):
+                for chain in chains:
+                    print("%-6s chain %s: %s streams up to %s" % (action, chain[0]["snapshot"], len(chain),
+                                                                 chain[-1]["snapshot"]))
+            self.completed = True
+            exit(0)
+        if os.path.isfile(self.lockfile):
+            logWarning("Lockfile found. The last archive run was interrupted. Its chunks are reused or removed.")
+            os.remove(self.lockfile)
+        chains = store.chains()
+        parent = None
+        if chains:
+            newest = chains[-1][-1]
+            parent = self.clientInventory.findUUID(newest["uuid"]) if newest["uuid"] else None
+            if parent is None:
+                logInfo("The client no longer has %s. Starting a new chain with a full send.", newest["snapshot"])
+            elif len(chains[-1]) > fullEvery:
+                logInfo("Chain %s holds %s incrementals. Starting a new chain with a full send.",
+                        chains[-1][0]["snapshot"], len(chains[-1]) - 1)
+                parent = None
+        newSnapshot = os.path.basename(self.clientCreateSnapshot())
+        entry = self.clientInventory.find(newSnapshot)
+        self.runInfo.update(mode="incremental" if parent else "full", snapshot=newSnapshot, uuid=entry["uuid"],
+                            parent=parent["name"] if parent else None, parentUUID=parent["uuid"] if parent else None)
+        sendCmd = ["sudo", "btrfs", "send"] + (["-p", "%s%s" % (self.source, parent["name"])] if parent else []) + \
+            ["%s%s" % (self.source, newSnapshot)]
+        logInfo("Archiving %s %s into %s.", newSnapshot, "incrementally from %s" % parent["name"] if parent
+                                              else "in full", self.destContainer)
+        touch(self.lockfile)
+        progress = TransferProgress(self.snapshotName, self.progressInterval, self.statusFile)
+        with self.timer.phase("transfer"), store.lock():
+            p1 = Popen(sendCmd, stdout=PIPE)
+            written = store.write(p1.stdout, {"snapshot": newSnapshot, "ts": int(entry["ts"]), "uuid": entry["uuid"],
+                                              "parent": parent["name"] if parent else None,
+                                              "parentUUID": parent["uuid"] if parent else None}, progress)
+            if written is None:
+                p1.kill()
+            p1.stdout.close()
+            p1.wait()
+            returncode = p1.returncode if written is not None else 1
+            progress.finish(returncode)
+            if returncode != 0:
+                logError("Error when archiving %s. Sending Mail and exiting.", newSnapshot)
+                sendmail("error", "Bytterfs", "Error when archiving %s into %s." % (newSnapshot, self.destContainer))
+                exit(0)
+            store.commit(written)
+        os.remove(self.lockfile)
+        self.sentBytes = written["bytes"]
+        with self.timer.phase("prune"):
+            kept, deleted = store.plan(self.retention)
+            for chain in deleted:
+                store.delete(chain)
+            store.collectGarbage()
+        logInfo('clientDeleteOlderSnapshots()')
+        self.clientDeleteOlderSnapshots()
+        logInfo('Backup %s created successfully', self.snapshotName)
+        self.completed = True
+        exit(0)
+
+    def runBackup(self):
+        """Prepares the destination and runs the backup. Called by run(), which closes the transport afterwards."""
+        if self.archive is not None:
+            self.archiveBackup()
         if self.sshHost == None or self.sshPort == None or self.sshKey == None:
-            localMntpoint = "%s%s" % ("/mnt/bytterfs/", self.snapshotName)
-            mkdir_p(localMntpoint)
-            devPath = self.destDevPath()
-            if self.destMountSubvol(devPath, localMntpoint):
-                destRelMountedContainerPath = self.destMountedContainerPath(localMntpoint, self.destSubvolID())
-                self.destRootSubvol = "%s/" % localMntpoint
-                destAbsMountedCountainerPath = os.path.join(localMntpoint, destRelMountedContainerPath)
-                self.destContainer = "%s/" % destAbsMountedCountainerPath
+            if self.localPrepared and not os.path.ismount(self.destRootSubvol):
+                self.localPrepared = False  # Unmounted behind our back since the last warm run.
+                self.sharedMount.release(self.command)
+            if self.localPrepared or self.prepareLocal():
+                if self.dryRun:
+                    self.dryRunExit()
                 self.isLockfile()
-                self.destKeepSnapshots()
+                if not self.overlapPrune:
+                    self.destKeepSnapshots()
                 logInfo('initiateBackup() locally.')
                 self.initiateBackup()
             else:
                 sys.exit(0)
+        if self.mirrors:
+            self.fanOutBackup()
+        self.prefetchRemote()
         self.destHasContainer()
+        if self.dryRun:
+            self.dryRunExit()
         self.isLockfile()
-        self.destKeepSnapshots()
+        if not self.overlapPrune:
+            self.destKeepSnapshots()  # With overlapPrune, a PruneWorker does this during the transfer.
         logInfo('initiateBackup()')
         self.initiateBackup()
 
 
-#### Main
-logger = logging.getLogger()  # Initializing Logger
-logger.addHandler(ColoredConsoleHandler())
-log_syslog_handler = logging.handlers.SysLogHandler('/dev/log')  # /dev/log is the socket to log to syslog
-log_syslog_handler.setFormatter(logging.Formatter(app_name + '[%(process)d] %(message)s'))
-logger.addHandler(log_syslog_handler)  # Add SysLogHandler
-logger.info('%s v%s by %s' % (app_name, __version__, __author__))
-
-try:
+# Optional Bytterfs settings accepted both as command line option and as config file key, with their type.
+JOB_OPTIONS = {"compress": checkCompress, "compressLevel": int, "compressThreads": int, "relay": bool,
+               "progressInterval": float, "statusFile": str, "bwLimit": checkRate, "bwSchedule": checkBwSchedule,
+               "spool": checkPath, "remoteSpool": checkPath, "spoolChunkSize": checkRate, "deleteBatch": int,
+               "deleteCommit": checkDeleteCommit, "dryRun": bool, "mirrors": checkMirrors, "mirrorBuffer": checkRate,
+               "commandTimeout": float, "agent": bool, "buffer": checkRate, "bufferWatermarks": checkWatermarks,
+               "bufferDir": str, "checksum": bool, "manifestDir": str, "archive": bool, "archiveChunkSize": checkRate,
+               "archiveWriters": int, "fullEvery": int, "maxDuration": checkDuration, "oversize": checkOversize,
+               "stateDir": checkPath, "stateFile": str, "historyDb": str, "overlapPrune": bool,
+               "cloneSources": checkCloneSources}
+
+
+def jobOptionsFromSection(section):
+    options = {}
+    for key, kind in JOB_OPTIONS.items():
+        if key not in section:
+            options[key] = None
+        elif kind is bool:
+            options[key] = section.getboolean(key)
+        else:
+            options[key] = kind(section[key])
+    return options
+
+
+class BackupJob:
+    """One snapshotName/source/destContainer triple of a config file, as run by the JobScheduler."""
+
+    def __init__(self, name, options, priority=0):
+        self.name = name
+        self.options = options
+        self.priority = priority
+        self.status = "pending"
+        self.duration = None
+        self.error = None
+        self.interval = DEFAULT_JOB_INTERVAL  # Daemon mode: seconds between runs, plus up to jitter seconds.
+        self.jitter = 0
+        self.paused = False
+        self.triggered = False  # Daemon mode: triggered while running, so run again as soon as this run is done.
+        self.nextRun = None
+        self.lastRun = None
+        self.runs = 0
+        self.failures = 0
+        self.warm = False  # Keep the Bytterfs instance of a successful run for the next one.
+        self.cloneSiblings = False  # Use the snapshots of the other jobs to the same destination as clone sources.
+        self.bytterfs = None
+        if options["sshHost"] is None:
+            mount = findMount(options["destRootSubvol"])  # Local jobs contend for the destination disk instead.
+            self.hostKey = "local:%s" % (mount["device"] if mount is not None else options["destRootSubvol"])
+        else:
+            self.hostKey = options["sshHost"].split("@")[-1]
+        mount = findMount(options["source"])
+        self.deviceKey = mount["device"] if mount is not None else options["source"]
+
+    def createBytterfs(self):
+        return Bytterfs(self.name, self.options["source"], self.options["destRootSubvol"],
+                        self.options["destContainer"], self.options["destKeep"], self.options["sshHost"],
+                        self.options["sshPort"], self.options["sshKey"],
+                        **dict((key, self.options.get(key)) for key in JOB_OPTIONS))
+
+    def run(self):
+        bytterfs = self.bytterfs or self.createBytterfs()
+        bytterfs.warm = self.warm
+        start = time.time()
+        try:
+            bytterfs.run()
+        except SystemExit:
+            pass  # Bytterfs ends every run with exit(), successful or not.
+        except Exception:
+            import traceback
+            self.error = traceback.format_exc()
+            logError("Job %s raised:\n%s", self.name, self.error)
+        self.duration = time.time() - start
+        self.status = "ok" if bytterfs.completed else "deferred" if bytterfs.deferred else "failed"
+        self.lastRun = start
+        self.runs += 1
+        if self.status == "failed":
+            self.failures += 1
+        if self.warm and self.status != "failed":
+            self.bytterfs = bytterfs
+        else:
+            self.bytterfs = None  # Start cold after a failure, its state may be stale.
+            if bytterfs.warm:
+                bytterfs.close()
+
+    def close(self):
+        if self.bytterfs is not None:
+            self.bytterfs.close()
+            self.bytterfs = None
+
+    def describe(self):
+        return {"name": self.name, "status": self.status, "paused": self.paused, "runs": self.runs,
+                "failures": self.failures, "lastRun": self.lastRun, "nextRun": self.nextRun,
+                "triggered": self.triggered, "duration": self.duration, "interval": self.interval}
+
+
+def loadJobs(configPath):
+    """Reads a config file into scheduler settings and a list of BackupJobs.
+
+    The [bytterfs] section holds scheduler settings (workers, hostLimit, deviceLimit). Every other section is a job
+    named after its snapshotName with the keys source, destRootSubvol, destContainer, destKeep, sshHost, sshPort,
+    sshKey, local and priority, plus interval and jitter for the daemon. Keys in [DEFAULT] apply to all jobs.
+    cloneSiblings = yes makes the other jobs with the same client filesystem, destination host and destRootSubvol
+    the cloneSources of a job.
+    """
+    import configparser
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str  # Keep the camelCase option names.
+    if not config.read(configPath):
+        raise ArgumentTypeError("Could not read config file %s" % configPath)
+    settings = {"workers": 4, "hostLimit": 1, "deviceLimit": 1}
+    if config.has_section("bytterfs"):
+        for key in settings:
+            settings[key] = config.getint("bytterfs", key, fallback=settings[key])
+    jobs = []
+    for name in config.sections():
+        if name == "bytterfs":
+            continue
+        section = config[name]
+        try:
+            options = {"source": checkPath(section["source"]),
+                       "destRootSubvol": checkPath(section["destRootSubvol"]),
+                       "destContainer": checkPath(section["destContainer"]),
+                       "destKeep": checkTimespan(section["destKeep"]),
+                       "sshHost": section.get("sshHost"), "sshPort": section.get("sshPort"),
+                       "sshKey": section.get("sshKey")}
+            options.update(jobOptionsFromSection(section))
+        except KeyError as e:
+            raise ArgumentTypeError("Job %s in %s is missing option %s" % (name, configPath, e))
+        except (ValueError, ArgumentTypeError) as e:
+            raise ArgumentTypeError("Job %s in %s has an invalid option: %s" % (name, configPath, e))
+        if section.getboolean("local", fallback=False):
+            options["sshHost"] = options["sshPort"] = options["sshKey"] = None
+        elif options["sshHost"] is None or options["sshPort"] is None or options["sshKey"] is None:
+            raise ArgumentTypeError("Job %s in %s is missing SSH parameters and is not local" % (name, configPath))
+        job = BackupJob(name, options, section.getint("priority", fallback=0))
+        try:
+            job.interval = parseInterval(section.get("interval", str(DEFAULT_JOB_INTERVAL)))
+            job.jitter = parseInterval(section.get("jitter", "0"))
+        except ArgumentTypeError as e:
+            raise ArgumentTypeError("Job %s in %s: %s" % (name, configPath, e))
+        job.cloneSiblings = section.getboolean("cloneSiblings", fallback=False)
+        jobs.append(job)
+    for job in jobs:
+        if job.cloneSiblings and not job.options["cloneSources"]:
+            job.options["cloneSources"] = ["%s:%s:%s" % (sibling.name, sibling.options["source"],
+                                                         sibling.options["destContainer"]) for sibling in jobs
+                                           if sibling is not job and sibling.hostKey == job.hostKey and
+                                           sibling.deviceKey == job.deviceKey and
+                                           sibling.options["destRootSubvol"] == job.options["destRootSubvol"]]
+    return settings, jobs
+
+
+class JobScheduler:
+    """Runs BackupJobs on a pool of worker threads.
+
+    Jobs are started in priority order (highest first, then config order), but a job only starts while fewer than
+    hostLimit jobs run against its destination host and fewer than deviceLimit jobs read from its source device.
+    For local jobs the destination device takes the place of the host. Jobs on independent disks and hosts run in
+    parallel; the others wait for a free slot.
+    """
+
+    def __init__(self, jobs, workers=4, hostLimit=1, deviceLimit=1):
+        self.jobs = jobs
+        self.pending = sorted(jobs, key=lambda job: -job.priority)
+        self.workers = max(1, workers)
+        self.hostLimit = max(1, hostLimit)
+        self.deviceLimit = max(1, deviceLimit)
+        self.running = defaultdict(int)
+        self.condition = threading.Condition()
+
+    def nextJob(self):
+        for job in self.pending:
+            if self.running[("host", job.hostKey)] < self.hostLimit and \
+                    self.running[("device", job.deviceKey)] < self.deviceLimit:
+                return job
+        return None
+
+    def finished(self):
+        """True once workers should exit instead of waiting for a job."""
+        return not self.pending
+
+    def jobDone(self, job):
+        """Called with the condition held after a job ran."""
+        pass
+
+    def worker(self):
+        while True:
+            with self.condition:
+                job = self.nextJob()
+                while job is None and not self.finished():
+                    self.condition.wait()
+                    job = self.nextJob()
+                if job is None:
+                    return
+                self.pending.remove(job)
+                self.running[("host", job.hostKey)] += 1
+                self.running[("device", job.deviceKey)] += 1
+                job.status = "running"
+            threading.current_thread().name = job.name  # Log records of this job carry its name.
+            logInfo("Starting job %s (host %s, device %s)", job.name, job.hostKey, job.deviceKey)
+            job.run()
+            with self.condition:
+                self.running[("host", job.hostKey)] -= 1
+                self.running[("device", job.deviceKey)] -= 1
+                self.jobDone(job)
+                self.condition.notify_all()
+
+    def run(self):
+        """Runs all jobs and returns the combined exit status: 0 if every job succeeded, else 1."""
+        threads = [threading.Thread(target=self.worker, name="worker-%s" % i) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report()
+
+    def report(self):
+        failed = [job for job in self.jobs if job.status not in ("ok", "deferred")]
+        for job in self.jobs:
+            message = "Job %-20s %-7s %8.1fs" % (job.name, job.status, job.duration or 0)
+            if job.status in ("ok", "deferred"):
+                logInfo(message)
+            else:
+                logError(message)
+        if failed:
+            sendmail("error", "Bytterfs", "%s of %s backup jobs failed: %s" % (
+                len(failed), len(self.jobs), ", ".join(job.name for job in failed)))
+            return 1
+        logInfo("All %s backup jobs succeeded.", len(self.jobs))
+        return 0
+
+
+DEFAULT_JOB_INTERVAL = 3600
+DEFAULT_CONTROL_SOCKET = "/run/bytterfs.sock"
+INTERVAL_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parseInterval(string):
+    """Parses a duration like 90, 30m, 1h or 7d into seconds."""
+    match = re.match(r"^([0-9]+)([smhd]?)$", string.strip().lower())
+    if match is None:
+        raise ArgumentTypeError("%r is not a duration like 90, 30m, 1h or 7d" % string)
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+class BackupDaemon(JobScheduler):
+    """Runs the jobs of a config file every job.interval seconds until stopped, controlled through a unix socket.
+
+    Runs are spread by a random delay of up to job.jitter seconds and limited per host and device like in the
+    JobScheduler. Jobs are warm: a successful run keeps its transport, inventories and mounts for the next one.
+    The control socket takes one command line per connection and answers with one line of JSON:
+    status, trigger [job], pause [job], resume [job] and stop. Without a job name a command applies to all jobs.
+    A job triggered while it runs starts again right after that run.
+    """
+
+    def __init__(self, jobs, socketPath=DEFAULT_CONTROL_SOCKET, workers=4, hostLimit=1, deviceLimit=1):
+        JobScheduler.__init__(self, jobs, workers, hostLimit, deviceLimit)
+        self.pending = []
+        self.socketPath = socketPath
+        self.stopping = False
+        now = time.time()
+        for job in jobs:
+            job.warm = True
+            job.nextRun = now + random.uniform(0, job.jitter)
+
+    def finished(self):
+        return self.stopping
+
+    def nextJob(self):
+        return None if self.stopping else JobScheduler.nextJob(self)
+
+    def jobDone(self, job):
+        if job.triggered:
+            job.triggered = False
+            job.nextRun = time.time()
+        else:
+            job.nextRun = time.time() + job.interval + random.uniform(0, job.jitter)
+
+    def queueDueJobs(self):
+        """Moves jobs whose time has come to pending. Returns the seconds until the next job is due."""
+        now = time.time()
+        wait = 60.0
+        for job in self.jobs:
+            if job.paused or job.status == "running" or job in self.pending:
+                continue
+            if job.nextRun <= now:
+                self.pending.append(job)
+                self.pending.sort(key=lambda pendingJob: -pendingJob.priority)
+                self.condition.notify_all()
+            else:
+                wait = min(wait, job.nextRun - now)
+        return wait
+
+    def command(self, line):
+        """Executes one control command and returns the answer as a dict."""
+        words = line.split()
+        if not words:
+            return {"error": "empty command"}
+        action, names = words[0], words[1:]
+        jobs = [job for job in self.jobs if not names or job.name in names]
+        if names and len(jobs) != len(names):
+            return {"error": "unknown job in %s" % " ".join(names)}
+        with self.condition:
+            if action == "status":
+                pass
+            elif action == "trigger":
+                for job in jobs:
+                    if job.status == "running":
+                        job.triggered = True  # jobDone() would overwrite nextRun.
+                    else:
+                        job.nextRun = time.time()
+            elif action in ("pause", "resume"):
+                for job in jobs:
+                    job.paused = action == "pause"
+                    if job.paused and job in self.pending:
+                        self.pending.remove(job)
+            elif action == "stop":
+                self.stopping = True
+            else:
+                return {"error": "unknown command %s" % action}
+            self.condition.notify_all()
+            return {"ok": True, "stopping": self.stopping, "jobs": [job.describe() for job in jobs]}
+
+    def serveControl(self, server):
+        while not self.stopping:
+            try:
+                connection, address = server.accept()
+            except OSError:
+                return  # Closed by serve() on shutdown.
+            with connection:
+                try:
+                    line = connection.makefile("r").readline()
+                    connection.sendall((json.dumps(self.command(line)) + "\n").encode("utf-8"))
+                except OSError as e:
+                    logWarning("Control connection failed: %s", e)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True  # No lock: this may run as a signal handler. serve() polls the flag.
+
+    def serve(self):
+        """Runs until a stop command or SIGTERM/SIGINT, then waits for running jobs. Returns the exit status."""
+        import signal
+        import socket
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        server.listen(8)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        threads = [threading.Thread(target=self.worker, name="worker-%s" % i) for i in range(self.workers)]
+        threads.append(threading.Thread(target=self.serveControl, args=(server,), name="control", daemon=True))
+        for thread in threads:
+            thread.start()
+        logInfo("Daemon started with %s jobs, control socket %s", len(self.jobs), self.socketPath)
+        with self.condition:
+            while not self.stopping:
+                self.condition.wait(min(self.queueDueJobs(), 1.0))  # Short waits to notice stop() soon.
+            self.condition.notify_all()
+        logInfo("Daemon stopping, waiting for running jobs.")
+        server.close()
+        os.remove(self.socketPath)
+        for thread in threads[:-1]:
+            thread.join()
+        for job in self.jobs:
+            job.close()
+        return 0
+
+
+def controlCommand(socketPath, line):
+    """Sends one command to a running daemon and returns its answer."""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        client.connect(socketPath)
+        client.sendall((line + "\n").encode("utf-8"))
+        return json.loads(client.makefile("r").readline())
+
+
+class JobLogFilter(logging.Filter):
+    """Passes only records logged by the worker thread of one job."""
+
+    def __init__(self, jobName):
+        logging.Filter.__init__(self)
+        self.jobName = jobName
+
+    def filter(self, record):
+        return record.threadName == self.jobName
+
+
+def buildParser():
     parser = ArgumentParser(description="bytterfs. Incremental Backup helper for btrfs send/receive over SSH. "
                                          "Make sure that the SSH user has added following sudo rights in /etc/sudoers: "
                                          "..... ..... ..... username ALL=NOPASSWD: /usr/bin/btrfs subvol delete* ..... "
@@ -632,14 +4253,20 @@ try:
                                          "destination server. Also make sure that you have already created a subvolume"
                                          "on the backup destination which holds all your backup for the specific "
                                          "source.")
-    parser.add_argument('snapshotName', type=str, help="Name of snapshot. A timestamp will then be suffixed to it. "
-                                                       "E.g.: rootfs_1418415962.")
-    parser.add_argument('source', type=checkPath, help='Source subvolume to backup. Local path or SSH url.')
-    parser.add_argument('destRootSubvol', type=checkPath,
+    parser.add_argument('snapshotName', type=str, nargs='?',
+                        help="Name of snapshot. A timestamp will then be suffixed to it. E.g.: rootfs_1418415962.")
+    parser.add_argument('source', type=checkPath, nargs='?', help='Source subvolume to backup. Local path or SSH url.')
+    parser.add_argument('destRootSubvol', type=checkPath, nargs='?',
                         help="Destination root subvolume. This parameter is required to verify, that the specified "
                              "destinationContainer is existent on the destination root subvolume.")
-    parser.add_argument('destContainer', type=checkPath, help="Destination container subvolume path, where snapshots "
-                                                              "are send to.")
+    parser.add_argument('destContainer', type=checkPath, nargs='?',
+                        help="Destination container subvolume path, where snapshots are send to.")
+    parser.add_argument('-c', '--config', type=str, required=False,
+                        help="Run all jobs of this config file instead of a single backup. Each section is a job "
+                             "named after its snapshotName with the options source, destRootSubvol, destContainer, "
+                             "destKeep, sshHost, sshPort, sshKey, local and priority. An optional [bytterfs] section "
+                             "sets workers, hostLimit (concurrent jobs per destination host) and deviceLimit "
+                             "(concurrent jobs per source device).")
     parser.add_argument('-l', '--local', action='store_true', help='If this switch is used, then ssh parameters will be'
                                                                    'ignored and the backup transfer will run locally',
                         required=False)
@@ -656,35 +4283,429 @@ try:
                              "and maximum 3 snapshots will be kept from the time span of 6 until 12 months. Only w for "
                              "weeks and m for months is accepted syntax. Abstract: <time span>[w|m]= <number of snapsho"
                              "ts>optional(<comma as delimiter>)... Notice that the next specified time span has to be "
-                             "greater than the previous, else the parameter will yield an error.", required=True)
-    args = parser.parse_args()
-    logPath = "%s%s" % ("/var/log/", app_name)  # Add fileHandler
-    mkdir_p(logPath)
-    logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-    fileHandler = logging.FileHandler("{0}/{1}.log".format(logPath, args.snapshotName))  # {0}{1} for format(logPath,..)
-    fileHandler.setFormatter(logFormatter)
-    logger.addHandler(fileHandler)
+                             "greater than the previous, else the parameter will yield an error.", required=False)
+    parser.add_argument('--compress', choices=COMPRESS_CHOICES, default="none",
+                        help="Compress the send stream on its way to the destination, which needs the same tool "
+                             "installed. auto samples the start of the stream and picks zstd, lz4 or gzip only if it "
+                             "compresses well. Default: none.", required=False)
+    parser.add_argument('--compressLevel', type=int, help='Compression level. Default: the tool\'s default.',
+                        required=False)
+    parser.add_argument('--compressThreads', type=int,
+                        help='Compression threads for zstd and pigz. Default: all cores.', required=False)
+    parser.add_argument('--relay', action='store_true',
+                        help='Copy the stream between send and receive in-process (zero-copy splice where supported) '
+                             'to count bytes and measure throughput. Implied by --progressInterval and --statusFile.',
+                        required=False)
+    parser.add_argument('--progressInterval', type=float,
+                        help='Log transfer progress and throughput every this many seconds.', required=False)
+    parser.add_argument('--statusFile', type=str,
+                        help='JSON file updated with the transfer state, bytes and throughput while a transfer runs. '
+                             '{snapshotName} is replaced with the snapshot name.', required=False)
+    parser.add_argument('--bwLimit', type=checkRate,
+                        help='Cap the transfer at this many bytes per second, e.g. 500K, 10M or 1G. 0 is unlimited.',
+                        required=False)
+    parser.add_argument('--bwSchedule', type=checkBwSchedule,
+                        help="Time of day rate limits, e.g. mon-fri@08:00-18:00=10M,22:00-06:00=0. Days are optional, "
+                             "the first matching rule wins and --bwLimit applies outside of all rules. The schedule "
+                             "is re-checked every 30 seconds while a transfer runs.", required=False)
+    parser.add_argument('--spool', type=checkPath,
+                        help='Local spool directory. The send stream is written there in checksummed chunks, copied '
+                             'to --remoteSpool and only received once all chunks arrived intact. An interrupted '
+                             'transfer resumes from the last confirmed chunk on the next run instead of being resent.',
+                        required=False)
+    parser.add_argument('--remoteSpool', type=checkPath,
+                        help='Spool directory on the destination. Default: %s' % DEFAULT_REMOTE_SPOOL, required=False)
+    parser.add_argument('--spoolChunkSize', type=checkRate,
+                        help='Size of the spool chunks, e.g. 64M (the default).', required=False)
+    parser.add_argument('--archive', action='store_true',
+                        help='Treat destContainer as a plain directory on this machine (any filesystem, e.g. XFS or '
+                             'NFS) and store the send streams there as chains of content-addressed chunks. '
+                             'destRootSubvol is ignored. Restore with bytterfs restore.', required=False)
+    parser.add_argument('--archiveChunkSize', type=checkRate,
+                        help='Size of the archive chunks, e.g. 8M (the default).', required=False)
+    parser.add_argument('--archiveWriters', type=int,
+                        help='Threads hashing and writing archive chunks. Default: %s.' % DEFAULT_ARCHIVE_WRITERS,
+                        required=False)
+    parser.add_argument('--fullEvery', type=int,
+                        help='Incrementals after which the next send is a fresh full one. Default: never, but %s in '
+                             'an archive, where it starts a new chain.' % DEFAULT_ARCHIVE_FULL_EVERY, required=False)
+    parser.add_argument('--maxDuration', type=checkDuration,
+                        help='Transfer time allowed for a run, e.g. 2h. Before sending, the stream size is estimated '
+                             '(btrfs subvol find-new for incrementals, btrfs filesystem du for full sends) and its '
+                             'duration predicted from the throughput of past runs. Longer sends are handled by '
+                             '--oversize.', required=False)
+    parser.add_argument('--oversize', type=checkOversize,
+                        help='What to do with a send predicted to exceed --maxDuration: run (the default, only log '
+                             'it), defer (skip the run, at most %s times in a row) or throttle:RATE (limit it to '
+                             'RATE, e.g. throttle:10M).' % MAX_DEFERRALS, required=False)
+    parser.add_argument('--stateDir', type=checkPath,
+                        help='Directory for the state kept between runs, such as the measured throughput. '
+                             'Default: %s' % DEFAULT_STATE_DIR, required=False)
+    parser.add_argument('--stateFile',
+                        help='JSON file keeping the throughput, chain length and deferrals of the job. '
+                             'Default: <stateDir>/<snapshotName>.json', required=False)
+    parser.add_argument('--historyDb',
+                        help='SQLite database the run is recorded in. Default: <stateDir>/history.db',
+                        required=False)
+    parser.add_argument('--deleteBatch', type=int,
+                        help='Maximum number of snapshots removed by one btrfs subvol delete call. Default: 32.',
+                        required=False)
+    parser.add_argument('--deleteCommit', choices=DELETE_COMMIT_CHOICES, default="none",
+                        help='Wait for the deletion to be committed: after each batch (--commit-after) or after each '
+                             'snapshot (--commit-each). Default: none.', required=False)
+    parser.add_argument('--overlapPrune', action='store_true',
+                        help='Delete expired destination snapshots in the background while the new snapshot is sent, '
+                             'instead of before it. The parent is never deleted, and older client snapshots are only '
+                             'deleted after a successful transfer.', required=False)
+    parser.add_argument('-n', '--dryRun', action='store_true',
+                        help='Print which destination snapshots the retention policy keeps and deletes, then exit '
+                             'without creating, sending or deleting anything.', required=False)
+    parser.add_argument('--cloneSource', type=checkCloneSource, action='append', dest='cloneSources',
+                        help='Snapshots of a sibling job as snapshotName:source:destContainer, whose destContainer is '
+                             'on the same destination filesystem. Its newest snapshot on both ends is passed to btrfs '
+                             'send as -c clone source, so extents shared with it are not sent again. May be given '
+                             'several times.', required=False)
+    parser.add_argument('-m', '--mirror', type=checkMirror, action='append', dest='mirrors',
+                        help='Additional SSH destination as user@host:port:sshKey:destRootSubvol:destContainer. May be '
+                             'given several times. One snapshot is created and its send stream is fed to all '
+                             'destinations at once, each with its own incremental parent and retention.',
+                        required=False)
+    parser.add_argument('--buffer', type=checkRate,
+                        help='Size of a ring buffer between send and receive, e.g. 512M, so disk seeks on the client '
+                             'and stalls of the link don\'t hold up each other.', required=False)
+    parser.add_argument('--bufferWatermarks', type=checkWatermarks,
+                        help='HIGH:LOW fill levels of --buffer in percent: reading the send stream pauses when the '
+                             'fill reaches HIGH and resumes at LOW. Default: %s.' % DEFAULT_BUFFER_WATERMARKS,
+                        required=False)
+    parser.add_argument('--bufferDir',
+                        help='Back --buffer with a memory-mapped temporary file in this directory instead of memory.',
+                        required=False)
+    parser.add_argument('--checksum', action='store_true',
+                        help='Hash the send stream while it passes through (BLAKE3 or xxHash if installed, else '
+                             'SHA-256) and record the digest and the UUIDs in a manifest on the destination, for '
+                             'bytterfs verify.', required=False)
+    parser.add_argument('--manifestDir', type=checkPath,
+                        help='Directory for the manifests on the destination. Default: %s' % DEFAULT_MANIFEST_DIR,
+                        required=False)
+    parser.add_argument('--agent', action='store_true',
+                        help='Start a helper on the destination that answers btrfs queries and deletions in batches '
+                             'over one SSH channel, instead of one SSH command per query. Needs python3 there.',
+                        required=False)
+    parser.add_argument('--commandTimeout', type=float,
+                        help='Seconds after which a btrfs query, deletion or mount is killed and counts as failed. '
+                             'Transfers have no timeout. Default: %s.' % DEFAULT_COMMAND_TIMEOUT, required=False)
+    parser.add_argument('--mirrorBuffer', type=checkRate,
+                        help='Stream buffered per destination, e.g. 64M (the default). A destination whose buffer '
+                             'stays full for %ss is dropped from the transfer.' % FANOUT_STALL_TIMEOUT, required=False)
+    return parser
+
+
+#### Main
+def setupLogging():
+    """Adds the console and syslog handlers. Only main() calls this, so importing bytterfs leaves logging alone."""
+    import logging.handlers
+    logger.addHandler(ColoredConsoleHandler())
+    if os.path.exists('/dev/log'):  # No syslog socket e.g. in a container.
+        log_syslog_handler = logging.handlers.SysLogHandler('/dev/log')  # /dev/log is the socket to log to syslog
+        log_syslog_handler.setFormatter(logging.Formatter(app_name + '[%(process)d] %(message)s'))
+        logger.addHandler(log_syslog_handler)  # Add SysLogHandler
+    logger.info('%s v%s by %s', app_name, __version__, __author__)
+
+
+def setLogLevel(args):
     if args.debug:
         logger.setLevel(logging.DEBUG)
     elif args.info:
         logger.setLevel(logging.INFO)
     else:
         logger.setLevel(logging.ERROR)
-    if args.local is True:
-        args.sshHost = None
-        args.sshPort = None
-        args.sshKey = None
+
+
+def addJobLogHandlers(jobs, logPath, logFormatter):
+    """Prefixes console lines with the job name and logs every job to its own file."""
+    for handler in logger.handlers:
+        if isinstance(handler, ColoredConsoleHandler):
+            handler.setFormatter(logging.Formatter("[%(threadName)s] %(message)s"))
+    for job in jobs:
+        fileHandler = logging.FileHandler("{0}/{1}.log".format(logPath, job.name))
+        fileHandler.setFormatter(logFormatter)
+        fileHandler.addFilter(JobLogFilter(job.name))
+        logger.addHandler(fileHandler)
+
+
+def daemonMain(argv):
+    """`bytterfs daemon -c CONFIG`: runs the jobs of CONFIG on their intervals until stopped."""
+    parser = ArgumentParser(prog="%s daemon" % app_name,
+                            description="Run the jobs of a config file every interval (a job option, e.g. 1h, "
+                                        "default 1h) with up to jitter (e.g. 5m) random delay, keeping SSH "
+                                        "connections, snapshot listings and mounts between runs.")
+    parser.add_argument('-c', '--config', type=str, required=True, help="Config file, see bytterfs --help.")
+    parser.add_argument('--socket', type=str, default=DEFAULT_CONTROL_SOCKET,
+                        help="Control socket for bytterfs ctl. Default: %s" % DEFAULT_CONTROL_SOCKET)
+    parser.add_argument('-vv', '--debug', action='store_true', help='Log level: debug', required=False)
+    parser.add_argument('-v', '--info', action='store_true', help='Log level: info', required=False)
+    args = parser.parse_args(argv)
+    setupLogging()
+    setLogLevel(args)
+    try:
+        settings, jobs = loadJobs(args.config)
+    except ArgumentTypeError as e:
+        logError(str(e))
+        return 2
+    logPath = "%s%s" % ("/var/log/", app_name)
+    mkdir_p(logPath)
+    addJobLogHandlers(jobs, logPath, logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s"))
+    return BackupDaemon(jobs, args.socket, **settings).serve()
+
+
+def ctlMain(argv):
+    """`bytterfs ctl COMMAND [JOB ...]`: sends a command to a running daemon and prints its answer."""
+    parser = ArgumentParser(prog="%s ctl" % app_name, description="Control a running bytterfs daemon.")
+    parser.add_argument('command', choices=["status", "trigger", "pause", "resume", "stop"])
+    parser.add_argument('jobs', nargs='*', help="Jobs to apply the command to. Default: all.")
+    parser.add_argument('--socket', type=str, default=DEFAULT_CONTROL_SOCKET,
+                        help="Control socket of the daemon. Default: %s" % DEFAULT_CONTROL_SOCKET)
+    args = parser.parse_args(argv)
+    try:
+        answer = controlCommand(args.socket, " ".join([args.command] + args.jobs))
+    except OSError as e:
+        print("Could not reach the daemon at %s: %s" % (args.socket, e), file=sys.stderr)
+        return 1
+    print(json.dumps(answer, indent=2))
+    return 0 if "error" not in answer else 1
+
+
+def verifyMain(argv):
+    """`bytterfs verify [-c CONFIG [JOB ...] | SNAPSHOTNAME ...] [--clean]`: checks the destinations against the
+    manifests written by --checksum runs. Returns 1 if a snapshot does not match its manifest or a check failed."""
+    parser = buildParser()
+    parser.prog = "%s verify" % app_name
+    parser.description = "Checks the snapshots on the destinations against the manifests of --checksum runs."
+    parser.add_argument('--clean', action='store_true', help='Remove manifests of snapshots that were deleted.')
+    parser.add_argument('--job', action='append', dest='jobNames', help='Job of the config file to verify. '
+                        'Repeat for several jobs. Default: all.')
+    args = parser.parse_args(argv)
+    setupLogging()
+    setLogLevel(args)
+    if args.config is not None:
+        try:
+            settings, jobs = loadJobs(args.config)
+        except ArgumentTypeError as e:
+            logError(str(e))
+            return 2
+        jobs = [job for job in jobs if not args.jobNames or job.name in args.jobNames]
+        targets = [(job.name, job.createBytterfs) for job in jobs]
+    elif args.destContainer is None:
+        parser.error("snapshotName, source, destRootSubvol and destContainer are required unless -c/--config is used.")
+    else:
+        if args.local is True:
+            args.sshHost = args.sshPort = args.sshKey = None
+        targets = [(args.snapshotName, lambda: Bytterfs(
+            args.snapshotName, args.source, args.destRootSubvol, args.destContainer, args.destKeep or "1w=1",
+            args.sshHost, args.sshPort, args.sshKey, **dict((key, getattr(args, key)) for key in JOB_OPTIONS)))]
+    failed = False
+    for name, createBytterfs in targets:
+        try:
+            reports = createBytterfs().verify(args.clean)
+        except (OSError, SystemExit) as e:
+            print("%s: verification failed: %s" % (name, e), file=sys.stderr)
+            failed = True
+            continue
+        for destination, report in reports:
+            print("%s on %s: %s verified, %s unverified, %s mismatched, %s orphaned manifests%s" % (
+                name, destination, len(report["verified"]), len(report["unverified"]), len(report["mismatched"]),
+                len(report["orphaned"]), " (removed)" if args.clean and report["orphaned"] else ""))
+            for snapshot in report["mismatched"]:
+                print("  MISMATCH %s" % snapshot)
+            failed = failed or bool(report["mismatched"])
+    return 1 if failed else 0
+
+
+def restoreMain(argv):
+    """`bytterfs restore ARCHIVE [SNAPSHOT TARGET]`: lists the chains of an archive, or receives the chain up to
+    SNAPSHOT into the btrfs directory TARGET."""
+    parser = ArgumentParser(prog="%s restore" % app_name,
+                            description="Restore a snapshot from an archive (see --archive) by receiving its full "
+                                        "stream and the incrementals up to it. Without SNAPSHOT, list the chains.")
+    parser.add_argument('archive', type=checkPath, help="Archive directory, the destContainer of the job.")
+    parser.add_argument('snapshot', nargs='?', help="Snapshot to restore, e.g. @home_1500000000.")
+    parser.add_argument('target', nargs='?', type=checkPath, help="btrfs directory to receive the snapshots in.")
+    parser.add_argument('-vv', '--debug', action='store_true', help='Log level: debug', required=False)
+    parser.add_argument('-v', '--info', action='store_true', help='Log level: info', required=False)
+    args = parser.parse_args(argv)
+    setupLogging()
+    setLogLevel(args)
+    store = ArchiveStore(args.archive)
+    if args.snapshot is None:
+        for chain in store.chains():
+            print("chain %s: %s streams, %s bytes" % (chain[0]["snapshot"], len(chain),
+                                                      sum(entry["bytes"] for entry in chain)))
+            for entry in chain:
+                print("  %s %12s  %s" % ("full" if entry["parent"] is None else "inc ", entry["bytes"],
+                                         entry["snapshot"]))
+        return 0
+    if args.target is None:
+        parser.error("TARGET is required to restore %s." % args.snapshot)
+    try:
+        chain = store.chainOf(args.snapshot)
+        for entry in chain:
+            if os.path.isdir("%s%s" % (args.target, entry["snapshot"])):
+                logInfo("%s%s exists. Not receiving it again.", args.target, entry["snapshot"])
+                continue
+            logInfo("Receiving %s (%s bytes) into %s.", entry["snapshot"], entry["bytes"], args.target)
+            p1 = Popen(["sudo", "btrfs", "receive", args.target], stdin=PIPE)
+            try:
+                for data in store.read(entry):
+                    writeAll(p1.stdin.fileno(), data)
+            finally:
+                p1.stdin.close()
+                p1.wait()
+            if p1.returncode != 0:
+                raise OSError("btrfs receive of %s failed with exit status %s" % (entry["snapshot"], p1.returncode))
+    except (IOError, OSError) as e:
+        logError("Restoring %s failed: %s", args.snapshot, e)
+        return 1
+    print("Restored %s%s from %s streams." % (args.target, args.snapshot, len(chain)))
+    return 0
+
+
+def formatSeconds(seconds):
+    return "-" if seconds is None else "%.1fs" % seconds
+
+
+def historyMain(argv):
+    """`bytterfs history`: prints per-phase percentiles, growth and regressions of the recorded runs, optionally
+    writing them as Prometheus metrics."""
+    parser = ArgumentParser(prog="%s history" % app_name,
+                            description="Summarize the run history: runs by status, percentiles of the time per "
+                                        "phase, growth of the incremental streams and phases that got slower.")
+    parser.add_argument('--stateDir', type=checkPath, default=DEFAULT_STATE_DIR,
+                        help="State directory of the jobs. Default: %s" % DEFAULT_STATE_DIR)
+    parser.add_argument('--historyDb', '--db', dest="historyDb",
+                        help="History database. Default: <stateDir>/history.db")
+    parser.add_argument('--config', metavar="FILE",
+                        help="Read the history databases of the jobs in this config file, as the daemon writes them.")
+    parser.add_argument('--job', action='append', help="Only this job (snapshotName). May be given several times.")
+    parser.add_argument('--days', type=float, default=90, help="Only runs of the last DAYS days. Default: 90")
+    parser.add_argument('--prometheus', metavar="FILE",
+                        help="Write the statistics as Prometheus metrics to FILE, e.g. for the node_exporter "
+                             "textfile collector, instead of printing them.")
+    parser.add_argument('-vv', '--debug', action='store_true', help='Log level: debug', required=False)
+    parser.add_argument('-v', '--info', action='store_true', help='Log level: info', required=False)
+    args = parser.parse_args(argv)
+    setupLogging()
+    setLogLevel(args)
+    import sqlite3
+    if args.config:
+        try:
+            paths = sorted(set(historyPath(job.options) for job in loadJobs(args.config)[1]))
+        except ArgumentTypeError as e:
+            logError("%s", e)
+            return 1
     else:
-        if args.sshPort is None or args.sshPort is None or args.sshKey is None:
-            logError("SSH parameter missing")
-            sys.exit()
-    bytterfs = Bytterfs(args.snapshotName, args.source, args.destRootSubvol, args.destContainer,
-                        args.destKeep, args.sshHost, args.sshPort, args.sshKey)
-    bytterfs.run()
-except SystemExit as e:
-    if e.code != 0:
+        paths = [historyPath({"stateDir": args.stateDir, "historyDb": args.historyDb})]
+    runs = []
+    for path in paths:
+        history = RunHistory(path)
+        try:
+            runs.extend(history.runs(args.job, time.time() - args.days * 86400))
+        except sqlite3.Error as e:
+            logError("Could not read the run history %s: %s", history.path, e)
+            return 1
+    runs.sort(key=lambda run: run["started"])
+    runsByJob = defaultdict(list)
+    for run in runs:
+        runsByJob[run["job"]].append(run)
+    statsByJob = dict((job, runStats(jobRuns)) for job, jobRuns in runsByJob.items())
+    if args.prometheus:
+        tmpFile = "%s.tmp" % args.prometheus
+        with open(tmpFile, "w") as f:
+            f.write(prometheusText(statsByJob))
+        os.replace(tmpFile, args.prometheus)
+        return 0
+    if not statsByJob:
+        print("No runs recorded in %s in the last %s days." % (", ".join(paths), args.days))
+    for job in sorted(statsByJob):
+        stats = statsByJob[job]
+        last = stats["last"]
+        print("%s: %s runs (%s)" % (job, stats["runs"], ", ".join("%s %s" % (count, status) for status, count in
+                                                                  sorted(stats["statuses"].items()))))
+        print("  last run %s: %s, %s %s in %s" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(last["started"])),
+                                                  last["status"], last["mode"] or "-", last["snapshot"] or "-",
+                                                  formatSeconds(last["duration"])))
+        print("  %-10s %10s %10s %10s" % ("phase", "p50", "p90", "p99"))
+        for name in ["duration"] + ["%sSeconds" % phase for phase in RUN_PHASES]:
+            quantiles = stats["phases"][name]
+            print("  %-10s %10s %10s %10s" % (name.replace("Seconds", ""), formatSeconds(quantiles["p50"]),
+                                              formatSeconds(quantiles["p90"]), formatSeconds(quantiles["p99"])))
+        quantiles = stats["phases"]["bytes"]
+        print("  %-10s %10s %10s %10s" % ("bytes", quantiles["p50"], quantiles["p90"], quantiles["p99"]))
+        if stats["growth"] is not None:
+            weekly = 100.0 * stats["growth"] * 7 / stats["meanBytes"] if stats["meanBytes"] else 0
+            print("  incremental streams grow by %.0f bytes/day (%+.1f%%/week)" % (stats["growth"], weekly))
+        for name, then, now in stats["regressions"]:
+            print("  REGRESSION %s: median of the last %s runs %s, before %s" % (
+                name.replace("Seconds", ""), REGRESSION_RUNS, formatSeconds(now), formatSeconds(then)))
+    return 0
+
+
+def main(argv=None):
+    """Command line entry point. Returns the exit code."""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["daemon"]:
+        return daemonMain(argv[1:])
+    if argv[:1] == ["ctl"]:
+        return ctlMain(argv[1:])
+    if argv[:1] == ["verify"]:
+        return verifyMain(argv[1:])
+    if argv[:1] == ["restore"]:
+        return restoreMain(argv[1:])
+    if argv[:1] in (["history"], ["stats"]):
+        return historyMain(argv[1:])
+    setupLogging()
+    try:
+        parser = buildParser()
+        args = parser.parse_args(argv)
+        if args.config is None and (args.destContainer is None or args.destKeep is None):
+            parser.error("snapshotName, source, destRootSubvol, destContainer and -dk/--destKeep are required unless "
+                         "-c/--config is used.")
+        logPath = "%s%s" % ("/var/log/", app_name)  # Add fileHandler
+        mkdir_p(logPath)
+        logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
+        if args.config is None:
+            fileHandler = logging.FileHandler("{0}/{1}.log".format(logPath, args.snapshotName))  # {0}{1} for format(..)
+            fileHandler.setFormatter(logFormatter)
+            logger.addHandler(fileHandler)
+        setLogLevel(args)
+        if args.config is not None:
+            try:
+                settings, jobs = loadJobs(args.config)
+            except ArgumentTypeError as e:
+                logError(str(e))
+                return 2
+            addJobLogHandlers(jobs, logPath, logFormatter)
+            return JobScheduler(jobs, **settings).run()
+        if args.local is True:
+            args.sshHost = None
+            args.sshPort = None
+            args.sshKey = None
+        else:
+            if args.sshPort is None or args.sshPort is None or args.sshKey is None:
+                logError("SSH parameter missing")
+                return 0
+        bytterfs = Bytterfs(args.snapshotName, args.source, args.destRootSubvol, args.destContainer,
+                            args.destKeep, args.sshHost, args.sshPort, args.sshKey,
+                            **dict((key, getattr(args, key)) for key in JOB_OPTIONS))
+        bytterfs.run()
+    except SystemExit as e:
+        if e.code != 0:
+            raise
+    except:
+        import traceback
+        logger.error('ERROR {0} {1}'.format(sys.exc_info(), traceback.extract_tb(sys.exc_info()[2])))
         raise
-except:
-    logger.error('ERROR {0} {1}'.format(sys.exc_info(), traceback.extract_tb(sys.exc_info()[2])))
-    raise
-exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
     # Application name:
     name="bytterfs",
@@ -10,7 +10,9 @@ setup(
     author="eayin2",
     author_email="eayin2 at gmail dot com",
 
-    scripts=["bytterfs.py"],
+    # bytterfs is a single module: importable as a library and installed as the bytterfs command.
+    py_modules=["bytterfs"],
+    entry_points={"console_scripts": ["bytterfs = bytterfs:main"]},
 
     # Include additional files into the package
     include_package_data=True,
@@ -0,0 +1,54 @@
+"""Fixtures that run bytterfs against the btrfs, ssh and sudo stand-ins of benchmarks/fakebin.py."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from bench_run import KEEP, SNAPSHOT_NAME, Scenario, readSpawns  # noqa: E402
+from bytterfs import Bytterfs  # noqa: E402
+
+FULL_SIZE = 8 * 1024 * 1024
+INC_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def scenario(tmp_path, monkeypatch):
+    """A Scenario with the stand-ins first on PATH."""
+    binDir = tmp_path / "bin"
+    binDir.mkdir()
+    for tool in ("btrfs", "ssh", "sudo"):
+        os.symlink(os.path.join(ROOT, "benchmarks", "fakebin.py"), str(binDir / tool))
+    scenario = Scenario(str(tmp_path / "state"))
+    monkeypatch.setenv("PATH", "%s:%s" % (binDir, os.environ["PATH"]))
+    monkeypatch.setenv("BENCH_STATE", scenario.root)
+    monkeypatch.setenv("BENCH_FULL_SIZE", str(FULL_SIZE))
+    monkeypatch.setenv("BENCH_INC_SIZE", str(INC_SIZE))
+    monkeypatch.delenv("BYTTERFS_SSH", raising=False)
+    open(os.path.join(scenario.root, "spawns.log"), "w").close()
+    scenario.stateDir = str(tmp_path / "var") + "/"
+    return scenario
+
+
+def runBackup(scenario, snapshotName=SNAPSHOT_NAME, keep=KEEP, **options):
+    """Runs one backup of the scenario over the ssh stand-in and returns the Bytterfs instance."""
+    options.setdefault("stateDir", scenario.stateDir)
+    bytterfs = Bytterfs(snapshotName, scenario.source, scenario.destRootSubvol, scenario.destContainer, keep,
+                        "bench@localhost", "22", "/dev/null", **options)
+    try:
+        bytterfs.run()
+    except SystemExit:
+        pass  # Bytterfs ends every run with exit().
+    return bytterfs
+
+
+def receivedBytes(scenario):
+    """Stream bytes that btrfs receive got in all runs so far, without the stand-in's header line."""
+    return readSpawns(scenario.root)["transfer"][2]
+
+
+def destSnapshots(scenario):
+    return sorted(name for name in os.listdir(scenario.destContainer)
+                  if os.path.isdir(os.path.join(scenario.destContainer, name)))
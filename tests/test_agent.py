@@ -0,0 +1,52 @@
+"""The remote agent protocol over the ssh stand-in."""
+import os
+
+import pytest
+
+from conftest import INC_SIZE, destSnapshots, receivedBytes, runBackup
+from bytterfs import RemoteAgent, SshTransport
+
+
+@pytest.fixture
+def agent(scenario):
+    transport = SshTransport("bench@localhost", "22", "/dev/null")
+    agent = RemoteAgent(transport)
+    assert agent.start(timeout=30)
+    yield agent
+    agent.close()
+    transport.close()
+
+
+def test_incremental_over_the_agent(scenario):
+    name = scenario.snapshot(3600)
+    bytterfs = runBackup(scenario, agent=True)
+    assert bytterfs.completed
+    assert receivedBytes(scenario) == INC_SIZE
+    assert name in destSnapshots(scenario)
+
+
+def test_batch_answers_every_op(scenario, agent):
+    kept = scenario.destSnapshot(7200)
+    deleted = scenario.destSnapshot(3600)
+    results = agent.call([{"op": "list", "flags": ["-o"], "path": scenario.destContainer},
+                          {"op": "free", "path": scenario.destContainer},
+                          {"op": "delete", "flags": [], "paths": [os.path.join(scenario.destContainer, deleted)]}],
+                         timeout=30)
+    assert [result["returncode"] for result in results] == [0, 0, 0]
+    assert kept in results[0]["stdout"] and deleted in results[0]["stdout"]
+    assert results[1]["available"] > 0
+    assert destSnapshots(scenario) == [kept]
+    assert agent.roundTrips == 1
+
+
+def test_rejected_op_keeps_the_session(scenario, agent):
+    name = scenario.destSnapshot(3600)
+    results = agent.call([{"op": "list", "flags": ["--rm-rf"], "path": scenario.destContainer},
+                          {"op": "delete", "flags": [], "paths": ["relative/path"]},
+                          {"op": "receive", "path": scenario.destContainer}], timeout=30)
+    assert [result["returncode"] for result in results] == [1, 1, 1]
+    assert "not allowed" in results[0]["stderr"]
+    assert "not absolute" in results[1]["stderr"]
+    results = agent.call([{"op": "list", "flags": [], "path": scenario.destContainer}], timeout=30)
+    assert results[0]["returncode"] == 0
+    assert name in results[0]["stdout"]
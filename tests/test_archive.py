@@ -0,0 +1,73 @@
+"""Archive stores: pruning and garbage collection of jobs that share a directory, and backups into one."""
+import os
+import threading
+import time
+
+from conftest import FULL_SIZE, INC_SIZE, runBackup
+from bytterfs import ArchiveStore, RetentionPolicy
+
+DAY = 24 * 60 * 60
+
+
+def source(tmp_path, data):
+    path = tmp_path / ("stream-%s" % len(os.listdir(str(tmp_path))))
+    path.write_bytes(data)
+    return open(str(path), "rb")
+
+
+def archive(tmp_path, store, age, data):
+    snapshot = "%s_%s" % (store.job, int(time.time()) - age)
+    with source(tmp_path, data) as stream:
+        entry = store.write(stream, {"snapshot": snapshot, "ts": int(time.time()) - age, "uuid": snapshot,
+                                     "parent": None, "parentUUID": None})
+    store.commit(entry)
+    return snapshot
+
+
+def chunkFiles(store):
+    return sorted(name for directory, dirs, files in os.walk(store.chunkDir) for name in files)
+
+
+def test_prune_keeps_other_jobs(tmp_path):
+    home = ArchiveStore(str(tmp_path / "archive"), chunkSize=1024, job="home")
+    root = ArchiveStore(str(tmp_path / "archive"), chunkSize=1024, job="root")
+    old = archive(tmp_path, home, 20 * DAY, b"a" * 4096)
+    new = archive(tmp_path, home, 10 * DAY, b"b" * 4096)
+    other = archive(tmp_path, root, 30 * DAY, b"c" * 4096)
+    assert [chain[0]["snapshot"] for chain in home.chains()] == [old, new]
+    kept, deleted = home.plan(RetentionPolicy.parse("8w=1"))
+    assert [chain[0]["snapshot"] for chain in deleted] == [old]
+    for chain in deleted:
+        home.delete(chain)
+    assert home.collectGarbage() == 1024
+    assert [chain[0]["snapshot"] for chain in root.chains()] == [other]
+    assert b"".join(root.read(root.chainOf(other)[0])) == b"c" * 4096
+    assert [entry["snapshot"] for entry in ArchiveStore(str(tmp_path / "archive")).streams()] == [other, new]
+
+
+def test_garbage_collection_waits_for_writers(tmp_path):
+    store = ArchiveStore(str(tmp_path / "archive"), chunkSize=1024, job="home")
+    with store.lock(), source(tmp_path, b"d" * 2048) as stream:
+        entry = store.write(stream, {"snapshot": "home_1", "ts": 1, "uuid": "u", "parent": None, "parentUUID": None})
+        collector = threading.Thread(target=store.collectGarbage)
+        collector.start()
+        time.sleep(0.3)
+        assert collector.is_alive()
+        store.commit(entry)
+    collector.join(10)
+    assert not collector.is_alive()
+    assert len(chunkFiles(store)) == 1
+    assert b"".join(store.read(entry)) == b"d" * 2048
+
+
+def test_backups_into_an_archive(scenario):
+    assert runBackup(scenario, archive=True).completed
+    time.sleep(1)  # Snapshot names have a resolution of one second.
+    assert runBackup(scenario, archive=True).completed
+    store = ArchiveStore(scenario.destContainer)
+    chains = store.chains()
+    assert len(chains) == 1
+    full, incremental = chains[0]
+    assert incremental["parent"] == full["snapshot"]
+    assert FULL_SIZE < full["bytes"] < FULL_SIZE + 1024  # The stand-in's stream starts with a header line.
+    assert INC_SIZE < incremental["bytes"] < INC_SIZE + 1024
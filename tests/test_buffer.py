@@ -0,0 +1,67 @@
+"""The ring buffer between send and receive (--buffer) with streams larger than the ring."""
+import os
+import threading
+import time
+
+import pytest
+
+from bytterfs import StreamBuffer, StreamRelay, parseWatermarks
+from conftest import FULL_SIZE, receivedBytes, runBackup
+
+
+@pytest.mark.parametrize("watermarks", ["100:100", "50:75", "0:0", "100"])
+def test_invalid_watermarks_are_rejected(watermarks):
+    with pytest.raises(ValueError):
+        parseWatermarks(watermarks)
+
+
+@pytest.mark.parametrize("watermarks, fullLow", [("100:75", False), ("100:99", False), ("50:25", False),
+                                                 ("100:75", True)])
+def test_stream_larger_than_the_ring_arrives_complete(watermarks, fullLow):
+    data = os.urandom(8 * 1024 * 1024 + 123)
+    srcRead, srcWrite = os.pipe()
+    dstRead, dstWrite = os.pipe()
+    received = []
+
+    def reader():
+        time.sleep(0.3)  # A slow receiver, so the ring fills up.
+        with os.fdopen(dstRead, "rb") as f:
+            received.append(f.read())
+
+    def writer():
+        with os.fdopen(srcWrite, "wb") as f:
+            f.write(data)
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    buffer = StreamBuffer(os.fdopen(srcRead, "rb"), os.fdopen(dstWrite, "wb"), 1024 * 1024, bufferSize=64 * 1024,
+                          watermarks=watermarks)
+    if fullLow:
+        buffer.lowBytes = buffer.size  # Resumes reading while the ring is still full, as 100:100 did.
+    buffer.start()
+    buffer.join(30)
+    for thread in threads:
+        thread.join(30)
+    assert buffer.error is None
+    assert buffer.bytes == len(data)
+    assert received == [data]
+
+
+def test_backup_through_a_small_buffer(scenario):
+    bytterfs = runBackup(scenario, buffer="1M")
+    assert bytterfs.completed
+    assert receivedBytes(scenario) == FULL_SIZE
+
+
+def test_stages_log_under_the_job_thread():
+    names = []
+
+    def job():
+        with open(os.devnull, "rb") as src, open(os.devnull, "wb") as dst:
+            names.extend([StreamBuffer(src, dst, 1024 * 1024).name, StreamRelay(src, dst).name])
+
+    thread = threading.Thread(target=job, name="home")
+    thread.start()
+    thread.join()
+    assert names == ["home", "home"]  # JobLogFilter passes records by thread name.
@@ -0,0 +1,42 @@
+"""Bandwidth limits: schedule rules that cross midnight and a throttled run over the stand-ins."""
+import time
+
+from conftest import FULL_SIZE, runBackup
+from bytterfs import RateLimiter, parseRate
+
+SLOW = parseRate("1M")
+FAST = parseRate("50M")
+
+
+def at(day, hour, minute):
+    """Local time on day days after Monday, 2024-01-01."""
+    return time.mktime((2024, 1, 1 + day, hour, minute, 0, 0, 0, -1))
+
+
+def test_rule_wraps_past_midnight():
+    limiter = RateLimiter("50M", "22:00-06:00=1M")
+    assert limiter.scheduledRate(at(0, 23, 30)) == SLOW
+    assert limiter.scheduledRate(at(1, 5, 59)) == SLOW
+    assert limiter.scheduledRate(at(1, 6, 0)) == FAST
+    assert limiter.scheduledRate(at(1, 21, 59)) == FAST
+
+
+def test_weekday_rule_ends_the_next_morning():
+    limiter = RateLimiter(None, "fri@22:00-06:00=1M")
+    assert limiter.scheduledRate(at(4, 23, 0)) == SLOW  # Friday night
+    assert limiter.scheduledRate(at(5, 2, 0)) == SLOW  # Saturday morning belongs to Friday's rule.
+    assert limiter.scheduledRate(at(4, 2, 0)) == 0  # Friday morning belongs to Thursday, which has no rule.
+
+
+def test_wrapping_rule_throttles_a_run(scenario):
+    local = time.localtime()
+    minute = local.tm_hour * 60 + local.tm_min
+    for offset in (10, 20):
+        end = (minute + offset) % 1440
+        if end + 1 < 1440:
+            break
+    # Crosses midnight and leaves out only [end, end + 1), well after the run.
+    schedule = "%02d:%02d-%02d:%02d=4M" % ((end + 1) // 60, (end + 1) % 60, end // 60, end % 60)
+    started = time.time()
+    assert runBackup(scenario, bwSchedule=schedule).completed
+    assert time.time() - started >= 0.75 * FULL_SIZE / parseRate("4M")
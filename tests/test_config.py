@@ -0,0 +1,26 @@
+"""Config files: job options are checked like their command line counterparts."""
+from argparse import ArgumentTypeError
+
+import pytest
+
+from bytterfs import loadJobs
+
+
+def writeConfig(tmp_path, extra):
+    path = tmp_path / "bytterfs.conf"
+    path.write_text(u"[home]\nsource = /home/\ndestRootSubvol = /backup/\ndestContainer = /backup/home/\n"
+                    u"destKeep = 1w=7\nlocal = yes\n" + extra)
+    return str(path)
+
+
+def test_valid_choices_are_read(tmp_path):
+    settings, jobs = loadJobs(writeConfig(tmp_path, "compress = zstd\ndeleteCommit = after\n"))
+    assert jobs[0].options["compress"] == "zstd"
+    assert jobs[0].options["deleteCommit"] == "after"
+
+
+@pytest.mark.parametrize("extra", ["compress = zsdt\n", "deleteCommit = afer\n"])
+def test_unknown_choice_is_rejected(tmp_path, extra):
+    with pytest.raises(ArgumentTypeError) as error:
+        loadJobs(writeConfig(tmp_path, extra))
+    assert "Job home" in str(error.value) and extra.split(" = ")[1].strip() in str(error.value)
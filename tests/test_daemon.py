@@ -0,0 +1,27 @@
+"""Daemon scheduling: control commands and when jobs run next."""
+import time
+
+from bytterfs import BackupDaemon, BackupJob
+
+
+def job(scenario, name="bench"):
+    return BackupJob(name, {"source": scenario.source, "destRootSubvol": scenario.destRootSubvol,
+                            "destContainer": scenario.destContainer, "destKeep": "1w=1", "sshHost": None,
+                            "sshPort": None, "sshKey": None})
+
+
+def test_trigger_during_a_run_runs_again(scenario, tmp_path):
+    running, idle = job(scenario), job(scenario, "other")
+    daemon = BackupDaemon([running, idle], socketPath=str(tmp_path / "control.sock"))
+    running.status = "running"
+    answer = daemon.command("trigger")
+    assert answer["ok"] and answer["jobs"][0]["triggered"]
+    assert idle.nextRun <= time.time()
+    daemon.jobDone(running)
+    assert running.nextRun <= time.time() and not running.triggered
+    running.status = "ok"
+    with daemon.condition:
+        daemon.queueDueJobs()
+    assert daemon.pending == [running, idle]
+    daemon.jobDone(running)
+    assert running.nextRun > time.time() + running.interval - 1
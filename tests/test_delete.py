@@ -0,0 +1,23 @@
+"""Batched `btrfs subvol delete`: one failure in a batch is reported by name, the rest of it is deleted."""
+import os
+
+from conftest import KEEP, SNAPSHOT_NAME, destSnapshots
+from bytterfs import Bytterfs
+
+
+def test_one_failed_name_out_of_a_batch(scenario):
+    names = [scenario.destSnapshot(age) for age in (5 * 3600, 4 * 3600, 3 * 3600, 2 * 3600, 3600)]
+    open(os.path.join(scenario.destContainer, names[1], ".busy"), "w").close()
+    bytterfs = Bytterfs(SNAPSHOT_NAME, scenario.source, scenario.destRootSubvol, scenario.destContainer, KEEP,
+                        "bench@localhost", "22", "/dev/null", stateDir=scenario.stateDir, deleteBatch=3,
+                        deleteCommit="after")
+    try:
+        deleted, failed = bytterfs.deleteSubvols(bytterfs.transport, scenario.destContainer, None, names[:4])
+    finally:
+        bytterfs.close()
+    assert failed == [names[1]]
+    assert deleted == [names[0], names[2], names[3]]
+    assert destSnapshots(scenario) == [names[1], names[4]]
+    with open(os.path.join(scenario.root, "spawns.log")) as f:
+        deletes = [line for line in f if line.startswith("btrfs ") and " delete " in line]
+    assert len(deletes) == 2 and all("--commit-after" in line for line in deletes)
@@ -0,0 +1,33 @@
+"""State kept between runs: where the job state and the run history are written, and that recording never decides
+a run's outcome."""
+import os
+
+from conftest import runBackup
+from bytterfs import JobState, RunHistory
+
+
+def test_run_is_recorded_in_the_configured_database(scenario, tmp_path):
+    path = str(tmp_path / "elsewhere" / "runs.db")
+    assert runBackup(scenario, historyDb=path).completed
+    assert [run["status"] for run in RunHistory(path).runs()] == ["ok"]
+    assert not os.path.exists(os.path.join(scenario.stateDir, "history.db"))
+
+
+def test_unwritable_history_keeps_the_outcome(scenario, tmp_path):
+    blocker = tmp_path / "blocker"
+    blocker.write_text(u"not a directory")
+    assert runBackup(scenario, historyDb=str(blocker / "history.db")).completed
+
+
+def test_job_state_follows_the_state_dir(scenario):
+    scenario.snapshot(3600)
+    assert runBackup(scenario).completed
+    assert JobState(os.path.join(scenario.stateDir, "bench.json")).chainLength == 1
+
+
+def test_job_state_in_the_configured_file(scenario, tmp_path):
+    path = str(tmp_path / "elsewhere" / "bench.json")
+    scenario.snapshot(3600)
+    assert runBackup(scenario, stateFile=path).completed
+    assert JobState(path).chainLength == 1
+    assert not os.path.exists(os.path.join(scenario.stateDir, "bench.json"))
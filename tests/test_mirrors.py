@@ -0,0 +1,70 @@
+"""Fan-out backups to the destination and a mirror over the ssh stand-in."""
+import os
+
+import bytterfs
+from conftest import FULL_SIZE, INC_SIZE, destSnapshots, receivedBytes, runBackup
+
+
+def addMirror(scenario):
+    root = os.path.join(scenario.root, "mirror") + "/"
+    os.makedirs(root + "c")
+    return root + "c/", "bench@localhost:22:/dev/null:%s:%s" % (root, root + "c/")
+
+
+def test_mirror_gets_full_and_destination_incremental(scenario):
+    container, spec = addMirror(scenario)
+    scenario.snapshot(3600)
+    bytterfs = runBackup(scenario, mirrors=[spec])
+    assert bytterfs.completed
+    assert receivedBytes(scenario) == FULL_SIZE + INC_SIZE
+    assert sorted(os.listdir(container)) == destSnapshots(scenario)[-1:]
+
+
+def test_recovery_deletes_only_the_interrupted_snapshot(scenario):
+    container, spec = addMirror(scenario)
+    scenario.snapshot(7200)
+    handMade = "bench_%s" % (scenario.now - 5400)
+    scenario.writeMeta(os.path.join(scenario.destContainer, handMade), {"uuid": "made-by-hand"})
+    partial = scenario.snapshot(3600, onDest=False)
+    scenario.writeMeta(os.path.join(container, partial), {"uuid": "interrupted"})
+    with open(os.path.join(scenario.source, "bytterfs.lock"), "w") as f:
+        f.write(partial)
+    bytterfs = runBackup(scenario, mirrors=[spec])
+    assert bytterfs.completed
+    assert handMade in destSnapshots(scenario)
+    assert partial not in os.listdir(container)
+    assert not os.path.exists(os.path.join(scenario.source, "bytterfs.lock"))
+
+
+def test_failed_client_cleanup_fails_the_run(scenario, monkeypatch):
+    container, spec = addMirror(scenario)
+    busy = scenario.snapshot(7200)
+    open(os.path.join(scenario.source, busy, ".busy"), "w").close()
+    scenario.snapshot(3600)
+    mails = []
+    monkeypatch.setattr(bytterfs, "sendmail", lambda event, subject, message: mails.append(message))
+    result = runBackup(scenario, mirrors=[spec])
+    assert not result.completed
+    assert busy in os.listdir(scenario.source)
+    assert len(mails) == 1 and busy in mails[0]
+
+
+def test_undeleted_partial_mirror_snapshot_is_reported(scenario, monkeypatch):
+    container, spec = addMirror(scenario)
+    scenario.snapshot(3600)
+    monkeypatch.setenv("BENCH_RECV_FAIL", container)
+    deleteSubvols = bytterfs.Bytterfs.deleteSubvols
+
+    def failingOnMirror(self, transport, path, inventory, names):
+        if path == container:
+            return [], list(names)
+        return deleteSubvols(self, transport, path, inventory, names)
+
+    monkeypatch.setattr(bytterfs.Bytterfs, "deleteSubvols", failingOnMirror)
+    mails = []
+    monkeypatch.setattr(bytterfs, "sendmail", lambda event, subject, message: mails.append(message))
+    result = runBackup(scenario, mirrors=[spec])
+    assert not result.completed
+    failedFor, leftovers = mails[0].splitlines()[:2]
+    assert failedFor.endswith("failed for: bench@localhost:%s" % container)
+    assert leftovers.startswith("Could not delete the incomplete") and leftovers.endswith(container)
@@ -0,0 +1,54 @@
+"""Local mode mounts: /proc/self/mountinfo lookups and the top level mount shared by the local jobs."""
+import bytterfs
+from bytterfs import CommandResult, SharedMount, findMount
+
+
+class FakeMounts:
+    """Stands in for /proc/self/mountinfo and for `sudo mount`/`sudo umount`, which change it."""
+
+    def __init__(self, monkeypatch, entries):
+        self.entries = entries
+        self.calls = []
+        monkeypatch.setattr(bytterfs, "iterMountinfo", lambda: iter(list(self.entries)))
+
+    def command(self, cmd):
+        self.calls.append(cmd[1])
+        if cmd[1] == "mount":
+            self.entries.append(mountEntry(cmd[-1], "/", "0:42", cmd[-2]))
+        elif cmd[1] == "umount":
+            self.entries = [entry for entry in self.entries if entry["mountPoint"] != cmd[-1]]
+        return CommandResult(cmd, 0, b"", b"", 0.0)
+
+
+def mountEntry(mountPoint, root, devNumber="0:42", device="/dev/sdb1"):
+    return {"mountPoint": mountPoint, "root": root, "devNumber": devNumber, "fsType": "btrfs", "device": device,
+            "superOptions": "rw"}
+
+
+def test_find_mount_takes_the_deepest_mount(monkeypatch):
+    FakeMounts(monkeypatch, [mountEntry("/", "/", "0:1", "/dev/sda1"), mountEntry("/backup", "/@backup"),
+                             mountEntry("/backup/other", "/@other", "0:43", "/dev/sdc1")])
+    assert findMount("/backup/c/")["root"] == "/@backup"
+    assert findMount("/backup/other/c/")["device"] == "/dev/sdc1"
+    assert findMount("/backupx/")["device"] == "/dev/sda1"
+
+
+def test_last_user_unmounts(monkeypatch, tmp_path):
+    mounts = FakeMounts(monkeypatch, [mountEntry("/backup", "/@backup")])
+    first, second = (SharedMount("fs", "/dev/sdb1", "0:42", str(tmp_path)) for i in range(2))
+    assert first.acquire(mounts.command) == str(tmp_path / "fs")
+    assert second.acquire(mounts.command) == str(tmp_path / "fs")
+    assert mounts.calls == ["mount"]
+    assert first.release(mounts.command)
+    assert mounts.calls == ["mount"]
+    assert second.release(mounts.command)
+    assert mounts.calls == ["mount", "umount"]
+    assert [entry["mountPoint"] for entry in mounts.entries] == ["/backup"]
+
+
+def test_top_level_mounted_elsewhere_is_left_alone(monkeypatch, tmp_path):
+    mounts = FakeMounts(monkeypatch, [mountEntry("/backup", "/@backup"), mountEntry("/mnt/pool", "/")])
+    shared = SharedMount("fs", "/dev/sdb1", "0:42", str(tmp_path))
+    assert shared.acquire(mounts.command) == "/mnt/pool"
+    assert shared.release(mounts.command)
+    assert mounts.calls == []
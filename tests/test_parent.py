@@ -0,0 +1,21 @@
+"""Choice of the incremental parent: the newest client snapshot the destination received, by received UUID."""
+from conftest import FULL_SIZE, INC_SIZE, receivedBytes, runBackup
+
+
+def test_same_named_snapshot_with_another_received_uuid_is_skipped(scenario):
+    common = scenario.snapshot(7200)
+    recreated = scenario.snapshot(3600, onDest=False)
+    assert scenario.destSnapshot(3600) == recreated  # Same name, received from another snapshot.
+    bytterfs = runBackup(scenario)
+    assert bytterfs.completed
+    assert bytterfs.runInfo["parent"] == common
+    assert receivedBytes(scenario) == INC_SIZE
+
+
+def test_no_received_snapshot_means_a_full_send(scenario):
+    scenario.snapshot(3600, onDest=False)
+    scenario.destSnapshot(3600)
+    bytterfs = runBackup(scenario)
+    assert bytterfs.completed
+    assert bytterfs.runInfo["mode"] == "full"
+    assert receivedBytes(scenario) == FULL_SIZE
@@ -0,0 +1,42 @@
+"""--overlapPrune: what the background deletions may and may not remove."""
+import os
+
+import bytterfs
+from conftest import destSnapshots, runBackup
+
+
+def clientSnapshots(scenario):
+    return sorted(name for name in os.listdir(scenario.source) if os.path.isdir(os.path.join(scenario.source, name)))
+
+
+def recordDeletions(monkeypatch):
+    """Returns the list that collects the names every PruneWorker is given to delete."""
+    names = []
+    init = bytterfs.PruneWorker.__init__
+
+    def recordingInit(self, owner, deletions):
+        names.extend(name for deletion in deletions for name in deletion[3])
+        init(self, owner, deletions)
+
+    monkeypatch.setattr(bytterfs.PruneWorker, "__init__", recordingInit)
+    return names
+
+
+def test_failed_send_keeps_the_client_snapshots(scenario, monkeypatch):
+    older = scenario.snapshot(7200)
+    parent = scenario.snapshot(3600)
+    monkeypatch.setenv("BENCH_RECV_FAIL", scenario.destContainer)
+    assert not runBackup(scenario, overlapPrune=True).completed
+    assert older in clientSnapshots(scenario) and parent in clientSnapshots(scenario)
+
+
+def test_parent_is_not_pruned_during_the_send(scenario, monkeypatch):
+    parent = scenario.snapshot(7200)
+    kept = scenario.destSnapshot(5400)
+    expired = scenario.destSnapshot(3600)  # 1w=1 keeps the middle one of three and drops the parent and this one.
+    deletions = recordDeletions(monkeypatch)
+    result = runBackup(scenario, keep="1w=1", overlapPrune=True)
+    assert result.completed
+    assert result.runInfo["parent"] == parent
+    assert deletions == [expired]
+    assert kept in destSnapshots(scenario)
@@ -0,0 +1,34 @@
+"""RetentionPolicy.plan(): bucket boundaries and which snapshots of a bucket are deleted."""
+import random
+
+from bytterfs import RetentionPolicy, evenSpread
+
+NOW = 1700000000
+WEEK = RetentionPolicy.units["w"]
+MONTH = RetentionPolicy.units["m"]
+
+
+def test_snapshot_on_a_boundary_belongs_to_the_older_bucket():
+    plan = RetentionPolicy.parse("1w=1,4w=1").plan([NOW - WEEK, NOW - 1], now=NOW)
+    assert [members for label, keep, members, victims in plan.buckets] == [[NOW - 1], [NOW - WEEK]]
+    assert plan.keep == [NOW - WEEK, NOW - 1] and plan.delete == []
+
+
+def test_snapshot_on_the_last_boundary_is_unmanaged():
+    plan = RetentionPolicy.parse("1w=1").plan([NOW - WEEK, NOW - 2, NOW - 1], now=NOW)
+    assert plan.unmanaged == [NOW - WEEK]
+    assert NOW - WEEK in plan.keep and NOW - WEEK not in plan.delete
+
+
+def test_victims_are_the_even_spread_picks():
+    policy = RetentionPolicy.parse("1w=7,4w=4,3m=3,12m=6")
+    rng = random.Random(9)
+    timestamps = sorted(set(NOW - rng.randrange(12 * MONTH) for i in range(500)))
+    plan = policy.plan(timestamps, now=NOW)
+    expected = []
+    for label, keep, members, victims in plan.buckets:
+        assert len(members) - len(victims) == min(keep, len(members))
+        expected.extend(evenSpread(members, max(0, len(members) - keep)))
+        assert victims == set(evenSpread(members, max(0, len(members) - keep)))
+    assert plan.delete == sorted(expected)
+    assert sorted(plan.keep + plan.delete) == timestamps
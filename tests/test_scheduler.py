@@ -0,0 +1,51 @@
+"""JobScheduler limits: which jobs run at the same time."""
+import threading
+import time
+
+import bytterfs
+from bytterfs import BackupJob, JobScheduler
+
+
+def localJob(monkeypatch, name, devices):
+    """A local job whose paths are on the devices {path: device}, with a run that only records when it ran."""
+    monkeypatch.setattr(bytterfs, "findMount", lambda path: {"device": devices[path]})
+    job = BackupJob(name, {"source": "/src/%s/" % name, "destRootSubvol": "/dest/%s/" % name,
+                           "destContainer": "/dest/%s/c/" % name, "destKeep": "1w=1", "sshHost": None,
+                           "sshPort": None, "sshKey": None})
+    job.spans = []
+
+    def run():
+        started = time.time()
+        time.sleep(0.3)
+        job.spans.append((started, time.time()))
+        job.status = "ok"
+
+    job.run = run
+    return job
+
+
+def overlap(first, second):
+    (start1, end1), (start2, end2) = first.spans[0], second.spans[0]
+    return start1 < end2 and start2 < end1
+
+
+def runJobs(jobs):
+    scheduler = JobScheduler(jobs, workers=4, hostLimit=1, deviceLimit=1)
+    thread = threading.Thread(target=scheduler.run)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_local_jobs_on_independent_disks_overlap(monkeypatch):
+    devices = {"/src/a/": "sda", "/dest/a/": "sdb", "/src/b/": "sdc", "/dest/b/": "sdd"}
+    first, second = localJob(monkeypatch, "a", devices), localJob(monkeypatch, "b", devices)
+    runJobs([first, second])
+    assert overlap(first, second)
+
+
+def test_local_jobs_to_one_destination_device_take_turns(monkeypatch):
+    devices = {"/src/a/": "sda", "/dest/a/": "sdb", "/src/b/": "sdc", "/dest/b/": "sdb"}
+    first, second = localJob(monkeypatch, "a", devices), localJob(monkeypatch, "b", devices)
+    runJobs([first, second])
+    assert not overlap(first, second)
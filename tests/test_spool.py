@@ -0,0 +1,44 @@
+"""Spooled transfers: chunks confirmed by the destination are not sent again when a run is resumed."""
+import os
+import re
+
+import bytterfs
+from conftest import FULL_SIZE, INC_SIZE, destSnapshots, receivedBytes, runBackup
+
+
+def uploads(scenario):
+    """Returns {(snapshot, chunk name): number of upload commands} from the stand-ins' log."""
+    counts = {}
+    with open(os.path.join(scenario.root, "spawns.log")) as f:
+        for line in f:
+            if line.startswith("ssh ") and " cat > " in line:
+                name = re.search(r"([^/]+)/(chunk-\d+)\.part", line).groups()
+                counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def test_resumed_upload_skips_confirmed_chunks(scenario, tmp_path, monkeypatch):
+    options = dict(spool=str(tmp_path / "spool"), remoteSpool=str(tmp_path / "remote") + "/", spoolChunkSize="1M")
+    wrapShell = bytterfs.SshTransport.wrapShell
+
+    def failingWrapShell(self, cmdString, tty=True):
+        if "chunk-000003.part" in cmdString:
+            return wrapShell(self, "false", tty)
+        return wrapShell(self, cmdString, tty)
+
+    monkeypatch.setattr(bytterfs.SshTransport, "wrapShell", failingWrapShell)
+    assert not runBackup(scenario, **options).completed
+    assert destSnapshots(scenario) == []
+    spooled = os.listdir(str(tmp_path / "spool"))[0]
+    assert sorted(uploads(scenario)) == [(spooled, "chunk-000000"), (spooled, "chunk-000001"),
+                                         (spooled, "chunk-000002")]
+
+    monkeypatch.setattr(bytterfs.SshTransport, "wrapShell", wrapShell)
+    assert runBackup(scenario, **options).completed
+    assert spooled in destSnapshots(scenario)
+    assert receivedBytes(scenario) == FULL_SIZE + INC_SIZE  # The resumed full send, then this run's snapshot.
+    counts = uploads(scenario)
+    assert len([key for key in counts if key[0] == spooled]) == 9
+    assert set(counts.values()) == {1}
+    with open(os.path.join(scenario.root, "spawns.log")) as f:
+        assert "sha256sum chunk-*" not in f.read()  # Each chunk is verified by its own upload, not by a scan.
@@ -0,0 +1,19 @@
+"""Backups over the ssh stand-in: one multiplexed connection per run, full and incremental sends."""
+from conftest import FULL_SIZE, INC_SIZE, destSnapshots, receivedBytes, runBackup
+
+
+def test_first_backup_sends_in_full(scenario):
+    bytterfs = runBackup(scenario)
+    assert bytterfs.completed
+    assert len(destSnapshots(scenario)) == 1
+    assert receivedBytes(scenario) == FULL_SIZE
+
+
+def test_incremental_uses_one_ssh_connection(scenario):
+    name = scenario.snapshot(3600)
+    bytterfs = runBackup(scenario)
+    assert bytterfs.completed
+    assert receivedBytes(scenario) == INC_SIZE
+    assert bytterfs.transport.connections == 1
+    assert bytterfs.transport.commands > 1
+    assert name in destSnapshots(scenario)
@@ -0,0 +1,33 @@
+"""Manifests: verify confirms what was sent and flags snapshots that no longer match their manifest."""
+import glob
+import json
+import os
+
+from conftest import KEEP, SNAPSHOT_NAME, runBackup
+from bytterfs import Bytterfs
+
+
+def verify(scenario, manifestDir):
+    bytterfs = Bytterfs(SNAPSHOT_NAME, scenario.source, scenario.destRootSubvol, scenario.destContainer, KEEP,
+                        "bench@localhost", "22", "/dev/null", stateDir=scenario.stateDir, manifestDir=manifestDir)
+    [(name, report)] = bytterfs.verify()
+    return report
+
+
+def test_corrupted_manifest_is_flagged(scenario, tmp_path):
+    manifestDir = str(tmp_path / "manifests") + "/"
+    older = scenario.snapshot(3600)
+    bytterfs = runBackup(scenario, checksum=True, manifestDir=manifestDir)
+    assert bytterfs.completed
+    sent = bytterfs.runInfo["snapshot"]
+    report = verify(scenario, manifestDir)
+    assert report["verified"] == [sent] and report["unverified"] == [older]
+    [path] = glob.glob(os.path.join(manifestDir, "*", "%s.json" % sent))
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest["sourceUUID"] = "00000000-0000-0000-0000-000000000000"
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+    report = verify(scenario, manifestDir)
+    assert report["mismatched"] == [sent]
+    assert report["verified"] == []